@@ -0,0 +1,264 @@
+# ems_project/alarm_engine.py
+# 警報規則引擎：收集程式每寫入一筆資料，只檢查以該資料表為來源的規則，
+# 以每條規則的「持續超標」狀態機判斷是否達到 duration_minutes，達到時自動開立 Alarm_Events (不重複開立)
+#
+# 用法:
+#   python alarm_engine.py          # 列出各資料表對應的啟用規則
+
+import datetime
+import operator
+import sqlite3
+import threading
+import time
+
+import db
+import rollup
+
+RULE_RELOAD_SECONDS = 60      # 多久重新讀取一次規則 (規則修改後最晚在此秒數內生效)
+CLOSED_STATUSES = ('closed', 'verified')
+EVENT_TYPE = '警報規則'
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+CONDITIONS = {
+    '>': operator.gt,
+    '>=': operator.ge,
+    '<': operator.lt,
+    '<=': operator.le,
+    '==': operator.eq,
+    '=': operator.eq,
+    '!=': operator.ne,
+}
+
+
+def init_alarm_tables(c):
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS Alarm_Rules (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL UNIQUE,              -- 規則名稱，例如 "空壓機耗電異常"
+            description TEXT,
+            source_type TEXT NOT NULL,              -- 來源類型, e.g., 'template', 'dashboard_chart', 'enpi'
+            source_id INTEGER NOT NULL,             -- 來源的 ID (範本、DashboardChart 或 EnPI ID)
+            target_column TEXT NOT NULL,            -- 要監控的欄位
+            condition TEXT NOT NULL,                -- 條件, e.g., '>', '<', '=='
+            threshold REAL NOT NULL,                -- 閾值
+            duration_minutes INTEGER DEFAULT 5,     -- 持續多少分鐘才觸發
+            is_active BOOLEAN DEFAULT 1,
+            notification_list TEXT                  -- 通知對象 (e.g., email list, a JSON string)
+        )
+    ''')
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS Alarm_Events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            rule_id INTEGER,                        -- 關聯的警報規則 ID (如果是手動建立可為 NULL)
+            event_title TEXT NOT NULL,              -- 事件標題 (如果由規則觸發，可自動生成)
+            event_time TEXT DEFAULT CURRENT_TIMESTAMP, -- 事件發生時間
+            status TEXT NOT NULL DEFAULT 'open',    -- 狀態: 'open', 'in_progress', 'closed', 'verified'
+            severity TEXT DEFAULT 'medium',         -- 嚴重性: 'low', 'medium', 'high'
+            assigned_to TEXT,                       -- 負責人
+            due_date TEXT, event_type TEXT, impact_scope TEXT, root_cause TEXT,
+            FOREIGN KEY (rule_id) REFERENCES Alarm_Rules (id)
+        )
+    ''')
+    c.execute('CREATE INDEX IF NOT EXISTS idx_alarm_events_rule ON Alarm_Events (rule_id, status)')
+
+
+def parse_sample_time(value):
+    """將資料列的時間欄位轉為 datetime；無法解析時回傳 None"""
+    if isinstance(value, datetime.datetime):
+        return value
+    try:
+        return datetime.datetime.strptime(str(value)[:19], TIME_FORMAT)
+    except (TypeError, ValueError):
+        return None
+
+
+class Rule:
+    """編譯後的單一規則：條件函式、持續秒數與來源資料表"""
+
+    def __init__(self, row, table_name):
+        self.id = row['id']
+        self.name = row['name']
+        self.table_name = table_name
+        self.column = row['target_column']
+        self.condition = row['condition'].strip()
+        self.compare = CONDITIONS[self.condition]
+        self.threshold = float(row['threshold'])
+        self.duration = datetime.timedelta(minutes=row['duration_minutes'] or 0)
+        # 定義改變時狀態需重新開始
+        self.signature = (table_name, self.column, self.condition, self.threshold, self.duration)
+
+    def title(self, value):
+        minutes = int(self.duration.total_seconds() // 60)
+        return f"{self.name}: {self.table_name}.{self.column} {self.condition} {self.threshold:g} 持續 {minutes} 分鐘 (目前值 {value:g})"
+
+
+class RuleState:
+    """
+    單一規則的狀態機：
+    breach_since 為目前這段連續超標的第一筆樣本時間 (None 代表未超標)；
+    fired 代表這段超標已處理過 (已開立或已有未結案的事件)，直到恢復正常前不再檢查。
+    """
+    __slots__ = ('breach_since', 'fired', 'last_time', 'event_id')
+
+    def __init__(self, event_id=None):
+        self.breach_since = None
+        self.fired = False
+        self.last_time = None
+        self.event_id = event_id
+
+    def copy(self):
+        state = RuleState(self.event_id)
+        state.breach_since, state.fired, state.last_time = self.breach_since, self.fired, self.last_time
+        return state
+
+
+SOURCE_QUERIES = {
+    'template': "SELECT id, template_name FROM data_templates",
+    'dashboard_chart': "SELECT id, source_table_name FROM DashboardCharts",
+    'enpi': "SELECT id, numerator_source_table FROM EnPI_Definitions WHERE numerator_source_type = 'auto'",
+}
+
+
+def _resolve_source_tables(c):
+    """各來源類型對應的資料表 {(source_type, source_id): table_name}"""
+    sources = {}
+    for source_type, query in SOURCE_QUERIES.items():
+        try:
+            for source_id, table_name in c.execute(query).fetchall():
+                sources[(source_type, source_id)] = table_name
+        except sqlite3.OperationalError:
+            pass  # 尚未建立該功能表格的資料庫
+    return sources
+
+
+class AlarmEngine:
+    """
+    規則依來源資料表建立索引：每筆寫入只檢查 rules_by_table[資料表] 中的規則，
+    每條規則只比較一次數值並更新狀態，不會回頭查詢歷史資料。
+    evaluate 在收集程式的寫入交易中開立事件並回傳待定的狀態，提交成功後再以 confirm 套用，
+    交易回滾時狀態不變，下一筆樣本會重新判斷。
+    """
+
+    def __init__(self):
+        self.rules_by_table = {}
+        self.states = {}
+        self.next_reload = 0.0
+        self._lock = threading.Lock()
+
+    def invalidate(self):
+        with self._lock:
+            self.next_reload = 0.0
+
+    def _load(self, c):
+        sources = _resolve_source_tables(c)
+        rules_by_table, states = {}, {}
+        open_events = {row[0]: row[1] for row in c.execute(
+            f"SELECT rule_id, MAX(id) FROM Alarm_Events WHERE rule_id IS NOT NULL AND status NOT IN ({', '.join('?' * len(CLOSED_STATUSES))}) GROUP BY rule_id",
+            CLOSED_STATUSES)}
+        c.execute("SELECT id, name, source_type, source_id, target_column, condition, threshold, duration_minutes FROM Alarm_Rules WHERE is_active = 1")
+        columns = [d[0] for d in c.description]
+        for values in c.fetchall():
+            row = dict(zip(columns, values))
+            table_name = sources.get((row['source_type'], row['source_id']))
+            if not table_name:
+                continue
+            try:
+                rule = Rule(row, table_name)
+            except (KeyError, TypeError, ValueError, AttributeError) as e:
+                print(f"警報規則 '{row['name']}' 設定錯誤，已略過: {e}")
+                continue
+            rules_by_table.setdefault(table_name, []).append(rule)
+            previous = self.states.get(rule.id)
+            if previous is not None and previous[0] == rule.signature:
+                states[rule.id] = previous
+            else:
+                states[rule.id] = (rule.signature, RuleState(open_events.get(rule.id)))
+        self.rules_by_table, self.states = rules_by_table, states
+        self.next_reload = time.monotonic() + RULE_RELOAD_SECONDS
+
+    def rules_for(self, c, table_name):
+        with self._lock:
+            if time.monotonic() >= self.next_reload:
+                try:
+                    self._load(c)
+                except sqlite3.OperationalError as e:
+                    if db.is_busy_error(e):
+                        raise
+                    self.rules_by_table, self.next_reload = {}, time.monotonic() + RULE_RELOAD_SECONDS  # 尚未建立警報表格
+            return self.rules_by_table.get(table_name, ())
+
+    def _event_is_open(self, c, event_id):
+        if event_id is None:
+            return False
+        row = c.execute("SELECT status FROM Alarm_Events WHERE id = ?", (event_id,)).fetchone()
+        return row is not None and row[0] not in CLOSED_STATUSES
+
+    def evaluate(self, c, table_name, data_row, sample_time=None):
+        """
+        以剛寫入的資料列更新規則狀態，必要時在同一交易中開立事件。
+        回傳 {rule_id: 新狀態}，交易提交後交給 confirm。
+        """
+        rules = self.rules_for(c, table_name)
+        if not rules:
+            return {}
+        sample_time = parse_sample_time(sample_time) or datetime.datetime.now()
+        pending = {}
+        for rule in rules:
+            value = rollup.to_number(data_row.get(rule.column))
+            if value is None:
+                continue
+            entry = self.states.get(rule.id)
+            if entry is None:
+                continue
+            state = entry[1]
+            if state.last_time is not None and sample_time < state.last_time:
+                continue  # 亂序的舊資料不影響狀態
+            new_state = state.copy()
+            new_state.last_time = sample_time
+            if not rule.compare(value, rule.threshold):
+                new_state.breach_since, new_state.fired = None, False
+            else:
+                if new_state.breach_since is None:
+                    new_state.breach_since = sample_time
+                if not new_state.fired and sample_time - new_state.breach_since >= rule.duration:
+                    new_state.fired = True
+                    if not self._event_is_open(c, new_state.event_id):
+                        new_state.event_id = self._open_event(c, rule, value, sample_time)
+            pending[rule.id] = (rule.signature, new_state)
+        return pending
+
+    def _open_event(self, c, rule, value, sample_time):
+        c.execute(
+            "INSERT INTO Alarm_Events (rule_id, event_title, event_time, status, severity, event_type, impact_scope) VALUES (?, ?, ?, 'open', 'medium', ?, ?)",
+            (rule.id, rule.title(value), sample_time.strftime(TIME_FORMAT), EVENT_TYPE, rule.table_name))
+        return c.lastrowid
+
+    def confirm(self, pending):
+        if not pending:
+            return
+        with self._lock:
+            for rule_id, (signature, state) in pending.items():
+                current = self.states.get(rule_id)
+                if current is not None and current[0] == signature:
+                    self.states[rule_id] = (signature, state)
+
+
+engine = AlarmEngine()
+
+
+def main():
+    conn = db.connect()
+    try:
+        engine.rules_for(conn.cursor(), None)
+        if not engine.rules_by_table:
+            print("目前沒有可對應到資料表的啟用規則。")
+        for table_name, rules in sorted(engine.rules_by_table.items()):
+            print(f"{table_name}:")
+            for rule in rules:
+                print(f"  [{rule.id}] {rule.name}: {rule.column} {rule.condition} {rule.threshold:g} 持續 {rule.duration}")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,101 @@
+# ems_project/analysis_query.py
+# 圖表分析查詢：只選取需要的欄位，在 SQL (或彙總資料表) 中完成分組與聚合，
+# 預覽與匯出共用同一份結果；匯出以 openpyxl write-only 模式逐列寫入。
+
+import datetime
+
+import retention
+import rollup
+
+# 時間群組: (彙總層級, strftime 格式, X 軸名稱)
+GROUPINGS = {
+    'hour': ('hour', '%H', '小時'),
+    'day': ('day', '%d', '日期 (日)'),
+    'month': ('month', '%m', '月份'),
+}
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+class AnalysisResult:
+    """分組後的分析結果：labels 為 X 軸 (整數)，rows 與 labels 對應，每列依 fields 順序排列各欄位的聚合值 (無數值時為 0)"""
+
+    def __init__(self, index_name, fields, labels, rows, source, warnings=None):
+        self.index_name = index_name
+        self.fields = fields
+        self.labels = labels
+        self.rows = rows
+        self.source = source
+        self.warnings = warnings or []
+
+    @property
+    def columns(self):
+        return [col for col, _ in self.fields]
+
+    def series(self, column):
+        index = self.columns.index(column)
+        return [row[index] for row in self.rows]
+
+
+def _keep_row(values):
+    """與舊版相同：所有欄位都是 0 或沒有數值的分組不顯示"""
+    return any(value for value in values)
+
+
+def run_analysis(conn, table, date_col, grouping, start_dt, end_dt, fields):
+    """
+    fields: [(欄位, 'SUM'|'AVG')]；時間範圍為 [start_dt, end_dt) 半開區間。
+    資料表已建立彙總且時間欄位相符時讀取彙總資料，否則以單一 GROUP BY 查詢只掃描選取的欄位。
+    無法轉為數值的值與無法解析的時間都會被略過 (與彙總資料的規則相同)。
+    """
+    tier, label_format, index_name = GROUPINGS[grouping]
+    start, end = start_dt.strftime(TIME_FORMAT), end_dt.strftime(TIME_FORMAT)
+    warnings = []
+    if rollup.has_rollup(conn, table, date_col) and all(col != date_col for col, _ in fields):
+        aliases = {(func, col): f"v{i}" for i, (col, func) in enumerate(fields)}
+        rows = rollup.query_rollup(conn, table, tier, start, end, aliases, *rollup.TIER_LABELS[tier])
+        data = [(int(row[0]), [row[1 + list(aliases).index((func, col))] for col, func in fields]) for row in rows]
+        source = 'rollup'
+    else:
+        rollup.register_functions(conn)
+        aggregates = [('COUNT', '*', None)] + [(func, rollup.num_sql(col), None) for col, func in fields]
+        rows = retention.aggregate_range(conn, table, date_col, f"""CAST(strftime('{label_format}', "{date_col}") AS INTEGER)""", aggregates, start, end)
+        data = []
+        for row in rows:
+            if row[0] is None:
+                warnings.append(f"欄位 '{date_col}' 中有 {row[1]} 筆資料無法解析為有效日期，已被忽略。")
+                continue
+            data.append((row[0], list(row[2:])))
+        source = 'sql'
+    data = [(label, [value if value is not None else 0 for value in values]) for label, values in data if _keep_row(values)]
+    return AnalysisResult(index_name, list(fields), [label for label, _ in data], [values for _, values in data], source, warnings)
+
+
+def export_excel(result, path, image=None, sheet_name='分析數據'):
+    """以 write-only 模式匯出：逐列寫入，不在記憶體中保留整張工作表；image 為 PNG 的 file-like 物件"""
+    from openpyxl import Workbook
+    from openpyxl.drawing.image import Image
+
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet(sheet_name)
+    sheet.append([result.index_name] + result.columns)
+    for label, values in zip(result.labels, result.rows):
+        sheet.append([label] + values)
+    if image is not None:
+        picture = Image(image)
+        picture.anchor = f'A{len(result.rows) + 5}'
+        sheet.add_image(picture)
+    workbook.save(path)
+
+
+def day_range(date):
+    start = datetime.datetime.combine(date, datetime.time.min)
+    return start, start + datetime.timedelta(days=1)
+
+
+def month_range(year, month):
+    start = datetime.datetime(year, month, 1)
+    return start, (start + datetime.timedelta(days=32)).replace(day=1)
+
+
+def year_range(year):
+    return datetime.datetime(year, 1, 1), datetime.datetime(year + 1, 1, 1)
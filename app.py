@@ -1,13 +1,24 @@
 # ems_project/app.py
 
-from flask import Flask, jsonify, render_template, request, redirect, url_for
+from flask import Flask, jsonify, render_template, request, redirect, url_for, make_response, Response
 import sqlite3
-import pandas as pd
 import datetime
 import os
+import io
 import json
 import traceback
-from datetime import datetime
+from datetime import datetime, timedelta
+import db
+from collector_core import ensure_time_indexes
+from dashboard_query import build_dashboard, get_chart_configs, invalidate_chart_configs
+from ingest import IngestError, detect_format, ingest_stream
+from dashboard_stream import broadcaster
+import enpi_report
+import baseline_eval
+import baseline_fit
+import rollup
+import schema_cache
+import chart_series
 
 def validate_date(date_str):
     if not date_str:
@@ -22,13 +33,28 @@ def validate_date(date_str):
 app = Flask(__name__, template_folder='templates', static_folder='static')
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-DB_NAME = "url_manager.db"
-DB_PATH = os.path.join(BASE_DIR, DB_NAME)
 def get_db_connection():
-    conn = sqlite3.connect(DB_PATH)
+    conn = db.connect()
     conn.row_factory = sqlite3.Row
     return conn
 
+_indexes_checked = False
+
+@app.before_request
+def ensure_db_indexes():
+    """啟動後第一個請求時，確認所有時間欄位都已建立索引"""
+    global _indexes_checked
+    if _indexes_checked:
+        return
+    _indexes_checked = True
+    conn = get_db_connection()
+    try:
+        ensure_time_indexes(conn)
+    except Exception as e:
+        print(f"建立時間欄位索引時發生錯誤: {e}")
+    finally:
+        conn.close()
+
 # --- 頁面路由 ---
 @app.route('/')
 def index():
@@ -86,18 +112,77 @@ def get_regression_baseline_details(id):
     finally:
         if conn: conn.close()
 
+@app.route('/api/regression_baselines/fit', methods=['POST'])
+def fit_regression_baselines():
+    """
+    由已收集的資料自動擬合迴歸基線 (設定格式見 baseline_fit.py)。
+    請求內容可為單一設定或設定陣列；?dry_run=1 時只回傳擬合結果不儲存。
+    """
+    specs = request.json
+    if isinstance(specs, dict):
+        specs = [specs]
+    if not specs or not isinstance(specs, list):
+        return jsonify({"error": "缺少擬合設定"}), 400
+    save = request.args.get('dry_run', '').lower() not in ('1', 'true', 'yes')
+    conn = get_db_connection()
+    try:
+        results = baseline_fit.fit_baselines(conn, specs, save=save)
+        return jsonify({"success": True, "message": f"已擬合 {len(results)} 條基線", "baselines": results}), 201 if save else 200
+    except baseline_fit.FitError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        conn.rollback()
+        return jsonify({"error": str(e), "trace": traceback.format_exc()}), 500
+    finally:
+        if conn: conn.close()
+
+@app.route('/api/regression_baselines/evaluate', methods=['GET'])
+def evaluate_regression_baselines():
+    """
+    伺服器端計算基線標準、差異與累積節能 (CUSUM)：?ids=1,2 (省略時為全部基線)。
+    所有基線的監控數據組成一個因子矩陣，以 NumPy 一次與係數相乘。
+    """
+    try:
+        ids = [int(i) for i in request.args.get('ids', '').split(',') if i.strip()]
+    except ValueError:
+        return jsonify({"error": "基線 ID 必須是整數"}), 400
+    conn = get_db_connection()
+    try:
+        return jsonify(baseline_eval.evaluate_baselines(conn, ids or None))
+    except Exception as e:
+        return jsonify({"error": str(e), "trace": traceback.format_exc()}), 500
+    finally:
+        if conn: conn.close()
+
+MONITORED_DATA_UPSERT = """
+    INSERT INTO MonitoredData (baseline_id, month, factors_json, actual_consumption) VALUES (?, ?, ?, ?) 
+    ON CONFLICT(baseline_id, month) DO UPDATE SET 
+        factors_json = excluded.factors_json, 
+        actual_consumption = excluded.actual_consumption
+"""
+
+def _monitored_data_rows(entries, default_baseline_id=None):
+    """驗證多個月份的監控數據，回傳 executemany 用的參數列表；格式錯誤時拋出 ValueError"""
+    rows = []
+    for entry in entries:
+        baseline_id = entry.get('baseline_id', default_baseline_id)
+        if baseline_id is None or entry.get('month') is None:
+            raise ValueError("每筆數據都必須包含 baseline_id 與 month")
+        month = int(entry['month'])
+        if not 1 <= month <= 12:
+            raise ValueError(f"月份必須介於 1 到 12: {month}")
+        actual = entry.get('actual_consumption')
+        rows.append((int(baseline_id), month, json.dumps(entry.get('factors') or {}), float(actual) if actual not in (None, '') else None))
+    return rows
+
 @app.route('/api/monitored_data', methods=['POST'])
 def handle_monitored_data():
     conn = get_db_connection()
     try:
         data = request.json
-        conn.execute("""
-            INSERT INTO MonitoredData (baseline_id, month, factors_json, actual_consumption) VALUES (?, ?, ?, ?) 
-            ON CONFLICT(baseline_id, month) DO UPDATE SET 
-                factors_json = excluded.factors_json, 
-                actual_consumption = excluded.actual_consumption
-        """, (data['baseline_id'], data['month'], json.dumps(data['factors']), data.get('actual_consumption')))
+        conn.execute(MONITORED_DATA_UPSERT, (data['baseline_id'], data['month'], json.dumps(data['factors']), data.get('actual_consumption')))
         conn.commit()
+        enpi_report.invalidate_baseline_data(data['baseline_id'])
         return jsonify({"success": True, "message": "監控數據已儲存"})
     except Exception as e:
         conn.rollback()
@@ -105,59 +190,135 @@ def handle_monitored_data():
     finally:
         if conn: conn.close()
 
+@app.route('/api/monitored_data/bulk', methods=['POST'])
+def handle_monitored_data_bulk():
+    """一次儲存多個月份：{"baseline_id": 1, "months": [{"month": 1, "factors": {...}, "actual_consumption": 123}, ...]}，於單一交易中寫入"""
+    data = request.json
+    entries = data.get('months', []) if isinstance(data, dict) else data
+    try:
+        rows = _monitored_data_rows(entries or [], data.get('baseline_id') if isinstance(data, dict) else None)
+    except (ValueError, TypeError, AttributeError) as e:
+        return jsonify({"error": f"數據格式錯誤: {e}"}), 400
+    conn = get_db_connection()
+    try:
+        conn.executemany(MONITORED_DATA_UPSERT, rows)
+        conn.commit()
+        for baseline_id in {row[0] for row in rows}:
+            enpi_report.invalidate_baseline_data(baseline_id)
+        return jsonify({"success": True, "message": f"已儲存 {len(rows)} 個月份的監控數據", "count": len(rows)})
+    except Exception as e:
+        conn.rollback()
+        return jsonify({"error": str(e), "trace": traceback.format_exc()}), 500
+    finally:
+        if conn: conn.close()
+
+
+# --- 歷史資料大量匯入 API ---
+@app.route('/api/ingest/<template>', methods=['POST'])
+def ingest_template_data(template):
+    """
+    以 CSV 或 JSON lines 匯入歷史資料至範本資料表 (template 為範本 ID 或名稱)。
+    可直接以請求內容上傳 (Content-Type: text/csv 或 application/x-ndjson)，或以表單欄位 file 上傳檔案；
+    ?format=csv|ndjson 可覆寫格式判斷。
+    """
+    upload = request.files.get('file')
+    if upload:
+        fmt = request.args.get('format') or detect_format(upload.filename, upload.content_type)
+        stream = io.TextIOWrapper(upload.stream, encoding='utf-8-sig', newline='')
+    else:
+        fmt = request.args.get('format') or detect_format('', request.content_type)
+        stream = io.TextIOWrapper(io.BufferedReader(request.stream), encoding='utf-8-sig', newline='')
+    try:
+        stats = ingest_stream(template, stream, fmt)
+        return jsonify({"success": True, **stats})
+    except IngestError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e), "trace": traceback.format_exc()}), 500
 
 # --- Dashboard Chart APIs ---
 @app.route('/api/realtime_dashboard', methods=['GET'])
 def get_realtime_dashboard_data():
-    # ... (此函式內容保持不變，使用之前修正好的版本) ...
     conn = get_db_connection()
-    dashboard_data = []
     try:
-        charts_cursor = conn.execute("SELECT * FROM DashboardCharts ORDER BY display_order, id")
-        for chart_row in charts_cursor.fetchall():
-            chart_config = dict(chart_row)
-            series_cursor = conn.execute("SELECT * FROM DashboardSeries WHERE chart_id = ?", (chart_config['id'],))
-            series_configs = [dict(s) for s in series_cursor.fetchall()]
-            if series_configs:
-                time_col = chart_config['time_column']
-                table_name = chart_config['source_table_name']
-                time_grouping = chart_config.get('time_grouping', 'hour')
-                if time_grouping == 'hour': sql_date_format, sql_group_by_format = "%Y-%m-%d", "strftime('%H', {time_col})"
-                elif time_grouping == 'day': sql_date_format, sql_group_by_format = "%Y-%m", "strftime('%d', {time_col})"
-                elif time_grouping == 'month': sql_date_format, sql_group_by_format = "%Y", "strftime('%m', {time_col})"
-                else: sql_date_format, sql_group_by_format = "%Y-%m-%d", "strftime('%H', {time_col})"
-                agg_clauses = []
-                for s_config in series_configs:
-                    method = s_config.get('aggregation_method')
-                    agg_func = "SUM" if method and method.lower() == 'sum' else "AVG"
-                    agg_clauses.append(f'{agg_func}("{s_config["source_column_name"]}") as "{s_config["source_column_name"]}"'
-)
-                agg_cols_str = ', '.join(agg_clauses)
-                query = f"""
-                    SELECT {sql_group_by_format.format(time_col=time_col)} as x_axis, {agg_cols_str} 
-                    FROM "{table_name}"
-                    WHERE strftime('{sql_date_format}', "{time_col}") = strftime('{sql_date_format}', 'now', 'localtime')
-                    AND "{time_col}" IS NOT NULL
-                    GROUP BY x_axis ORDER BY x_axis
-                """
-                df = pd.read_sql_query(query, conn)
-                if not df.empty:
-                    df = df.sort_values(by='x_axis')
-                    chart_data = {'tableName': chart_config['chart_title'], 'labels': df['x_axis'].tolist(), 'datasets': []}
-                    for s_config in series_configs:
-                        col_name = s_config['source_column_name']
-                        df[col_name] = pd.to_numeric(df[col_name], errors='coerce').fillna(0)
-                        method = s_config.get('aggregation_method')
-                        agg_label = "(累加)" if method and method.lower() == 'sum' else "(平均)"
-                        series_label_with_agg = f"{s_config['series_label']} {agg_label}"
-                        chart_data['datasets'].append({'label': series_label_with_agg, 'data': df[col_name].tolist(), 'type': s_config['chart_type'], 'yAxisID': s_config['y_axis_id']})
-                    dashboard_data.append(chart_data)
+        dashboard_data, etag = build_dashboard(conn)
     except Exception as e:
         print(f"產生儀表板數據時發生錯誤: {e}")
         return jsonify({"error": str(e), "trace": traceback.format_exc()}), 500
     finally:
         if conn: conn.close()
-    return jsonify(dashboard_data)
+    # 資料未變時回傳 304，瀏覽器直接使用快取內容
+    if request.if_none_match.contains(etag):
+        response = make_response('', 304)
+    else:
+        response = jsonify(dashboard_data)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+@app.route('/api/realtime_dashboard/stream', methods=['GET'])
+def stream_realtime_dashboard():
+    """
+    以 Server-Sent Events 推播儀表板：連線時送出全部圖表 (snapshot)，
+    之後只在來源表有新資料時送出變動的分組點 (delta) 或單一圖表 (chart)。
+    """
+    conn = get_db_connection()
+    try:
+        events = broadcaster.open_stream(conn)
+    except Exception as e:
+        print(f"建立儀表板推播時發生錯誤: {e}")
+        return jsonify({"error": str(e), "trace": traceback.format_exc()}), 500
+    finally:
+        conn.close()
+    response = Response(events, mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+@app.route('/api/chart_data', methods=['GET'])
+def get_chart_data():
+    """
+    任意時間範圍的圖表資料，點數不超過 points (預設 1000)。
+    參數: table, time_column (預設為彙總資料的時間欄位), columns ('a,b' 或 'a:SUM,b:MAX'), agg (預設 AVG),
+          from, to (預設為最近 24 小時), points, method ('lttb' 或 'minmax')；
+          或以 chart_id 使用儀表板圖表設定的資料表、時間欄位與序列。
+    """
+    conn = get_db_connection()
+    try:
+        now = datetime.now().replace(microsecond=0)
+        end_dt = chart_series.parse_time(request.args['to'], 'to') if request.args.get('to') else now
+        start_dt = chart_series.parse_time(request.args['from'], 'from') if request.args.get('from') else end_dt - timedelta(days=1)
+        chart_id = request.args.get('chart_id', type=int)
+        if chart_id is not None:
+            chart = next((c for c in get_chart_configs(conn) if c['id'] == chart_id), None)
+            if chart is None:
+                return jsonify({"error": "圖表不存在"}), 404
+            table, time_col = chart['source_table_name'], chart['time_column']
+            series = [(s['source_column_name'], 'SUM' if (s['aggregation_method'] or '').lower() == 'sum' else 'AVG',
+                       s['series_label'] or s['source_column_name']) for s in chart['series']]
+        else:
+            table = request.args.get('table')
+            if not table:
+                return jsonify({"error": "未提供資料表名稱"}), 400
+            time_col = request.args.get('time_column')
+            if not time_col:
+                try:
+                    time_col = rollup.get_rollup_time_column(conn, table)
+                except sqlite3.OperationalError:
+                    time_col = None
+            if not time_col:
+                return jsonify({"error": "未提供時間欄位"}), 400
+            series = chart_series.parse_series(request.args.get('columns'), request.args.get('agg', 'AVG'))
+        data = chart_series.query_chart_data(
+            conn, table, time_col, series, start_dt, end_dt,
+            request.args.get('points', chart_series.DEFAULT_POINTS, type=int), request.args.get('method', 'lttb'))
+        return jsonify(data)
+    except chart_series.ChartDataError as e:
+        return jsonify({"error": str(e)}), 400
+    except Exception as e:
+        return jsonify({"error": str(e), "trace": traceback.format_exc()}), 500
+    finally:
+        conn.close()
 
 
 
@@ -170,15 +331,10 @@ def get_realtime_dashboard_data():
 def get_available_tables():
     """回傳資料庫中所有可用的資料表名稱列表"""
     conn = get_db_connection()
-    # 排除 SQLite 系統表和我們自己的設定表
-    query = """
-        SELECT name FROM sqlite_master 
-        WHERE type='table' AND name NOT LIKE 'sqlite_%' AND name NOT LIKE 'Dashboard%' 
-        AND name NOT LIKE 'data_templates%' AND name NOT LIKE 'Regression%' AND name NOT LIKE 'Monitored%'
-    """
-    tables = [row['name'] for row in conn.execute(query).fetchall()]
-    conn.close()
-    return jsonify(tables)
+    try:
+        return jsonify(_get_data_table_names(conn))
+    finally:
+        conn.close()
 
 @app.route('/api/config/columns', methods=['GET'])
 def get_table_columns():
@@ -189,40 +345,25 @@ def get_table_columns():
     
     conn = get_db_connection()
     try:
-        # 獲取所有合法的資料表名稱
-        cursor = conn.execute("SELECT name FROM sqlite_master WHERE type='table'")
-        valid_tables = [row['name'] for row in cursor.fetchall()]
-
-        # 檢查請求的資料表名稱是否在合法列表中
-        if table_name not in valid_tables:
+        # 只接受結構快取中存在的資料表名稱
+        columns = schema_cache.get_columns(conn, table_name)
+        if columns is None:
             return jsonify({"error": "無效或不存在的資料表名稱"}), 400
-
-        # 使用安全的 PRAGMA 查詢
-        cursor = conn.execute(f'PRAGMA table_info("{table_name}")')
-        columns = [row['name'] for row in cursor.fetchall()]
         return jsonify(columns)
     except Exception as e:
         return jsonify({"error": f"無法讀取資料表 {table_name} 的資訊: {e}"}), 500
     finally:
         conn.close()
 
+# 排除 SQLite 系統表和我們自己的設定表 (與 SQL 的 NOT LIKE 相同，不分大小寫)
+EXCLUDED_TABLE_PREFIXES = ('sqlite_', 'dashboard', 'data_templates', 'regression', 'monitored')
+
+def _get_data_table_names(conn):
+    return [name for name in schema_cache.table_names(conn) if not name.lower().startswith(EXCLUDED_TABLE_PREFIXES)]
+
 def _get_valid_table_and_columns(conn):
-    valid_tables = {}
-    query = """
-        SELECT name FROM sqlite_master 
-        WHERE type='table' AND name NOT LIKE 'sqlite_%' AND name NOT LIKE 'Dashboard%' 
-        AND name NOT LIKE 'data_templates%' AND name NOT LIKE 'Regression%' AND name NOT LIKE 'Monitored%'
-    """
-    tables = [row['name'] for row in conn.execute(query).fetchall()]
-    
-    for table_name in tables:
-        try:
-            cursor = conn.execute(f'PRAGMA table_info("{table_name}")')
-            columns = [row['name'] for row in cursor.fetchall()]
-            valid_tables[table_name] = columns
-        except Exception:
-            pass # Ignore tables that can't be read for some reason
-    return valid_tables
+    catalog = schema_cache.get_catalog(conn)
+    return {table_name: catalog.columns(table_name) for table_name in _get_data_table_names(conn)}
 
 # 在 app.py 中，找到 handle_chart_configs 函式並替換
 @app.route('/api/config/charts', methods=['GET', 'POST'])
@@ -244,17 +385,13 @@ def handle_chart_configs():
                 (chart_id, series['source_column_name'], series['series_label'], series['chart_type'], series['y_axis_id'], series['aggregation_method'])
             )
         conn.commit()
+        invalidate_chart_configs()
+        ensure_time_indexes(conn)
         conn.close()
         return jsonify({"success": True, "message": "圖表已建立", "id": chart_id}), 201
 
-    else: # GET (保持不變，因為 `SELECT *` 會自動包含新欄位)
-        charts_cursor = conn.execute("SELECT * FROM DashboardCharts ORDER BY display_order, id")
-        charts = []
-        for chart_row in charts_cursor.fetchall():
-            chart_dict = dict(chart_row)
-            series_cursor = conn.execute("SELECT * FROM DashboardSeries WHERE chart_id = ?", (chart_dict['id'],))
-            chart_dict['series'] = [dict(s) for s in series_cursor.fetchall()]
-            charts.append(chart_dict)
+    else: # GET (圖表與數據系列以單一 JOIN 載入並快取，設定變更時才重新讀取)
+        charts = get_chart_configs(conn)
         conn.close()
         return jsonify(charts)
 # 在 app.py 中，找到 handle_single_chart_config 函式並替換
@@ -265,6 +402,7 @@ def handle_single_chart_config(chart_id):
     if request.method == 'DELETE':
         conn.execute("DELETE FROM DashboardCharts WHERE id = ?", (chart_id,))
         conn.commit()
+        invalidate_chart_configs()
         conn.close()
         return jsonify({"success": True, "message": "圖表已刪除"})
     
@@ -283,6 +421,8 @@ def handle_single_chart_config(chart_id):
                 (chart_id, series['source_column_name'], series['series_label'], series['chart_type'], series['y_axis_id'], series['aggregation_method'])
             )
         conn.commit()
+        invalidate_chart_configs()
+        ensure_time_indexes(conn)
         conn.close()
         return jsonify({"success": True, "message": "Chart updated"})
 
@@ -312,6 +452,7 @@ def handle_enpi_definitions():
                 data['denominator_source_type'], data.get('denominator_manual_name'), data.get('denominator_baseline_id'), data.get('denominator_source_table'), data.get('denominator_source_column'), data.get('denominator_time_column'), data.get('denominator_aggregation')
             ))
             conn.commit()
+            ensure_time_indexes(conn)
             return jsonify({"success": True, "message": "EnPI 已建立"}), 201
         
         definitions = conn.execute("SELECT * FROM EnPI_Definitions ORDER BY name").fetchall()
@@ -320,55 +461,41 @@ def handle_enpi_definitions():
         return jsonify({"error": str(e), "trace": traceback.format_exc()}), 500
     finally:
         if conn: conn.close()
-def _calculate_enpi_component(conn, definition, component_prefix, year):
-    """輔助函式，用於計算分子或分母的值"""
-    source_type = definition.get(f'{component_prefix}_source_type')
-    
-    if source_type == 'manual':
-        manual_name = definition.get(f'{component_prefix}_manual_name')
-        if not manual_name: return {}
-        data_rows = conn.execute(
-            "SELECT month, value FROM EnPI_Manual_Data WHERE enpi_id = ? AND year = ? AND variable_name = ?",
-            (definition['id'], year, manual_name)
-        ).fetchall()
-        return {row['month']: row['value'] for row in data_rows}
-    
-    elif source_type == 'auto':
-        agg = definition.get(f'{component_prefix}_aggregation')
-        table = definition.get(f'{component_prefix}_source_table')
-        column = definition.get(f'{component_prefix}_source_column')
-        time_col = definition.get(f'{component_prefix}_time_column')
-        
-        if not all([agg, table, column, time_col]): 
-            return {}
-        
-        query = f"""
-            SELECT CAST(strftime('%m', "{time_col}") AS INTEGER) as month, {agg}("{column}") as value 
-            FROM "{table}" WHERE strftime('%Y', "{time_col}") = '{year}' GROUP BY month
-        """
-        data_rows = conn.execute(query).fetchall()
-        return {row['month']: row['value'] for row in data_rows}
-    
-    elif source_type == 'baseline':
-        baseline_id = definition.get(f'{component_prefix}_baseline_id')
-        source_col = definition.get(f'{component_prefix}_source_column')
-        if not baseline_id or not source_col: 
-            return {}
-        
-        data_map = {}
-        monitored_data = conn.execute("SELECT month, actual_consumption, factors_json FROM MonitoredData WHERE baseline_id = ? AND year = ?", (baseline_id, year)).fetchall()
-        for row in monitored_data:
-            month = row['month']
-            if source_col == 'actual_consumption':
-                if row['actual_consumption'] is not None: 
-                    data_map[month] = row['actual_consumption']
-            else:
-                factors = json.loads(row['factors_json']) if row['factors_json'] else {}
-                if source_col in factors: 
-                    data_map[month] = factors[source_col]
-        return data_map
-    
-    return {}
+MAX_REPORT_YEARS = 20  # 多年度報表一次最多計算的年數
+
+ENPI_TARGET_UPSERT = """
+    INSERT INTO EnPI_Targets (enpi_id, year, month, target_value) 
+    VALUES (?, ?, ?, ?) ON CONFLICT(enpi_id, year, month) 
+    DO UPDATE SET target_value = excluded.target_value
+"""
+ENPI_MANUAL_UPSERT = """
+    INSERT INTO EnPI_Manual_Data (enpi_id, year, month, variable_name, value) 
+    VALUES (?, ?, ?, ?, ?) ON CONFLICT(enpi_id, year, month, variable_name) 
+    DO UPDATE SET value = excluded.value
+"""
+
+def _enpi_month_rows(enpi_def, year, entries):
+    """
+    將多個月份的輸入轉為 (目標值參數列表, 人工數據參數列表)，供 executemany 寫入。
+    空白的值略過；只有來源為 manual 的分子/分母才會寫入人工數據。格式錯誤時拋出 ValueError。
+    """
+    enpi_id = enpi_def['id']
+    manual_names = [(enpi_def.get(f'{part}_manual_name'), f'{part}_value') for part in ('numerator', 'denominator')
+                    if enpi_def.get(f'{part}_source_type') == 'manual' and enpi_def.get(f'{part}_manual_name')]
+    targets, manual = [], []
+    for entry in entries:
+        month = int(entry.get('month'))
+        if not 1 <= month <= 12:
+            raise ValueError(f"月份必須介於 1 到 12: {month}")
+        target_value = entry.get('target_value')
+        if target_value is not None and target_value != '':
+            targets.append((enpi_id, year, month, float(target_value)))
+        for variable_name, key in manual_names:
+            value = entry.get(key)
+            if value is not None and value != '':
+                manual.append((enpi_id, year, month, variable_name, float(value)))
+    return targets, manual
+
 # 在 app.py 中，找到並用這個【終極修正版】替換 handle_enpi_data 函式
 
 @app.route('/api/enpi/data/<int:enpi_id>/<int:year>', methods=['GET', 'POST'])
@@ -384,61 +511,13 @@ def handle_enpi_data(enpi_id, year):
         if request.method == 'POST':
             data = request.json
             month = data.get('month')
-            
-            def upsert_manual_data(variable_name, value):
-                if value is not None and value != '':
-                    if variable_name:
-                        conn.execute("""
-                            INSERT INTO EnPI_Manual_Data (enpi_id, year, month, variable_name, value) 
-                            VALUES (?, ?, ?, ?, ?) ON CONFLICT(enpi_id, year, month, variable_name) 
-                            DO UPDATE SET value = excluded.value
-                        """, (enpi_id, year, month, variable_name, float(value)))
-
-            target_value = data.get('target_value')
-            if target_value is not None and target_value != '':
-                conn.execute("""
-                    INSERT INTO EnPI_Targets (enpi_id, year, month, target_value) 
-                    VALUES (?, ?, ?, ?) ON CONFLICT(enpi_id, year, month) 
-                    DO UPDATE SET target_value = excluded.target_value
-                """, (enpi_id, year, month, float(target_value)))
-            
-            if enpi_def.get('numerator_source_type') == 'manual':
-                upsert_manual_data(enpi_def.get('numerator_manual_name'), data.get('numerator_value'))
-            if enpi_def.get('denominator_source_type') == 'manual':
-                upsert_manual_data(enpi_def.get('denominator_manual_name'), data.get('denominator_value'))
-
+            targets, manual = _enpi_month_rows(enpi_def, year, [data])
+            conn.executemany(ENPI_TARGET_UPSERT, targets)
+            conn.executemany(ENPI_MANUAL_UPSERT, manual)
             conn.commit()
             return jsonify({"success": True, "message": f"{year}年{month}月數據已儲存"})
 
-        numerators_map = _calculate_enpi_component(conn, enpi_def, 'numerator', year)
-        denominators_map = _calculate_enpi_component(conn, enpi_def, 'denominator', year)
-        
-        targets_data = conn.execute("SELECT month, target_value FROM EnPI_Targets WHERE enpi_id = ? AND year = ?", (enpi_id, year)).fetchall()
-        targets_map = {t['month']: t['target_value'] for t in targets_data}
-
-        report = []
-        for month in range(1, 13):
-            num_raw = numerators_map.get(month)
-            den_raw = denominators_map.get(month)
-            
-            actual_enpi = None
-            
-            try:
-                num_val = float(num_raw) if num_raw is not None else None
-                den_val = float(den_raw) if den_raw is not None else None
-                
-                if isinstance(num_val, (int, float)) and isinstance(den_val, (int, float)) and den_val != 0:
-                    actual_enpi = num_val / den_val
-            except (ValueError, TypeError):
-                actual_enpi = None
-
-            report.append({
-                "month": month, "month_name": f"{month}月", 
-                "target_value": targets_map.get(month), 
-                "numerator_value": num_raw,
-                "denominator_value": den_raw,
-                "actual_enpi": actual_enpi
-            })
+        report = enpi_report.build_reports(conn, [enpi_def], year, year)[enpi_id][year]
 
         return jsonify({"definition": enpi_def, "report": report})
 
@@ -448,6 +527,65 @@ def handle_enpi_data(enpi_id, year):
         return jsonify({"error": str(e), "trace": traceback.format_exc()}), 500
     finally:
         if conn: conn.close()
+
+@app.route('/api/enpi/data/<int:enpi_id>/<int:year>/bulk', methods=['POST'])
+def handle_enpi_data_bulk(enpi_id, year):
+    """一次儲存整年度的目標值與人工數據：{"months": [{"month": 1, "target_value": ..., "numerator_value": ..., "denominator_value": ...}, ...]}"""
+    data = request.json
+    entries = data.get('months', []) if isinstance(data, dict) else data
+    conn = get_db_connection()
+    try:
+        enpi_def_row = conn.execute("SELECT * FROM EnPI_Definitions WHERE id = ?", (enpi_id,)).fetchone()
+        if not enpi_def_row:
+            return jsonify({"error": "EnPI not found"}), 404
+        try:
+            targets, manual = _enpi_month_rows(dict(enpi_def_row), year, entries or [])
+        except (ValueError, TypeError, AttributeError) as e:
+            return jsonify({"error": f"數據格式錯誤: {e}"}), 400
+        conn.executemany(ENPI_TARGET_UPSERT, targets)
+        conn.executemany(ENPI_MANUAL_UPSERT, manual)
+        conn.commit()
+        return jsonify({"success": True, "message": f"{year}年 {len(entries or [])} 個月份的數據已儲存", "count": len(entries or [])})
+    except Exception as e:
+        conn.rollback()
+        return jsonify({"error": str(e), "trace": traceback.format_exc()}), 500
+    finally:
+        if conn: conn.close()
+@app.route('/api/enpi/report', methods=['GET'])
+def get_enpi_report():
+    """
+    多年度、多 EnPI 報表：?start_year=2021&end_year=2025&ids=1,2 (ids 省略時為全部 EnPI)。
+    同一來源表/時間欄位的分子分母共用一次分組查詢，回傳每個 EnPI 每年 12 個月的報表。
+    """
+    this_year = datetime.now().year
+    try:
+        end_year = int(request.args.get('end_year', this_year))
+        start_year = int(request.args.get('start_year', end_year - 4))
+        ids = [int(i) for i in request.args.get('ids', '').split(',') if i.strip()]
+    except ValueError:
+        return jsonify({"error": "年度與 EnPI ID 必須是整數"}), 400
+    if start_year > end_year or end_year - start_year >= MAX_REPORT_YEARS:
+        return jsonify({"error": f"年度範圍必須介於 1 到 {MAX_REPORT_YEARS} 年"}), 400
+    conn = get_db_connection()
+    try:
+        query, params = "SELECT * FROM EnPI_Definitions", []
+        if ids:
+            query += f" WHERE id IN ({', '.join('?' * len(ids))})"
+            params = ids
+        definitions = [dict(row) for row in conn.execute(query + " ORDER BY name", params).fetchall()]
+        reports = enpi_report.build_reports(conn, definitions, start_year, end_year)
+        return jsonify({
+            "start_year": start_year, "end_year": end_year,
+            "enpis": [
+                {"definition": d, "years": [{"year": year, "report": report} for year, report in reports[d['id']].items()]}
+                for d in definitions
+            ]
+        })
+    except Exception as e:
+        return jsonify({"error": str(e), "trace": traceback.format_exc()}), 500
+    finally:
+        if conn: conn.close()
+
 # =========================================================
 #  ↓↓↓ 新增：異常事件與行動方案管理 API ↓↓↓
 # =========================================================
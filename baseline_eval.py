@@ -0,0 +1,141 @@
+# ems_project/baseline_eval.py
+# 迴歸基線評估：由 MonitoredData.factors_json 建立因子矩陣，與係數向量一次相乘，
+# 計算各月份的基線標準 (預期能耗)、差異與累積節能 (CUSUM)，可一次評估多個基線。
+
+import json
+
+import numpy as np
+
+import rollup
+import schema_cache
+
+
+def _placeholders(values):
+    return ', '.join('?' * len(values))
+
+
+def load_baselines(conn, baseline_ids=None):
+    """
+    讀取基線、係數與監控數據 (每個表格各查詢一次)。
+    回傳 (baselines, factors, monitored)：
+    baselines 為 [dict]、factors 為 {baseline_id: [(因子, 係數)]}、monitored 為 [(baseline_id, year, month, factors, actual)]。
+    """
+    query, params = "SELECT * FROM RegressionBaselines", []
+    if baseline_ids:
+        query += f" WHERE id IN ({_placeholders(baseline_ids)})"
+        params = list(baseline_ids)
+    baselines = [dict(row) for row in conn.execute(query + " ORDER BY year DESC, name ASC", params).fetchall()]
+    ids = [b['id'] for b in baselines]
+    if not ids:
+        return [], {}, []
+    factors = {baseline_id: [] for baseline_id in ids}
+    for baseline_id, name, coefficient in conn.execute(
+            f"SELECT baseline_id, factor_name, coefficient FROM RegressionFactors WHERE baseline_id IN ({_placeholders(ids)}) ORDER BY id", ids):
+        factors[baseline_id].append((name, coefficient))
+    # 舊版資料庫的 MonitoredData 沒有 year 欄位，以基線年度代替
+    has_year = schema_cache.has_column(conn, 'MonitoredData', 'year')
+    year_sql = "year" if has_year else "NULL"
+    monitored = [
+        (baseline_id, year, month, json.loads(factors_json) if factors_json else {}, actual)
+        for baseline_id, year, month, factors_json, actual in conn.execute(
+            f"SELECT baseline_id, {year_sql}, month, factors_json, actual_consumption FROM MonitoredData WHERE baseline_id IN ({_placeholders(ids)})", ids)
+    ]
+    return baselines, factors, monitored
+
+
+def evaluate(baselines, factors, monitored):
+    """
+    所有基線的所有月份組成一個矩陣一次計算：
+    X[列, 因子] 為該月的因子值、C[列, 因子] 為該列所屬基線的係數 (不使用的因子為 0)，
+    預期值 = 截距 + (X * C) 逐列加總；缺少任一需要的因子時預期值為 None。
+    差異 = 預期值 - 實際值 (正值代表節能)，CUSUM 為同一基線依年月排序後的差異累積和。
+    回傳 {baseline_id: [月份結果 dict, ...]}。
+    """
+    baseline_map = {b['id']: b for b in baselines}
+    results = {b['id']: [] for b in baselines}
+    rows = sorted(
+        (r for r in monitored if r[0] in baseline_map),
+        key=lambda r: (r[0], r[1] if r[1] is not None else baseline_map[r[0]]['year'], r[2]))
+    if not rows:
+        return results
+
+    names = sorted({name for items in factors.values() for name, _ in items})
+    column = {name: j for j, name in enumerate(names)}
+    n, m = len(rows), len(names)
+    X = np.full((n, m), np.nan)
+    C = np.zeros((n, m))
+    needed = np.zeros((n, m), dtype=bool)
+    intercepts = np.empty(n)
+    actual = np.full(n, np.nan)
+    coefficient_rows = {}
+    for baseline_id, items in factors.items():
+        coeffs, mask = np.zeros(m), np.zeros(m, dtype=bool)
+        for name, coefficient in items:
+            coeffs[column[name]] += coefficient
+            mask[column[name]] = True
+        coefficient_rows[baseline_id] = (coeffs, mask)
+    for i, (baseline_id, _, _, values, actual_value) in enumerate(rows):
+        C[i], needed[i] = coefficient_rows[baseline_id]
+        intercepts[i] = baseline_map[baseline_id]['formula_intercept']
+        for name, value in values.items():
+            j = column.get(name)
+            if j is not None:
+                number = rollup.to_number(value)
+                if number is not None:
+                    X[i, j] = number
+        number = rollup.to_number(actual_value)
+        if number is not None:
+            actual[i] = number
+
+    missing = (needed & np.isnan(X)).any(axis=1)
+    expected = intercepts + (np.where(needed, np.nan_to_num(X), 0.0) * C).sum(axis=1)
+    expected[missing] = np.nan
+    deviation = expected - actual
+    with np.errstate(divide='ignore', invalid='ignore'):
+        deviation_percent = np.where(expected != 0, deviation / expected * 100, 0.0)
+    deviation_percent[np.isnan(deviation)] = np.nan
+
+    # 分段累積和：整體累積後扣除各基線起點之前的累積值
+    filled = np.nan_to_num(deviation)
+    running = np.cumsum(filled)
+    group_ids = np.array([r[0] for r in rows])
+    starts = np.r_[True, group_ids[1:] != group_ids[:-1]]
+    offsets = np.maximum.accumulate(np.where(starts, np.arange(n), 0))
+    cusum = running - (running[offsets] - filled[offsets])
+
+    def value(array, i):
+        return None if np.isnan(array[i]) else float(array[i])
+
+    for i, (baseline_id, year, month, values, actual_value) in enumerate(rows):
+        results[baseline_id].append({
+            "year": year if year is not None else baseline_map[baseline_id]['year'],
+            "month": month,
+            "factors": values,
+            "actual_consumption": actual_value,
+            "expected": value(expected, i),
+            "deviation": value(deviation, i),
+            "deviation_percent": value(deviation_percent, i),
+            "cusum": float(cusum[i]),
+        })
+    return results
+
+
+def evaluate_baselines(conn, baseline_ids=None):
+    """回傳 [{baseline, factors, months, totals}]，months 依年月排序"""
+    baselines, factors, monitored = load_baselines(conn, baseline_ids)
+    results = evaluate(baselines, factors, monitored)
+    report = []
+    for baseline in baselines:
+        months = results[baseline['id']]
+        paired = [r for r in months if r['deviation'] is not None]
+        report.append({
+            "baseline": baseline,
+            "factors": [{"factor_name": name, "coefficient": coefficient} for name, coefficient in factors[baseline['id']]],
+            "months": months,
+            "totals": {
+                "expected": sum(r['expected'] for r in paired),
+                "actual": sum(r['expected'] - r['deviation'] for r in paired),
+                "deviation": sum(r['deviation'] for r in paired),
+            },
+        })
+    return report
@@ -0,0 +1,250 @@
+# ems_project/baseline_fit.py
+# 由已收集的資料自動建立迴歸基線：
+# 目標能耗欄位與各因子序列依月或日對齊後，以最小平方法 (NumPy) 一次求解截距、係數與 R²，並寫入 RegressionBaselines。
+#
+# 用法:
+#   python baseline_fit.py specs.json              # 依設定檔 (單一設定或設定陣列) 擬合並儲存
+#   python baseline_fit.py specs.json --dry-run    # 只顯示擬合結果，不寫入資料庫
+#
+# 設定格式:
+#   {"name": "114年 哈特佛用電基線", "grain": "month", "start": "2025-01-01", "end": "2026-01-01",
+#    "target": {"table": "哈特佛用電", "column": "耗電度數", "aggregation": "SUM"},
+#    "factors": [{"name": "工時", "activity_name": "工時", "aggregation": "SUM"},
+#                {"name": "外氣溫度", "table": "三廠空調", "column": "溫度", "aggregation": "AVG"}],
+#    "replace": true}
+
+import argparse
+import json
+
+import numpy as np
+
+import db
+import retention
+import rollup
+import schema_cache
+
+GRAINS = {'month': 7, 'day': 10}   # 對齊粒度對應的時間字串前綴長度
+SQL_AGGREGATES = {'SUM', 'AVG', 'MIN', 'MAX', 'COUNT'}
+
+
+class FitError(Exception):
+    """擬合設定錯誤或資料不足"""
+
+
+def _aggregation(spec):
+    agg = str(spec.get('aggregation') or 'SUM').upper()
+    if agg not in SQL_AGGREGATES:
+        raise FitError(f"不支援的聚合方式: {agg}")
+    return agg
+
+
+def _resolve_time_column(conn, table):
+    """未指定時間欄位時，使用彙總資料的時間欄位或範本中 'now' 公式的欄位"""
+    try:
+        time_column = rollup.get_rollup_time_column(conn, table)
+    except Exception:
+        time_column = None
+    if time_column:
+        return time_column
+    row = conn.execute("SELECT columns_config FROM data_templates WHERE template_name = ?", (table,)).fetchone()
+    if row:
+        for col in json.loads(row[0]):
+            if col['type'] == '動態公式' and str(col['value']).strip().lower() == 'now':
+                return col['name']
+    raise FitError(f"無法判斷資料表 '{table}' 的時間欄位，請指定 time_column")
+
+
+def _query_table_group(conn, table, time_column, aggregates, grain, start, end):
+    """同一資料表的所有序列一次分組查詢，回傳 {(聚合, 欄位): {bucket: 值}}"""
+    aliases = {spec: f"v{i}" for i, spec in enumerate(sorted(aggregates))}
+    if grain in rollup.TIERS and all(agg in rollup.ROLLUP_AGGREGATES and column != time_column for agg, column in aliases) \
+            and rollup.has_rollup(conn, table, time_column):
+        rows = rollup.query_rollup(conn, table, grain, start, end, aliases)
+    else:
+        rollup.register_functions(conn)
+        aggregate_specs = [(agg, rollup.num_sql(column), alias) for (agg, column), alias in aliases.items()]
+        rows = retention.aggregate_range(conn, table, time_column, f'substr("{time_column}", 1, {GRAINS[grain]})', aggregate_specs, start, end)
+    series = {spec: {} for spec in aliases}
+    for row in rows:
+        for index, spec in enumerate(aliases, start=1):
+            if row[index] is not None:
+                series[spec][row[0]] = row[index]
+    return series
+
+
+def _query_activities(conn, names, grain, start, end):
+    """ActivityData 的所有活動一次查詢，回傳 {(聚合, 活動名稱): {bucket: 值}}"""
+    rows = conn.execute(f'''
+        SELECT substr(date, 1, {GRAINS[grain]}) AS x_axis, activity_name,
+               SUM(value), AVG(value), MIN(value), MAX(value), COUNT(value)
+        FROM ActivityData WHERE date >= ? AND date < ? AND activity_name IN ({', '.join('?' * len(names))})
+        GROUP BY x_axis, activity_name
+    ''', [start, end] + sorted(names)).fetchall()
+    series = {}
+    for bucket, name, *values in rows:
+        for agg, value in zip(('SUM', 'AVG', 'MIN', 'MAX', 'COUNT'), values):
+            series.setdefault((agg, name), {})[bucket] = value
+    return series
+
+
+def load_series(conn, spec):
+    """回傳 (目標序列, [(因子名稱, 因子序列)])，序列皆為 {bucket: 值}"""
+    grain = spec.get('grain', 'month')
+    if grain not in GRAINS:
+        raise FitError(f"不支援的對齊粒度: {grain}")
+    start, end = spec.get('start'), spec.get('end')
+    if not start or not end:
+        raise FitError("必須指定 start 與 end")
+    target = spec.get('target') or {}
+    factors = spec.get('factors') or []
+    if not isinstance(target, dict) or not target.get('table') or not target.get('column'):
+        raise FitError("target 必須包含 table 與 column")
+    if not isinstance(factors, list) or not factors:
+        raise FitError("至少需要一個因子")
+    if not all(isinstance(f, dict) for f in factors):
+        raise FitError("factors 的每個因子必須是物件")
+
+    catalog = schema_cache.get_catalog(conn)
+    sources = [('__target__', target)] + [(f.get('name') or f.get('column') or f.get('activity_name'), f) for f in factors]
+    table_groups, activity_names, keys = {}, set(), []
+    for name, source in sources:
+        agg = _aggregation(source)
+        if source.get('activity_name'):
+            activity_names.add(source['activity_name'])
+            keys.append((name, ('activity', None), (agg, source['activity_name'])))
+        elif source.get('table') and source.get('column'):
+            info = catalog.tables.get(source['table'])
+            if info is None:
+                raise FitError(f"資料表不存在: {source['table']}")
+            if not info.has_column(source['column']):
+                raise FitError(f"欄位不存在: {source['table']}.{source['column']}")
+            time_column = source.get('time_column') or _resolve_time_column(conn, source['table'])
+            if not info.has_column(time_column):
+                raise FitError(f"時間欄位不存在: {source['table']}.{time_column}")
+            group = (source['table'], time_column)
+            table_groups.setdefault(group, set()).add((agg, source['column']))
+            keys.append((name, group, (agg, source['column'])))
+        else:
+            raise FitError(f"因子 '{name}' 必須指定 activity_name，或 table 與 column")
+
+    results = {}
+    for (table, time_column), aggregates in table_groups.items():
+        for series_key, values in _query_table_group(conn, table, time_column, aggregates, grain, start, end).items():
+            results[((table, time_column), series_key)] = values
+    if activity_names:
+        for series_key, values in _query_activities(conn, activity_names, grain, start, end).items():
+            results[(('activity', None), series_key)] = values
+
+    loaded = [(name, results.get((group, series_key), {})) for name, group, series_key in keys]
+    return loaded[0][1], loaded[1:]
+
+
+def fit(target_series, factor_series):
+    """
+    依 bucket 對齊 (只保留所有序列都有數值的時段) 後求解 y = b0 + Σ bi·xi。
+    回傳 {'intercept', 'coefficients': [(名稱, 係數)], 'r2', 'points', 'buckets'}。
+    """
+    buckets = sorted(set(target_series).intersection(*(series.keys() for _, series in factor_series)))
+    y = np.array([rollup.to_number(target_series[b]) for b in buckets], dtype=float)
+    X = np.array([[rollup.to_number(series[b]) for _, series in factor_series] for b in buckets], dtype=float).reshape(len(buckets), len(factor_series))
+    valid = ~(np.isnan(y) | np.isnan(X).any(axis=1))
+    y, X = y[valid], X[valid]
+    buckets = [b for b, ok in zip(buckets, valid) if ok]
+    if len(buckets) < len(factor_series) + 2:
+        raise FitError(f"對齊後只有 {len(buckets)} 個時段，至少需要 {len(factor_series) + 2} 個才能擬合 {len(factor_series)} 個因子")
+
+    design = np.column_stack([np.ones(len(y)), X])
+    solution, _, rank, _ = np.linalg.lstsq(design, y, rcond=None)
+    if rank < design.shape[1]:
+        raise FitError("因子之間線性相依 (或某因子為常數)，無法唯一求解")
+    residual = y - design @ solution
+    total = y - y.mean()
+    ss_tot = float(total @ total)
+    r2 = 1.0 - float(residual @ residual) / ss_tot if ss_tot > 0 else None
+    return {
+        'intercept': float(solution[0]),
+        'coefficients': [(name, float(coef)) for (name, _), coef in zip(factor_series, solution[1:])],
+        'r2': r2,
+        'points': len(buckets),
+        'buckets': buckets,
+    }
+
+
+def save_baseline(conn, spec, result):
+    """寫入 (或 replace=True 時更新同名的) 迴歸基線與係數，回傳基線 ID；由呼叫端提交"""
+    name = spec.get('name')
+    if not name:
+        raise FitError("必須指定基線名稱 name")
+    year = int(spec.get('year') or str(spec['start'])[:4])
+    notes = spec.get('notes') or f"由 {spec['target']['table']}.{spec['target']['column']} 自動擬合 ({spec.get('grain', 'month')}, {result['points']} 個時段)"
+    existing = conn.execute("SELECT id FROM RegressionBaselines WHERE name = ?", (name,)).fetchone()
+    if existing and not spec.get('replace'):
+        raise FitError(f"基線名稱已存在: {name} (設定 replace 以重新擬合)")
+    if existing:
+        baseline_id = existing[0]
+        conn.execute("UPDATE RegressionBaselines SET year = ?, formula_intercept = ?, formula_r2 = ?, notes = ? WHERE id = ?",
+                     (year, result['intercept'], result['r2'], notes, baseline_id))
+        conn.execute("DELETE FROM RegressionFactors WHERE baseline_id = ?", (baseline_id,))
+    else:
+        baseline_id = conn.execute("INSERT INTO RegressionBaselines (name, year, formula_intercept, formula_r2, notes) VALUES (?, ?, ?, ?, ?)",
+                                   (name, year, result['intercept'], result['r2'], notes)).lastrowid
+    conn.executemany("INSERT INTO RegressionFactors (baseline_id, factor_name, coefficient) VALUES (?, ?, ?)",
+                     [(baseline_id, factor_name, coefficient) for factor_name, coefficient in result['coefficients']])
+    return baseline_id
+
+
+def fit_baselines(conn, specs, save=True):
+    """
+    依序擬合多個基線設定 (共用同一連線)，全部成功時在單一交易中寫入。
+    回傳 [{'name', 'id', 'intercept', 'coefficients', 'r2', 'points'}]；任一設定失敗時拋出 FitError。
+    """
+    results = []
+    for spec in specs:
+        if not isinstance(spec, dict):
+            raise FitError(f"擬合設定必須是 JSON 物件: {json.dumps(spec, ensure_ascii=False)[:100]}")
+        try:
+            target, factors = load_series(conn, spec)
+            result = fit(target, factors)
+        except FitError as e:
+            raise FitError(f"{spec.get('name', '(未命名)')}: {e}") from e
+        results.append((spec, result))
+    summary = []
+    try:
+        for spec, result in results:
+            baseline_id = save_baseline(conn, spec, result) if save else None
+            summary.append({
+                'name': spec.get('name'), 'id': baseline_id,
+                'intercept': result['intercept'], 'r2': result['r2'], 'points': result['points'],
+                'coefficients': [{'name': name, 'coeff': coefficient} for name, coefficient in result['coefficients']],
+            })
+        if save:
+            conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="由已收集的資料自動擬合迴歸基線")
+    parser.add_argument("spec_file", help="擬合設定 JSON 檔 (單一設定或設定陣列)")
+    parser.add_argument("--dry-run", action="store_true", help="只顯示擬合結果，不寫入資料庫")
+    args = parser.parse_args()
+    with open(args.spec_file, encoding='utf-8') as f:
+        specs = json.load(f)
+    if isinstance(specs, dict):
+        specs = [specs]
+    conn = db.connect()
+    try:
+        for item in fit_baselines(conn, specs, save=not args.dry_run):
+            r2 = f"{item['r2']:.4f}" if item['r2'] is not None else "-"
+            factors = ", ".join(f"{c['name']}={c['coeff']:.6g}" for c in item['coefficients'])
+            print(f"{item['name']}: 截距={item['intercept']:.6g}, {factors}, R²={r2}, {item['points']} 個時段" + (f" (ID {item['id']})" if item['id'] else ""))
+    except FitError as e:
+        raise SystemExit(f"擬合失敗: {e}")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,2 @@
+# ems_project/benchmarks/__init__.py
+# 效能基準測試：合成工廠資料庫 (synthetic_plant)、熱路徑計時 (run) 與收集程式負載測試 (collector_load)，用法見各模組
@@ -0,0 +1,186 @@
+# ems_project/benchmarks/collector_load.py
+# 收集程式負載測試：複製資料庫、將 url_list 改寫為本機電表模擬器的位址，
+# 以固定週期執行 run_templates (與背景收集服務相同的批次抓取 + 依序寫入)，
+# 回報每秒取樣數、週期耗時 (p50/p95/最大) 與漏失的取樣 (執行失敗或週期超時而跳過的時段)。
+# 原始資料庫不會被修改。
+#
+# 用法 (於專案根目錄執行):
+#   python -m benchmarks.collector_load --duration 60 --interval 5
+#   python -m benchmarks.collector_load --db /tmp/bench.db --latency 300 --jitter 200 --error-rate 0.02 --hang-rate 0.005 \
+#       --timeout 3 --per-host 32 --max-workers 64 --output load.json
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def copy_database(source, target):
+    """以 SQLite backup 複製 (包含尚未 checkpoint 的 WAL 內容)，來源以唯讀方式開啟"""
+    src = sqlite3.connect(f"file:{os.path.abspath(source)}?mode=ro", uri=True)
+    dst = sqlite3.connect(target)
+    try:
+        src.backup(dst)
+    finally:
+        dst.close()
+        src.close()
+
+
+def _failure_reason(message):
+    lower = message.lower()
+    if 'timed out' in lower or 'timeout' in lower:
+        return 'timeout'
+    if '500' in message or 'server error' in lower:
+        return 'http_error'
+    if 'connection' in lower:
+        return 'connection'
+    return 'other'
+
+
+def run_load(template_ids, interval, duration=None, cycles=None, log=print):
+    """
+    每 interval 秒執行一次所有範本，直到超過 duration 秒或執行 cycles 次。
+    前一週期超時時跳過錯過的時段 (與背景收集服務相同)，跳過的時段計入漏失的取樣。
+    """
+    from collector_core import run_templates
+    from benchmarks.run import percentile
+
+    durations, ok_count, failures, reasons, skipped_slots = [], 0, [], {}, 0
+    started = time.monotonic()
+    next_at = started
+    while (cycles is None or len(durations) < cycles) and (duration is None or next_at - started < duration):
+        now = time.monotonic()
+        if next_at > now:
+            time.sleep(next_at - now)
+        cycle_start = time.monotonic()
+        results = run_templates(template_ids)
+        cycle_end = time.monotonic()
+        durations.append(cycle_end - cycle_start)
+        for template_id, ok, msg in results:
+            if ok:
+                ok_count += 1
+            else:
+                reason = _failure_reason(msg)
+                reasons[reason] = reasons.get(reason, 0) + 1
+                if len(failures) < 20:
+                    failures.append({'template_id': template_id, 'reason': reason, 'message': msg[:300]})
+        next_at += interval
+        if next_at <= cycle_end:
+            missed = int((cycle_end - next_at) // interval) + 1
+            skipped_slots += missed
+            next_at += missed * interval
+        log(f"週期 {len(durations)}: {durations[-1] * 1000:.0f} ms，成功 {sum(1 for r in results if r[1])}/{len(results)}")
+    elapsed = time.monotonic() - started
+    failed = sum(reasons.values())
+    expected = (len(durations) + skipped_slots) * len(template_ids)
+    return {
+        'cycles': len(durations), 'templates': len(template_ids), 'interval_seconds': interval, 'elapsed_seconds': round(elapsed, 3),
+        'samples_ok': ok_count, 'samples_failed': failed, 'skipped_slots': skipped_slots,
+        'samples_expected': expected, 'samples_missed': failed + skipped_slots * len(template_ids),
+        'samples_per_second': round(ok_count / elapsed, 2) if elapsed else None,
+        'cycle_ms': {
+            'p50': round(percentile(durations, 0.5) * 1000, 1), 'p95': round(percentile(durations, 0.95) * 1000, 1),
+            'max': round(max(durations) * 1000, 1), 'mean': round(sum(durations) / len(durations) * 1000, 1),
+        } if durations else None,
+        'failure_reasons': reasons, 'failure_samples': failures,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="以本機電表模擬器測試收集程式的吞吐量與逾時行為")
+    parser.add_argument("--db", default=os.path.join(BASE_DIR, "url_manager.db"), help="來源資料庫 (會先複製，不會修改)")
+    parser.add_argument("--templates", nargs="*", type=int, help="只執行指定 ID 的範本 (預設全部)")
+    parser.add_argument("--interval", type=float, default=5, help="週期秒數 (所有範本每週期執行一次)")
+    parser.add_argument("--duration", type=float, default=30, help="測試秒數")
+    parser.add_argument("--cycles", type=int, help="執行指定週期數後結束 (優先於 --duration)")
+    parser.add_argument("--latency", type=float, default=20, help="模擬器回應延遲毫秒數")
+    parser.add_argument("--jitter", type=float, default=10, help="延遲的隨機變動範圍 (±毫秒)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="回傳 HTTP 500 的機率")
+    parser.add_argument("--hang-rate", type=float, default=0.0, help="連線掛住不回應的機率")
+    parser.add_argument("--toggle-seconds", type=float, default=60, help="設備狀態平均切換間隔秒數")
+    parser.add_argument("--timeout", type=float, help="一般範本 URL 逾時秒數 (預設使用 fetch_engine 設定)")
+    parser.add_argument("--monitor-timeout", type=float, help="設備狀態監控 URL 逾時秒數")
+    parser.add_argument("--max-workers", type=int, help="同時抓取的請求上限")
+    parser.add_argument("--per-host", type=int, help="單一主機同時連線上限 (模擬器所有 URL 都在同一主機)")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="將結果寫入 JSON 檔")
+    parser.add_argument("--keep-db", action="store_true", help="保留測試用的資料庫副本")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="ems_load_")
+    path = os.path.join(workdir, "load.db")
+    copy_database(args.db, path)
+    os.environ['EMS_DB_PATH'] = path  # 必須在匯入專案模組之前設定
+    sys.path.insert(0, BASE_DIR)
+
+    import collector_core
+    import db
+    import fetch_engine
+    import meter_simulator
+    from benchmarks.run import git_commit
+
+    # 抓取設定必須在第一次抓取 (建立執行緒池與連線池) 之前修改；逾時秒數在編譯範本執行計畫時讀取
+    if args.max_workers:
+        fetch_engine.MAX_WORKERS = args.max_workers
+    if args.per_host:
+        fetch_engine.PER_HOST_LIMIT = args.per_host
+    if args.timeout:
+        collector_core.STANDARD_TIMEOUT = args.timeout
+    if args.monitor_timeout:
+        collector_core.MONITOR_TIMEOUT = args.monitor_timeout
+
+    faults = meter_simulator.FaultConfig(args.latency, args.jitter, args.error_rate, args.hang_rate, hang_seconds=600)
+    simulator = meter_simulator.MeterSimulator(faults=faults, seed=args.seed)
+    try:
+        collector_core.init_db()
+        conn = db.connect()
+        try:
+            rewritten = meter_simulator.rewrite_urls(conn, simulator.base_url)
+            simulator.meters = meter_simulator.load_meters(conn, simulator.base_url, args.seed, args.toggle_seconds)
+        finally:
+            conn.close()
+        simulator.start()
+        templates = [t['id'] for t in collector_core.get_templates()]
+        if args.templates:
+            templates = [tid for tid in templates if tid in args.templates]
+        print(f"模擬器 {simulator.base_url}：{len(simulator.meters)} 個 URL (改寫 {rewritten} 筆)，{len(templates)} 個範本，週期 {args.interval} 秒")
+        result = run_load(templates, args.interval, None if args.cycles else args.duration, args.cycles)
+    finally:
+        simulator.stop()
+        fetch_engine.shutdown()
+        db.close_all()
+
+    report = {
+        'commit': git_commit(), 'timestamp': datetime.datetime.now().isoformat(timespec='seconds'), 'python': platform.python_version(),
+        'config': {
+            'source_db': os.path.abspath(args.db), 'latency_ms': args.latency, 'jitter_ms': args.jitter, 'error_rate': args.error_rate,
+            'hang_rate': args.hang_rate, 'standard_timeout': collector_core.STANDARD_TIMEOUT, 'monitor_timeout': collector_core.MONITOR_TIMEOUT,
+            'max_workers': fetch_engine.MAX_WORKERS, 'per_host_limit': fetch_engine.PER_HOST_LIMIT,
+        },
+        'simulator': simulator.stats(),
+        'result': result,
+    }
+    r = result
+    print(f"\n{r['cycles']} 個週期，每秒 {r['samples_per_second']} 筆取樣，週期耗時 p50 {r['cycle_ms']['p50']} ms / p95 {r['cycle_ms']['p95']} ms / 最大 {r['cycle_ms']['max']} ms")
+    print(f"成功 {r['samples_ok']} / 預期 {r['samples_expected']}，漏失 {r['samples_missed']} (失敗 {r['samples_failed']}，跳過時段 {r['skipped_slots']})，失敗原因 {r['failure_reasons']}")
+    print(f"模擬器統計 {report['simulator']}")
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"結果已寫入 {args.output}")
+    if args.keep_db:
+        print(f"測試資料庫: {path}")
+    else:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
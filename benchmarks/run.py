@@ -0,0 +1,223 @@
+# ems_project/benchmarks/run.py
+# 效能基準測試：在合成資料庫上計時各熱路徑，輸出 p50/p95 延遲與記憶體峰值 (JSON)，可跨 commit 比較。
+# 每個項目先暖機，再計時 --repeat 次；記憶體峰值以 tracemalloc 另外執行一次量測 (不影響計時，只含 Python 配置的記憶體)。
+# standard_logic 會實際寫入樣本，合成資料庫每次執行後會多出少量資料。
+#
+# 用法 (於專案根目錄執行):
+#   python -m benchmarks.run                                   # 1 年 x 10 具電表 x 12 張圖表，資料庫建在暫存目錄
+#   python -m benchmarks.run --years 10 --meters 100 --db /data/bench_10x.db   # 建立一次後重複使用
+#   python -m benchmarks.run --only dashboard enpi --output after.json --compare before.json
+#   python -m benchmarks.run --generate-only --db bench.db     # 只建立資料庫
+
+import argparse
+import datetime
+import gc
+import json
+import os
+import platform
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(fraction * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def measure(func, repeat, warmup):
+    """回傳 {'n', 'p50_ms', 'p95_ms', 'mean_ms', 'min_ms', 'max_ms', 'peak_kb'}"""
+    for i in range(warmup):
+        func(i)
+    samples = []
+    gc.collect()
+    for i in range(repeat):
+        started = time.perf_counter()
+        func(warmup + i)
+        samples.append((time.perf_counter() - started) * 1000)
+    gc.collect()
+    tracemalloc.start()
+    try:
+        func(warmup + repeat)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return {
+        'n': repeat, 'p50_ms': round(percentile(samples, 0.5), 3), 'p95_ms': round(percentile(samples, 0.95), 3),
+        'mean_ms': round(statistics.fmean(samples), 3), 'min_ms': round(min(samples), 3), 'max_ms': round(max(samples), 3),
+        'peak_kb': round(peak / 1024, 1),
+    }
+
+
+def build_cases():
+    """回傳 {名稱: (說明, func(i))}；func 的參數為呼叫序號，用來輪替電表/EnPI/基線"""
+    import analysis_query
+    import app as flask_app
+    import collector_core
+    import dashboard_query
+    import db
+
+    client = flask_app.app.test_client()
+    conn = db.connect()
+    try:
+        enpi_ids = [row[0] for row in conn.execute("SELECT id FROM EnPI_Definitions ORDER BY id")]
+        baseline_ids = [row[0] for row in conn.execute("SELECT id FROM RegressionBaselines ORDER BY id")]
+        templates = [(row[0], row[1]) for row in conn.execute("SELECT id, template_name FROM data_templates ORDER BY id")]
+    finally:
+        conn.close()
+    meters = [name for _, name in templates if name.startswith('bench_meter_')]
+    now = datetime.datetime.now()
+
+    def get_json(url):
+        response = client.get(url)
+        if response.status_code != 200:
+            raise RuntimeError(f"{url}: HTTP {response.status_code} {response.get_data(as_text=True)[:200]}")
+        return response
+
+    def dashboard_cold(i):
+        dashboard_query.invalidate_chart_configs()
+        get_json('/api/realtime_dashboard')
+
+    plans = collector_core.get_template_plans([tid for tid, name in templates if name in meters])
+    prefetched = {url: (True, f"{123.4 + i:.1f}") for i, plan in enumerate(plans.values()) for url in plan.url_jobs}
+    plan_list = list(plans.values())
+
+    def standard_logic(i):
+        ok, msg = collector_core._run_plan(plan_list[i % len(plan_list)], prefetched)
+        if not ok:
+            raise RuntimeError(msg)
+
+    fields = [('耗電度數', 'SUM'), ('電流', 'AVG')]
+
+    def analysis(grouping, date_range):
+        def run(i):
+            conn = db.connect()
+            try:
+                analysis_query.run_analysis(conn, meters[i % len(meters)], '時間', grouping, *date_range, fields)
+            finally:
+                conn.close()
+        return run
+
+    year_start = datetime.datetime(now.year, 1, 1)
+    return {
+        'dashboard': ("GET /api/realtime_dashboard (結果快取有效)", lambda i: get_json('/api/realtime_dashboard')),
+        'dashboard_cold': ("GET /api/realtime_dashboard (每次清除圖表設定與結果快取)", dashboard_cold),
+        'enpi': ("GET /api/enpi/data/<id>/<今年>", lambda i: get_json(f'/api/enpi/data/{enpi_ids[i % len(enpi_ids)]}/{now.year}')),
+        'baseline_details': ("GET /api/regression_baselines/<id> (get_regression_baseline_details)",
+                             lambda i: get_json(f'/api/regression_baselines/{baseline_ids[i % len(baseline_ids)]}')),
+        'standard_logic': ("run_standard_logic 寫入一筆樣本 (URL 值預先提供，不含網路)", standard_logic),
+        'analysis_hour': ("圖表分析 小時群組 (前一日)", analysis('hour', analysis_query.day_range((now - datetime.timedelta(days=1)).date()))),
+        'analysis_day': ("圖表分析 日群組 (本月)", analysis('day', analysis_query.month_range(now.year, now.month))),
+        'analysis_month': ("圖表分析 月群組 (今年)", analysis('month', analysis_query.year_range(now.year))),
+        'chart_data_year': ("GET /api/chart_data 一年範圍 (1000 點)",
+                            lambda i: get_json(f'/api/chart_data?table={meters[i % len(meters)]}&time_column=時間&columns=電流&from={year_start:%Y-%m-%d}&to={now:%Y-%m-%d %H:%M:%S}')),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=BASE_DIR, capture_output=True, text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def _database_shape(path):
+    conn = sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+    try:
+        meters = [row[0] for row in conn.execute("SELECT template_name FROM data_templates WHERE template_name LIKE 'bench_meter_%'")]
+        rows = sum(conn.execute(f'SELECT COUNT(*) FROM "{name}"').fetchone()[0] for name in meters)
+        charts = conn.execute("SELECT COUNT(*) FROM DashboardCharts").fetchone()[0]
+    finally:
+        conn.close()
+    return {'meters': len(meters), 'charts': charts, 'raw_rows': rows, 'db_bytes': os.path.getsize(path)}
+
+
+def compare(current, baseline_path):
+    """列出與前一次結果的 p50/p95 比值 (>1 代表變慢)"""
+    with open(baseline_path, encoding='utf-8') as f:
+        baseline = json.load(f)
+    print(f"\n與 {baseline_path} (commit {baseline.get('commit')}) 比較:")
+    print(f"{'項目':<20}{'p50 比值':>10}{'p95 比值':>10}{'記憶體比值':>12}")
+    for name, result in current['results'].items():
+        old = baseline.get('results', {}).get(name)
+        if not old:
+            continue
+        ratio = lambda key: result[key] / old[key] if old[key] else float('nan')
+        print(f"{name:<20}{ratio('p50_ms'):>10.2f}{ratio('p95_ms'):>10.2f}{ratio('peak_kb'):>12.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="EMS 效能基準測試")
+    parser.add_argument("--db", help="合成資料庫路徑 (已存在時直接使用；預設建在暫存目錄)")
+    parser.add_argument("--rebuild", action="store_true", help="刪除並重新建立 --db 指定的資料庫")
+    parser.add_argument("--schema-from", default=os.path.join(BASE_DIR, "url_manager.db"), help="複製設定表結構的來源資料庫")
+    parser.add_argument("--years", type=float, default=1)
+    parser.add_argument("--meters", type=int, default=10)
+    parser.add_argument("--charts", type=int, default=12)
+    parser.add_argument("--interval", type=int, default=300, help="合成資料的取樣間隔秒數")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=50)
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--only", nargs="*", help="只執行指定項目 (名稱前綴)")
+    parser.add_argument("--output", default="bench_results.json")
+    parser.add_argument("--compare", help="與先前的結果檔比較")
+    parser.add_argument("--generate-only", action="store_true")
+    args = parser.parse_args()
+
+    path = os.path.abspath(args.db or os.path.join(tempfile.mkdtemp(prefix="ems_bench_"), "bench.db"))
+    if args.rebuild:
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(path + suffix):
+                os.remove(path + suffix)
+    os.environ['EMS_DB_PATH'] = path  # 必須在匯入專案模組之前設定
+    sys.path.insert(0, BASE_DIR)
+
+    generated = None
+    if not os.path.exists(path):
+        from benchmarks import synthetic_plant
+        print(f"建立合成資料庫 {path} ({args.years} 年 x {args.meters} 具電表 x {args.charts} 張圖表)...")
+        started = time.perf_counter()
+        generated = synthetic_plant.build(args.schema_from, args.years, args.meters, args.charts, args.interval, args.seed)
+        print(f"完成，耗時 {time.perf_counter() - started:.1f} 秒")
+    if args.generate_only:
+        return
+
+    shape = _database_shape(path)
+    cases = build_cases()
+    selected = [name for name in cases if not args.only or any(name.startswith(prefix) for prefix in args.only)]
+    results = {}
+    for name in selected:
+        description, func = cases[name]
+        results[name] = dict(measure(func, args.repeat, args.warmup), description=description)
+        r = results[name]
+        print(f"{name:<20} p50 {r['p50_ms']:>9.2f} ms  p95 {r['p95_ms']:>9.2f} ms  峰值 {r['peak_kb']:>9.1f} KB")
+
+    report = {
+        'commit': git_commit(), 'timestamp': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(), 'sqlite': sqlite3.sqlite_version, 'platform': platform.platform(),
+        'database': dict(shape, path=path, generated=generated),
+        'repeat': args.repeat, 'warmup': args.warmup,
+        'max_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss if resource else None,
+        'results': results,
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"結果已寫入 {args.output}")
+    if args.compare:
+        compare(report, args.compare)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+# ems_project/benchmarks/synthetic_plant.py
+# 合成工廠資料庫：依指定的年數、電表數與圖表數建立與 url_manager.db 相同結構的資料庫，
+# 範本、圖表、EnPI 與迴歸基線的設定方式與現場相同 (空壓機範本: 時間 / 電表值 / 電流 / 風壓 / 耗電度數)。
+# 設定表的結構由現有資料庫複製 (只複製結構不複製資料)，其餘由 collector_core.init_db() 建立。
+#
+# 匯入前必須先設定 EMS_DB_PATH 指向要建立的資料庫 (run.py 會處理)。
+
+import datetime
+import json
+import math
+import random
+import sqlite3
+
+import db
+import collector_core
+import rollup
+
+METER_COLUMNS = [
+    {"name": "時間", "type": "動態公式", "value": "now"},
+    {"name": "電表值", "type": "URL", "value": None},
+    {"name": "電流", "type": "URL", "value": None},
+    {"name": "風壓", "type": "URL", "value": None},
+    {"name": "耗電度數", "type": "動態公式", "value": "db_eval:get_diff('電表值',1)"},
+]
+URL_KINDS = (("電表值", "kwh"), ("電流", "current"), ("風壓", "pressure"))
+INSERT_BATCH_SIZE = 20000
+DEFAULT_URL_BASE = "http://127.0.0.1:8900"
+
+
+def meter_name(index):
+    return f"bench_meter_{index:03d}"
+
+
+def copy_schema(conn, source_path):
+    """複製現有資料庫中非範本資料表的結構 (含索引)；觸發器與範本資料表由 init_db / save_template 建立"""
+    source = sqlite3.connect(f"file:{source_path}?mode=ro&immutable=1", uri=True)
+    try:
+        template_tables = {row[0] for row in source.execute("SELECT template_name FROM data_templates")}
+        rows = source.execute("SELECT type, name, tbl_name, sql FROM sqlite_master WHERE sql IS NOT NULL AND type IN ('table', 'index') ORDER BY type DESC, rowid").fetchall()
+    finally:
+        source.close()
+    for kind, name, table, sql in rows:
+        if table.startswith('sqlite_') or table in template_tables:
+            continue
+        conn.execute(sql)
+    conn.commit()
+
+
+def _load_profile(rng, minute_of_day, weekday):
+    """日間與平日負載較高的用電曲線 (0.2 ~ 1.0)"""
+    day_shape = 0.5 - 0.4 * math.cos(2 * math.pi * minute_of_day / 1440)
+    return max(0.2, min(1.0, day_shape * (1.0 if weekday < 5 else 0.6) + rng.uniform(-0.05, 0.05)))
+
+
+def meter_rows(rng, start, end, interval_seconds, rated_kw):
+    """產生 (時間, 電表值, 電流, 風壓, 耗電度數)；電表值為累計 kWh，耗電度數為與前一筆的差值"""
+    counter = rng.uniform(1000, 50000)
+    previous = None
+    step = datetime.timedelta(seconds=interval_seconds)
+    t = start
+    while t < end:
+        load = rated_kw * _load_profile(rng, t.hour * 60 + t.minute, t.weekday())
+        counter += load * interval_seconds / 3600
+        reading = round(counter, 2)
+        yield (t.strftime('%Y-%m-%d %H:%M:%S'), reading, round(load * 1.6, 2), round(rng.uniform(6.2, 7.0), 2),
+               round(reading - previous, 2) if previous is not None else None)
+        previous = reading
+        t += step
+
+
+def build(source_path, years=1, meters=10, charts=12, interval_seconds=300, seed=1, url_base=DEFAULT_URL_BASE, log=print):
+    """
+    建立合成資料庫 (EMS_DB_PATH 必須指向空檔案或不存在的檔案)，回傳資料規模摘要。
+    資料結束於目前時間，儀表板的「今日 / 本月 / 今年」都有資料。
+    """
+    rng = random.Random(seed)
+    conn = db.connect()
+    try:
+        copy_schema(conn, source_path)
+    finally:
+        conn.close()
+    collector_core.init_db()
+
+    end = datetime.datetime.now().replace(second=0, microsecond=0)
+    start = end - datetime.timedelta(days=round(365 * years))
+    total_rows = 0
+    for i in range(1, meters + 1):
+        name = meter_name(i)
+        url_ids = {}
+        conn = db.connect()
+        try:
+            for column, kind in URL_KINDS:
+                url_ids[column] = conn.execute("INSERT INTO url_list (url, description) VALUES (?, ?)", (f"{url_base}/meters/{i}/{kind}", f"{name} {column}")).lastrowid
+            conn.commit()
+        finally:
+            conn.close()
+        columns = [dict(col, value=str(url_ids[col['name']])) if col['name'] in url_ids else dict(col) for col in METER_COLUMNS]
+        ok, msg = collector_core.save_template(None, name, f"合成電表 {i}", columns, "", interval_seconds)
+        if not ok:
+            raise RuntimeError(msg)
+        conn = db.connect()
+        try:
+            rows = meter_rows(rng, start, end, interval_seconds, rng.uniform(20, 120))
+            while True:
+                batch = [row for _, row in zip(range(INSERT_BATCH_SIZE), rows)]
+                if not batch:
+                    break
+                conn.executemany(f'INSERT INTO "{name}" (時間, 電表值, 電流, 風壓, 耗電度數) VALUES (?, ?, ?, ?, ?)', batch)
+                total_rows += len(batch)
+            conn.commit()
+        finally:
+            conn.close()
+        log(f"  {name}: 已產生資料 ({total_rows} 筆累計)")
+
+    conn = db.connect()
+    try:
+        rollup.ensure_rollups(conn, force=True)
+        _add_charts(conn, meters, charts)
+        baseline_ids = _add_baselines(conn, rng, start.year, end.year)
+        _add_enpis(conn, rng, meters, start.year, end.year, baseline_ids)
+        conn.commit()
+    finally:
+        conn.close()
+    return {'years': years, 'meters': meters, 'charts': charts, 'interval_seconds': interval_seconds, 'raw_rows': total_rows,
+            'from': start.strftime('%Y-%m-%d %H:%M:%S'), 'to': end.strftime('%Y-%m-%d %H:%M:%S')}
+
+
+def _add_charts(conn, meters, charts):
+    """每張圖表: 耗電度數 (累加，長條) + 電流 (平均，折線)，時間群組依序為 hour / day / month"""
+    groupings = ('hour', 'day', 'month')
+    for i in range(charts):
+        table = meter_name(i % meters + 1)
+        chart_id = conn.execute(
+            "INSERT INTO DashboardCharts (chart_title, source_table_name, time_column, time_grouping, display_order) VALUES (?, ?, ?, ?, ?)",
+            (f"{table} ({groupings[i % 3]})", table, '時間', groupings[i % 3], str(i))).lastrowid
+        conn.executemany(
+            "INSERT INTO DashboardSeries (chart_id, source_column_name, series_label, chart_type, y_axis_id, aggregation_method) VALUES (?, ?, ?, ?, ?, ?)",
+            [(str(chart_id), '耗電度數', '耗電', 'bar', 'y', 'sum'), (str(chart_id), '電流', '電流', 'line', 'y1', 'avg')])
+
+
+def _add_baselines(conn, rng, first_year, last_year):
+    """每年一條全廠用電基線，含兩個因子與 12 個月的監測數據"""
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(MonitoredData)")}
+    baseline_ids = []
+    for year in range(first_year, last_year + 1):
+        baseline_id = conn.execute(
+            "INSERT INTO RegressionBaselines (name, year, formula_intercept, formula_r2, notes) VALUES (?, ?, ?, ?, ?)",
+            (f"{year}年全廠用電基線", year, rng.uniform(5000, 8000), rng.uniform(0.8, 0.95), '合成資料')).lastrowid
+        conn.executemany("INSERT INTO RegressionFactors (baseline_id, factor_name, coefficient) VALUES (?, ?, ?)",
+                         [(baseline_id, '工時', rng.uniform(0.5, 1.0)), (baseline_id, '外氣均溫', rng.uniform(3000, 4500))])
+        for month in range(1, 13):
+            factors = json.dumps({'工時': rng.randint(35000, 48000), '外氣均溫': round(rng.uniform(14, 31), 1)}, ensure_ascii=False)
+            values = {'baseline_id': baseline_id, 'month': month, 'factors_json': factors, 'actual_consumption': round(rng.uniform(90000, 160000), 1)}
+            if 'year' in columns:
+                values['year'] = year
+            conn.execute(f"INSERT INTO MonitoredData ({', '.join(values)}) VALUES ({', '.join('?' * len(values))})", list(values.values()))
+        baseline_ids.append(baseline_id)
+    return baseline_ids
+
+
+def _add_enpis(conn, rng, meters, first_year, last_year, baseline_ids):
+    """每具電表一個 EnPI：分子為電表耗電度數 (自動)，分母為人工填入的產量；另加一個以基線為分子的 EnPI"""
+    definitions = []
+    for i in range(1, meters + 1):
+        definitions.append({
+            'name': f"{meter_name(i)} 度/產量", 'unit': 'kWh/件', 'higher_is_better': 0,
+            'numerator_source_type': 'auto', 'numerator_source_table': meter_name(i), 'numerator_source_column': '耗電度數',
+            'numerator_time_column': '時間', 'numerator_aggregation': 'SUM',
+            'denominator_source_type': 'manual', 'denominator_manual_name': '產量',
+        })
+    if baseline_ids:
+        definitions.append({
+            'name': '全廠用電 度/工時', 'unit': 'kWh/h', 'higher_is_better': 0,
+            'numerator_source_type': 'baseline', 'numerator_baseline_id': baseline_ids[-1], 'numerator_source_column': 'actual_consumption',
+            'denominator_source_type': 'baseline', 'denominator_baseline_id': baseline_ids[-1], 'denominator_source_column': '工時',
+        })
+    for definition in definitions:
+        enpi_id = conn.execute(f"INSERT INTO EnPI_Definitions ({', '.join(definition)}) VALUES ({', '.join('?' * len(definition))})",
+                               list(definition.values())).lastrowid
+        for year in range(first_year, last_year + 1):
+            conn.executemany("INSERT INTO EnPI_Targets (enpi_id, year, month, target_value) VALUES (?, ?, ?, ?)",
+                             [(enpi_id, year, month, round(rng.uniform(0.5, 2.0), 3)) for month in range(1, 13)])
+            if definition['denominator_source_type'] == 'manual':
+                conn.executemany("INSERT INTO EnPI_Manual_Data (enpi_id, year, month, variable_name, value) VALUES (?, ?, ?, ?, ?)",
+                                 [(enpi_id, year, month, '產量', rng.randint(8000, 20000)) for month in range(1, 13)])
@@ -0,0 +1,249 @@
+# ems_project/chart_series.py
+# 任意時間範圍的圖表資料：依範圍長度自動選擇資料來源 (原始資料或每小時/每日/每月彙總)，
+# 回傳的點數不超過指定上限；點數仍太多時以 LTTB (保留曲線形狀) 或 min/max 包絡線抽樣。
+#
+# 選擇順序 (讀取上限為 點數上限 x FETCH_FACTOR 列):
+#   1. 原始資料：以時間索引估計範圍內的筆數 (加上重疊的封存分區筆數)，不超過讀取上限時直接讀取原始值；
+#   2. 彙總資料：選擇 bucket 數不超過讀取上限的最細層級 (hour → day → month)；
+#      彙總資料只能以整個 bucket 讀取，查詢範圍會向外對齊到 bucket 邊界 (回傳的 from/to 為對齊後的範圍)；
+#   3. 沒有彙總資料時，在 SQL 中依固定秒數分組 (每組一個聚合值，或 minmax 時的最小/最大值；只讀取主資料表)。
+
+import math
+from datetime import datetime, timedelta
+
+import numpy as np
+
+import retention
+import rollup
+import schema_cache
+
+DEFAULT_POINTS = 1000
+MAX_POINTS = 5000
+FETCH_FACTOR = 10
+AGGREGATES = ('SUM', 'AVG', 'MIN', 'MAX')
+METHODS = ('lttb', 'minmax')
+TIER_SECONDS = {'hour': 3600, 'day': 86400, 'month': 2629746}
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+BUCKET_SUFFIX = {13: ':00:00', 10: ' 00:00:00', 7: '-01 00:00:00'}
+
+
+class ChartDataError(ValueError):
+    """查詢參數錯誤 (API 回傳 400)"""
+
+
+def parse_time(value, name):
+    """接受 'YYYY-MM-DD'、'YYYY-MM-DD HH:MM[:SS]' 或 ISO 格式 ('T' 分隔)"""
+    try:
+        return datetime.fromisoformat(str(value).strip())
+    except (TypeError, ValueError):
+        raise ChartDataError(f"{name} 時間格式錯誤: {value}")
+
+
+def parse_series(spec, default_agg='AVG'):
+    """'a,b' 或 'a:SUM,b:MAX' 轉為 [(欄位, 聚合方式, 標籤)]，標籤即欄位名稱"""
+    series = []
+    for part in (spec or '').split(','):
+        column, _, func = part.strip().partition(':')
+        if column:
+            series.append((column.strip(), (func.strip() or default_agg).upper(), column.strip()))
+    return series
+
+
+def _bucket_time(bucket):
+    """彙總 bucket ('YYYY-MM-DD HH' / 'YYYY-MM-DD' / 'YYYY-MM') 轉為該時段起點的時間字串"""
+    return bucket + BUCKET_SUFFIX.get(len(bucket), '')
+
+
+def _bucket_floor(dt, tier):
+    """dt 所在 bucket 的起點"""
+    dt = dt.replace(minute=0, second=0, microsecond=0)
+    if tier == 'hour':
+        return dt
+    dt = dt.replace(hour=0)
+    return dt if tier == 'day' else dt.replace(day=1)
+
+
+def _next_bucket(dt, tier):
+    if tier == 'hour':
+        return dt + timedelta(hours=1)
+    if tier == 'day':
+        return dt + timedelta(days=1)
+    return dt.replace(year=dt.year + dt.month // 12, month=dt.month % 12 + 1)
+
+
+def _align_range(start_dt, end_dt, tier):
+    """將 [start_dt, end_dt) 向外對齊到彙總層級的 bucket 邊界 (包含頭尾不完整的 bucket)"""
+    start, end = _bucket_floor(start_dt, tier), _bucket_floor(end_dt, tier)
+    return start, end if end == end_dt else _next_bucket(end, tier)
+
+
+def _epoch_seconds(times):
+    """時間字串轉為秒數 (LTTB 的 X 座標)；無法解析時改用序號"""
+    try:
+        return np.array(times, dtype='datetime64[s]').astype(np.int64).astype(float)
+    except ValueError:
+        return np.arange(len(times), dtype=float)
+
+
+def lttb(x, y, threshold):
+    """Largest-Triangle-Three-Buckets：回傳保留曲線形狀的 threshold 個點的索引"""
+    n = len(y)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+    every = (n - 2) / (threshold - 2)
+    indices = np.empty(threshold, dtype=np.int64)
+    indices[0], indices[-1] = 0, n - 1
+    a = 0
+    for i in range(threshold - 2):
+        start, end = int(i * every) + 1, int((i + 1) * every) + 1
+        next_end = min(int((i + 2) * every) + 1, n)
+        avg_x, avg_y = x[end:next_end].mean(), y[end:next_end].mean()
+        area = np.abs((x[a] - avg_x) * (y[start:end] - y[a]) - (x[a] - x[start:end]) * (avg_y - y[a]))
+        a = start + int(area.argmax())
+        indices[i + 1] = a
+    return indices
+
+
+def minmax(x, y, threshold):
+    """將資料等分為 threshold/2 組，每組保留最小值與最大值 (依原順序)"""
+    n = len(y)
+    if threshold >= n:
+        return np.arange(n)
+    edges = np.linspace(0, n, max(1, threshold // 2) + 1).astype(np.int64)
+    picked = set()
+    for start, end in zip(edges[:-1], edges[1:]):
+        if end > start:
+            segment = y[start:end]
+            picked.add(start + int(segment.argmin()))
+            picked.add(start + int(segment.argmax()))
+    return np.array(sorted(picked), dtype=np.int64)
+
+
+def _estimate_raw_rows(conn, table, time_col, start, end):
+    """時間欄位有索引時以範圍首尾兩筆的 rowid 差估計筆數 (兩次索引查找)；無法估計時回傳 None"""
+    info = schema_cache.get_catalog(conn).tables.get(table)
+    if info is None or time_col not in info.indexed_columns():
+        return None
+    first = conn.execute(f'SELECT rowid FROM "{table}" WHERE "{time_col}" >= ? AND "{time_col}" < ? ORDER BY "{time_col}" LIMIT 1', (start, end)).fetchone()
+    if first is None:
+        return 0
+    last = conn.execute(f'SELECT rowid FROM "{table}" WHERE "{time_col}" >= ? AND "{time_col}" < ? ORDER BY "{time_col}" DESC LIMIT 1', (start, end)).fetchone()
+    estimate = last[0] - first[0] + 1
+    return estimate if estimate > 0 else None
+
+
+def _fetch_raw(conn, table, time_col, series, start, end, limit):
+    """讀取原始值 (包含時間範圍重疊的封存分區)；超過 limit 筆時回傳 None (改用彙總或分組)"""
+    columns = ', '.join(rollup.num_sql(column) for column, _, _ in series)
+    rows = retention.read_range(conn, table, time_col, f'"{time_col}", {columns}', start, end, limit + 1)
+    return None if len(rows) > limit else rows
+
+
+def _fetch_rollup(conn, table, tier, series, start, end, method):
+    """
+    讀取彙總資料 (start/end 須已對齊 bucket 邊界)，每個 bucket 以時段起點為時間；同一 (聚合, 欄位) 只查詢一次。
+    minmax 時讀取各 bucket 的最小值與最大值，每個 bucket 回傳兩列 (與 _fetch_buckets 相同)。
+    """
+    funcs = [('MIN', 'MAX') if method == 'minmax' else (func,) for _, func, _ in series]
+    aliases = {}
+    for (column, _, _), group in zip(series, funcs):
+        for func in group:
+            aliases.setdefault((func, column), f"v{len(aliases)}")
+    index = {key: i for i, key in enumerate(aliases, start=1)}
+    rows = []
+    for row in rollup.query_rollup(conn, table, tier, start, end, aliases):
+        for position in range(len(funcs[0])):
+            rows.append((_bucket_time(row[0]),) + tuple(row[index[(group[position], column)]] for (column, _, _), group in zip(series, funcs)))
+    return rows
+
+
+def _fetch_buckets(conn, table, time_col, series, start, end, step_seconds, method):
+    """沒有彙總資料時在 SQL 中依固定秒數分組；minmax 時每組回傳最小值與最大值兩個點"""
+    funcs = [('MIN', 'MAX') if method == 'minmax' else (func,) for _, func, _ in series]
+    select_parts = ', '.join(f'{f}({rollup.num_sql(column)})' for (column, _, _), group in zip(series, funcs) for f in group)
+    rows = conn.execute(f'''
+        SELECT MIN("{time_col}"), {select_parts} FROM "{table}"
+        WHERE "{time_col}" >= ? AND "{time_col}" < ?
+        GROUP BY CAST((julianday("{time_col}") - julianday(?)) * 86400 / ? AS INTEGER) ORDER BY 1
+    ''', (start, end, start, step_seconds)).fetchall()
+    if method != 'minmax':
+        return rows
+    # 每組展開為兩列：第一列放各序列的最小值、第二列放最大值 (X 座標相同)
+    expanded = []
+    for row in rows:
+        values = row[1:]
+        expanded.append((row[0],) + values[0::2])
+        expanded.append((row[0],) + values[1::2])
+    return expanded
+
+
+def query_chart_data(conn, table, time_col, series, start_dt, end_dt, max_points=DEFAULT_POINTS, method='lttb'):
+    """
+    series: [(欄位, 聚合方式, 標籤)]，聚合方式用於彙總/分組來源 (原始資料來源回傳原始值)。
+    時間範圍為 [start_dt, end_dt) 半開區間 (使用彙總資料時向外對齊到 bucket 邊界，回傳的 from/to 為實際範圍)；
+    回傳可直接序列化為 JSON 的 dict，每個序列的點為 [時間字串, 數值]。
+    """
+    catalog = schema_cache.get_catalog(conn)
+    info = catalog.tables.get(table)
+    if info is None:
+        raise ChartDataError(f"資料表不存在: {table}")
+    if not info.has_column(time_col):
+        raise ChartDataError(f"時間欄位不存在: {time_col}")
+    if not series:
+        raise ChartDataError("至少需要一個數據欄位")
+    for column, func, _ in series:
+        if not info.has_column(column):
+            raise ChartDataError(f"欄位不存在: {column}")
+        if func not in AGGREGATES:
+            raise ChartDataError(f"不支援的聚合方式: {func}")
+    if method not in METHODS:
+        raise ChartDataError(f"不支援的抽樣方式: {method}")
+    if end_dt <= start_dt:
+        raise ChartDataError("結束時間必須晚於開始時間")
+    max_points = max(10, min(int(max_points), MAX_POINTS))
+
+    rollup.register_functions(conn)
+    start, end = start_dt.strftime(TIME_FORMAT), end_dt.strftime(TIME_FORMAT)
+    span = (end_dt - start_dt).total_seconds()
+    fetch_limit = max_points * FETCH_FACTOR
+    rows, source, bucket_seconds = None, 'raw', None
+
+    estimate = _estimate_raw_rows(conn, table, time_col, start, end)
+    if estimate is not None:
+        estimate += sum(count for _, _, count in retention.archived_partitions(conn, table, start, end, time_col))
+    if estimate is None or estimate <= fetch_limit:
+        rows = _fetch_raw(conn, table, time_col, series, start, end, fetch_limit)
+    if rows is None and all(column != time_col for column, _, _ in series) and rollup.has_rollup(conn, table, time_col):
+        source = next((tier for tier in ('hour', 'day', 'month') if span / TIER_SECONDS[tier] <= fetch_limit), 'month')
+        bucket_seconds = TIER_SECONDS[source]
+        start_dt, end_dt = _align_range(start_dt, end_dt, source)
+        start, end = start_dt.strftime(TIME_FORMAT), end_dt.strftime(TIME_FORMAT)
+        rows = _fetch_rollup(conn, table, source, series, start, end, method)
+    if rows is None:
+        source = 'bucket'
+        bucket_seconds = math.ceil(span / (max_points // 2 if method == 'minmax' else max_points))
+        rows = _fetch_buckets(conn, table, time_col, series, start, end, bucket_seconds, method)
+
+    times = np.array([row[0] for row in rows], dtype=object)
+    x = _epoch_seconds(list(times))
+    decimate = lttb if method == 'lttb' else minmax
+    decimated = False
+    result_series = []
+    for i, (column, func, label) in enumerate(series):
+        y = np.array([row[i + 1] if row[i + 1] is not None else np.nan for row in rows], dtype=float)
+        mask = ~np.isnan(y)
+        xs, ys, ts = x[mask], y[mask], times[mask]
+        if len(ys) > max_points:
+            picked = decimate(xs, ys, max_points)
+            ts, ys = ts[picked], ys[picked]
+            decimated = True
+        result_series.append({
+            'label': label, 'column': column, 'aggregation': None if source == 'raw' else 'MIN/MAX' if method == 'minmax' else func,
+            'points': [[t, float(v)] for t, v in zip(ts.tolist(), ys.tolist())],
+        })
+    return {
+        'table': table, 'time_column': time_col, 'from': start, 'to': end,
+        'source': source, 'bucket_seconds': bucket_seconds, 'rows_read': len(rows),
+        'decimation': method if decimated else None, 'max_points': max_points,
+        'series': result_series,
+    }
@@ -0,0 +1,498 @@
+# ems_project/collector_core.py
+# 資料收集核心邏輯 (不依賴 tkinter / matplotlib)，供 GUI 與背景收集服務共用
+
+import sqlite3
+import requests
+import datetime
+import json
+import os
+import threading
+import db
+import formula_engine
+import alarm_engine
+import device_monitor
+from fetch_engine import fetch_url, fetch_all, STANDARD_TIMEOUT, MONITOR_TIMEOUT
+import rollup
+import retention
+import schema_cache
+
+# --- 全域設定 ---
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_SAMPLE_INTERVAL = 60  # 範本未設定取樣間隔時使用的秒數
+TABLE_PAGE_SIZE = 200  # 資料表檢視每次載入的筆數
+CONFIG_VERSION_TRIGGERS = (
+    ('trg_templates_insert_version', 'INSERT ON data_templates'),
+    ('trg_templates_update_version', 'UPDATE OF template_name, columns_config, unique_key_column ON data_templates'),
+    ('trg_templates_delete_version', 'DELETE ON data_templates'),
+    ('trg_urls_insert_version', 'INSERT ON url_list'),
+    ('trg_urls_update_version', 'UPDATE OF url ON url_list'),
+    ('trg_urls_delete_version', 'DELETE ON url_list'),
+)
+
+# --- 資料庫初始化與遷移 ---
+def init_db():
+    conn = db.connect()
+    c = conn.cursor()
+    
+    # 原有表格
+    c.execute('''CREATE TABLE IF NOT EXISTS url_list (id INTEGER PRIMARY KEY AUTOINCREMENT, url TEXT NOT NULL UNIQUE, description TEXT)''')
+    c.execute('''CREATE TABLE IF NOT EXISTS data_templates (id INTEGER PRIMARY KEY AUTOINCREMENT, template_name TEXT NOT NULL UNIQUE, description TEXT, columns_config TEXT NOT NULL, unique_key_column TEXT, last_run_time TEXT)''')
+    
+    # ISO 50001 相關表格
+    # 1. 儲存迴歸基線的主體資訊 (公式)
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS RegressionBaselines (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL UNIQUE,          -- 例如: 114年度 全廠用電基線
+            year INTEGER NOT NULL,              -- 基線對應的年度
+            formula_intercept REAL NOT NULL,    -- 公式的常數項 (截距)
+            formula_r2 REAL,                    -- R 平方值
+            notes TEXT,                         -- 備註事項
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+    # 2. 儲存迴歸公式的因子係數
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS RegressionFactors (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            baseline_id INTEGER NOT NULL,
+            factor_name TEXT NOT NULL,          -- 因子名稱 (例如: 工時, 外氣溫度)
+            coefficient REAL NOT NULL,          -- 係數
+            FOREIGN KEY (baseline_id) REFERENCES RegressionBaselines (id) ON DELETE CASCADE
+        )
+    ''')
+
+    # 3. 儲存每個月的實際監測數據 (人工輸入)
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS MonitoredData (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            baseline_id INTEGER NOT NULL,
+            month INTEGER NOT NULL,             -- 1 到 12
+            -- 使用 JSON 儲存所有因子數據, 例如: {"工時": 37808, "外氣溫度": 16}
+            factors_json TEXT NOT NULL,         
+            actual_consumption REAL,            -- 實際能源消耗量
+            UNIQUE (baseline_id, month),
+            FOREIGN KEY (baseline_id) REFERENCES RegressionBaselines (id) ON DELETE CASCADE
+        )
+    ''')
+
+    # 舊版資料庫遷移：每個範本各自的取樣間隔 (秒)
+    c.execute("PRAGMA table_info(data_templates)")
+    template_cols = [row[1] for row in c.fetchall()]
+    if 'sample_interval' not in template_cols:
+        c.execute("ALTER TABLE data_templates ADD COLUMN sample_interval REAL")
+    # 原始資料保留天數 (空值代表永久保留)，超過的月份由 retention.py 封存
+    if 'retention_days' not in template_cols:
+        c.execute("ALTER TABLE data_templates ADD COLUMN retention_days INTEGER")
+    # 資料版本：每次寫入資料時與寫入在同一交易中遞增，儀表板結果快取與 ETag 以此判斷資料是否改變 (last_run_time 只精確到秒)
+    if 'data_version' not in template_cols:
+        c.execute("ALTER TABLE data_templates ADD COLUMN data_version INTEGER NOT NULL DEFAULT 0")
+
+    # 範本與 URL 設定的版本號：由觸發器在設定變更時遞增，收集程式據此判斷執行計畫是否需要重新編譯
+    c.execute("CREATE TABLE IF NOT EXISTS Config_Version (name TEXT PRIMARY KEY, version INTEGER NOT NULL DEFAULT 0)")
+    c.execute("INSERT OR IGNORE INTO Config_Version (name, version) VALUES ('templates', 0)")
+    for trigger, event in CONFIG_VERSION_TRIGGERS: c.execute(f"CREATE TRIGGER IF NOT EXISTS {trigger} AFTER {event} BEGIN UPDATE Config_Version SET version = version + 1 WHERE name = 'templates'; END")
+
+    rollup.init_rollup_tables(c)
+    retention.init_partition_tables(c)
+    alarm_engine.init_alarm_tables(c)
+
+    conn.commit(); schema_cache.invalidate()
+    ensure_time_indexes(conn)
+    rollup.ensure_rollups(conn)
+    conn.close()
+
+# --- 時間欄位索引 ---
+def get_template_time_columns(columns_config):
+    """找出範本中記錄時間的欄位：動態公式 'now' 產生的欄位，監控範本則為 start_time"""
+    if any(col['type'] == '設備狀態監控' for col in columns_config): return ['start_time']
+    return [col['name'] for col in columns_config if col['type'] == '動態公式' and str(col['value']).strip().lower() == 'now']
+
+def ensure_time_index(c, table_name, time_column):
+    """在時間欄位 (或唯一鍵欄位) 上建立索引 (已存在則略過)，讓時間範圍查詢與唯一鍵查找不必掃描整張表"""
+    c.execute(f'CREATE INDEX IF NOT EXISTS "idx_{table_name}_{time_column}" ON "{table_name}" ("{time_column}")')
+
+def ensure_time_indexes(conn):
+    """為所有範本、儀表板圖表與 EnPI 定義所引用的時間欄位，以及範本的唯一鍵欄位建立索引"""
+    c = conn.cursor(); targets = set()
+    catalog = schema_cache.get_catalog(conn); existing_tables = set(catalog.tables)
+    if 'data_templates' in existing_tables:
+        for name, config_json, unique_key in c.execute("SELECT template_name, columns_config, unique_key_column FROM data_templates").fetchall():
+            if unique_key: targets.add((name, unique_key))
+            try: targets.update((name, col) for col in get_template_time_columns(json.loads(config_json)))
+            except (ValueError, TypeError): continue
+    if 'DashboardCharts' in existing_tables: targets.update(tuple(row) for row in c.execute("SELECT source_table_name, time_column FROM DashboardCharts").fetchall())
+    if 'EnPI_Definitions' in existing_tables:
+        for prefix in ('numerator', 'denominator'): targets.update(tuple(row) for row in c.execute(f"SELECT {prefix}_source_table, {prefix}_time_column FROM EnPI_Definitions WHERE {prefix}_source_type = 'auto'").fetchall())
+    for table_name, time_column in targets:
+        if not table_name or not time_column or table_name not in existing_tables: continue
+        if catalog.tables[table_name].has_column(time_column): ensure_time_index(c, table_name, time_column)
+    conn.commit()
+
+# --- 欄位型別 ---
+# 範本欄位可在 columns_config 中以 "dtype" 宣告型別，未宣告時依資料來源推斷。
+# 時間戳記以 'YYYY-MM-DD HH:MM:SS' 字串 (TEXT) 儲存，才能以字串範圍比對並使用索引。
+COLUMN_DTYPES = {'REAL': 'REAL', 'INTEGER': 'INTEGER', 'TIMESTAMP': 'TEXT', 'TEXT': 'TEXT'}
+MONITOR_COLUMN_DTYPES = {'device_id': 'TEXT', 'start_time': 'TIMESTAMP', 'end_time': 'TIMESTAMP', 'duration_seconds': 'INTEGER'}
+
+def is_monitor_template(columns_config): return any(col['type'] == '設備狀態監控' for col in columns_config)
+
+def get_column_dtype(col_def, is_monitor=False):
+    """回傳欄位型別 (REAL / INTEGER / TIMESTAMP / TEXT)"""
+    dtype = str(col_def.get('dtype') or '').upper()
+    if dtype in COLUMN_DTYPES: return dtype
+    if is_monitor and col_def['name'] in MONITOR_COLUMN_DTYPES: return MONITOR_COLUMN_DTYPES[col_def['name']]
+    value = str(col_def.get('value', '')).strip().lower()
+    if col_def['type'] == 'URL': return 'REAL'
+    if col_def['type'] == '動態公式' and value == 'now': return 'TIMESTAMP'
+    if col_def['type'] == '動態公式' and value.startswith('db_eval:'): return 'REAL'
+    return 'TEXT'
+
+def get_template_dtypes(columns_config):
+    """回傳 {欄位名稱: 型別}，不含設備狀態監控的控制欄位"""
+    is_monitor = is_monitor_template(columns_config)
+    return {col['name']: get_column_dtype(col, is_monitor) for col in columns_config if col['type'] != '設備狀態監控'}
+
+def coerce_value(value, dtype):
+    """依欄位型別轉換寫入值；數值欄位遇到非數值內容時存為 NULL"""
+    if value is None: return None
+    if dtype == 'REAL': return rollup.to_number(value)
+    if dtype == 'INTEGER':
+        number = rollup.to_number(value)
+        return int(round(number)) if number is not None else None
+    return value
+
+# --- URL 管理函式 ---
+def get_urls():
+    conn = db.connect(); conn.row_factory = sqlite3.Row; c = conn.cursor()
+    c.execute("SELECT id, url, description FROM url_list ORDER BY description")
+    urls = c.fetchall(); conn.close(); return urls
+
+def add_url(url, description):
+    if not url: return False, "URL不能為空"
+    conn = db.connect(); c = conn.cursor()
+    try: c.execute("INSERT INTO url_list (url, description) VALUES (?, ?)", (url, description)); conn.commit(); return True, "URL 已新增"
+    except sqlite3.IntegrityError: return False, "此 URL 已存在"
+    finally: conn.close()
+
+def delete_url(url_id):
+    conn = db.connect(); c = conn.cursor(); c.execute("DELETE FROM url_list WHERE id = ?", (url_id,)); conn.commit(); conn.close()
+
+def update_url(url_id, url, description):
+    if not url: return False, "URL不能為空"
+    conn = db.connect(); c = conn.cursor()
+    try: c.execute("UPDATE url_list SET url = ?, description = ? WHERE id = ?", (url, description, url_id)); conn.commit(); return True, "URL 已更新"
+    except sqlite3.IntegrityError: return False, "此 URL 已存在於另一筆記錄中"
+    except Exception as e: conn.rollback(); return False, f"更新時發生錯誤: {e}"
+    finally: conn.close()
+
+# --- 資料範本 (核心功能) ---
+def get_templates():
+    conn = db.connect(); conn.row_factory = sqlite3.Row; c = conn.cursor()
+    c.execute("SELECT id, template_name, description, unique_key_column, last_run_time, sample_interval FROM data_templates")
+    templates = c.fetchall(); conn.close(); return templates
+
+def touch_template(c, template_id, run_time=None, changed=True):
+    """更新範本的 last_run_time；changed 時一併遞增 data_version (必須與資料寫入在同一交易)"""
+    run_time = run_time or datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    if changed and schema_cache.has_column(c.connection, 'data_templates', 'data_version'): c.execute("UPDATE data_templates SET last_run_time = ?, data_version = data_version + 1 WHERE id = ?", (run_time, template_id))
+    else: c.execute("UPDATE data_templates SET last_run_time = ? WHERE id = ?", (run_time, template_id))
+
+def bump_data_version(c, table_name):
+    """資料被收集以外的方式修改 (清空、重算衍生欄位) 時遞增 data_version"""
+    if schema_cache.has_column(c.connection, 'data_templates', 'data_version'): c.execute("UPDATE data_templates SET data_version = data_version + 1 WHERE template_name = ?", (table_name,))
+
+def get_template_details(template_id):
+    conn = db.connect(); conn.row_factory = sqlite3.Row; c = conn.cursor()
+    c.execute("SELECT * FROM data_templates WHERE id = ?", (template_id,))
+    template = c.fetchone(); conn.close(); return template
+
+def get_template_interval(template):
+    """回傳範本的取樣間隔秒數，未設定或無效時使用預設值"""
+    try: interval = float(template['sample_interval'])
+    except (KeyError, IndexError, TypeError, ValueError): return DEFAULT_SAMPLE_INTERVAL
+    return interval if interval >= 1 else DEFAULT_SAMPLE_INTERVAL
+
+def save_template(template_id, name, desc, columns_config, unique_key, sample_interval=None, retention_days=None):
+    conn = db.connect(); c = conn.cursor(); config_json = json.dumps(columns_config, ensure_ascii=False)
+    if template_id: c.execute("UPDATE data_templates SET template_name=?, description=?, columns_config=?, unique_key_column=?, sample_interval=?, retention_days=? WHERE id=?", (name, desc, config_json, unique_key, sample_interval, retention_days, template_id))
+    else: c.execute("INSERT INTO data_templates (template_name, description, columns_config, unique_key_column, sample_interval, retention_days) VALUES (?, ?, ?, ?, ?, ?)", (name, desc, config_json, unique_key, sample_interval, retention_days))
+    try:
+        c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (name,))
+        dtypes = get_template_dtypes(columns_config)
+        if not c.fetchone():
+            col_defs = ", ".join([f'"{col_name}" {COLUMN_DTYPES[dtype]}' for col_name, dtype in dtypes.items()])
+            c.execute(f'CREATE TABLE "{name}" (id INTEGER PRIMARY KEY AUTOINCREMENT, {col_defs})')
+        else:
+            c.execute(f'PRAGMA table_info("{name}")')
+            existing_cols = [row[1] for row in c.fetchall()]
+            for col_name, dtype in dtypes.items():
+                if col_name not in existing_cols: c.execute(f'ALTER TABLE "{name}" ADD COLUMN "{col_name}" {COLUMN_DTYPES[dtype]}')
+        c.execute(f'PRAGMA table_info("{name}")'); table_cols = [row[1] for row in c.fetchall()]
+        for time_column in get_template_time_columns(columns_config):
+            if time_column in table_cols: ensure_time_index(c, name, time_column)
+        if unique_key and unique_key in table_cols: ensure_time_index(c, name, unique_key)
+        conn.commit(); rollup.ensure_rollups(conn, tables={name}); return True, "範本已儲存，資料表結構已同步。"
+    except Exception as e: conn.rollback(); return False, f"儲存範本時發生錯誤: {e}"
+    finally: schema_cache.invalidate(); conn.close()
+
+def delete_template(template_id):
+    conn = db.connect(); c = conn.cursor(); c.execute("SELECT template_name FROM data_templates WHERE id = ?", (template_id,)); result = c.fetchone()
+    if result: c.execute("DELETE FROM data_templates WHERE id = ?", (template_id,)); c.execute(f'DROP TABLE IF EXISTS "{result[0]}"'); rollup.drop_rollups(c, result[0], forget=True); retention.forget(c, result[0]); conn.commit(); formula_engine.invalidate(result[0]); device_monitor.states.invalidate(result[0]); schema_cache.invalidate()
+    conn.close()
+
+# --- 範本執行計畫 ---
+# 每個範本只編譯一次：解析 columns_config、以 URL ID 對照實際網址、預先編譯 eval: 公式並組好 INSERT/UPDATE 語句，跨收集週期重複使用。
+# data_templates 與 url_list 的觸發器會在設定變更時遞增 Config_Version，每個週期只需讀取一次版本號即可判斷快取是否有效 (其他程序的修改也適用)。
+class TemplatePlan:
+    """單一範本的執行計畫 (由 compile_template_plan 建立)"""
+    def __init__(self, template_id, table_name, columns_config, unique_key):
+        self.template_id = template_id; self.table_name = table_name; self.columns_config = columns_config; self.unique_key = unique_key
+        self.error = None; self.is_monitor = False; self.devices = []; self.device_ids = []; self.url_jobs = {}; self.steps = []; self.column_dtypes = []; self.deferred = []; self.time_col = None; self.rollup_columns = []
+
+def compile_template_plan(template, url_map):
+    """依範本設定與 URL 對照表建立執行計畫；設定錯誤不拋出例外，而是記錄在 plan.error 於執行時回報"""
+    table_name = template['template_name']; columns_config = json.loads(template['columns_config']); plan = TemplatePlan(template['id'], table_name, columns_config, template['unique_key_column'])
+    monitor_configs = [col for col in columns_config if col['type'] == '設備狀態監控']
+    if monitor_configs:
+        plan.is_monitor = True
+        try:
+            plan.devices = [device for col in monitor_configs for device in device_monitor.parse_devices(col['value'], url_map)]; device_monitor.check_unique(plan.devices)
+            plan.device_ids = [device.device_id for device in plan.devices]; plan.url_jobs = {device.url: MONITOR_TIMEOUT for device in plan.devices}
+        except device_monitor.MonitorConfigError as e: plan.error = f"監控範本 '{table_name}' {e}"
+        plan.select_last_sql = f'SELECT id, end_time FROM "{table_name}" WHERE device_id = ? ORDER BY id DESC LIMIT 1'; plan.insert_sql = f'INSERT INTO "{table_name}" (device_id, start_time) VALUES (?, ?)'
+        plan.close_sql = f'UPDATE "{table_name}" SET end_time = ? WHERE id = ?'; plan.close_duration_sql = f"""UPDATE "{table_name}" SET end_time = ?, duration_seconds = CAST(strftime('%s', ?) - strftime('%s', start_time) AS INTEGER) WHERE id = ?"""
+        return plan
+    dtypes = get_template_dtypes(columns_config)
+    for col_def in columns_config:
+        col_name, source_type, source_value = col_def["name"], col_def["type"], col_def["value"]
+        if source_type == "動態公式" and source_value.lower().startswith("db_eval:"): step = ('value', None); plan.deferred.append(col_name)
+        elif source_type == "URL":
+            try:
+                url_id = int(source_value); url, _ = url_map.get(url_id, (None, None))
+                step = ('url', (url, None if url else f"在範本 '{table_name}' 中找不到 URL ID: {url_id}"))
+            except (ValueError, TypeError) as e: step = ('url', (None, f"在範本 '{table_name}' 中抓取URL失敗 (None): {e}"))
+        elif source_type == "靜態值": step = ('value', source_value)
+        elif source_type == "動態公式":
+            if source_value.lower() == "now": step = ('now', None)
+            elif source_value.lower().startswith("eval:"):
+                try: step = ('eval', (compile(source_value[5:], '<string>', 'eval'), None))
+                except Exception as e: step = ('eval', (None, f"公式錯誤: {e}"))
+            else: step = ('value', source_value)
+        else: continue
+        plan.steps.append(step); plan.column_dtypes.append((col_name, dtypes.get(col_name, 'TEXT')))
+    columns = [col for col, _ in plan.column_dtypes]; time_columns = get_template_time_columns(columns_config); plan.time_col = time_col = time_columns[0] if time_columns else None; plan.rollup_columns = rollup.get_rollup_columns(columns_config)
+    key_select = f'id, "{time_col}"' if time_col else 'id'; column_list = ", ".join(f'"{k}"' for k in columns); set_clauses = ", ".join(f'"{k}" = ?' for k in columns)
+    plan.key_sql = f'SELECT {key_select} FROM "{table_name}" WHERE "{plan.unique_key}" = ?' if plan.unique_key in columns else None
+    plan.insert_sql = f'INSERT INTO "{table_name}" ({column_list}) VALUES ({", ".join("?" * len(columns))})'; plan.update_sql = f'UPDATE "{table_name}" SET {set_clauses} WHERE id = ?'
+    plan.url_jobs = _collect_template_urls(columns_config, url_map); deferred_clauses = ", ".join(f'"{k}" = ?' for k in plan.deferred); plan.formula_update_sql = f'UPDATE "{table_name}" SET {deferred_clauses} WHERE id = ?' if plan.deferred else None
+    return plan
+
+_plans = {}; _plans_version = None; _url_map = None; _plans_lock = threading.Lock()
+
+def _read_config_version(conn):
+    try: row = conn.execute("SELECT version FROM Config_Version WHERE name = 'templates'").fetchone()
+    except sqlite3.OperationalError: return None  # 尚未執行 init_db 的舊資料庫：不使用快取
+    return row[0] if row else None
+
+def get_template_plans(template_ids):
+    """回傳 {template_id: TemplatePlan} (找不到的範本不包含在內)；設定版本改變時重新編譯"""
+    global _plans_version, _url_map
+    conn = db.connect(); conn.row_factory = sqlite3.Row
+    try:
+        version = _read_config_version(conn)
+        with _plans_lock:
+            if version is None or version != _plans_version: _plans.clear(); _url_map = None; _plans_version = version
+            plans = {tid: _plans[int(tid)] for tid in template_ids if int(tid) in _plans}; url_map = _url_map
+        missing = sorted({int(tid) for tid in template_ids if tid not in plans})
+        if missing:
+            if url_map is None: url_map = {r['id']: (r['url'], r['description']) for r in conn.execute("SELECT id, url, description FROM url_list")}
+            rows = conn.execute(f"SELECT id, template_name, columns_config, unique_key_column FROM data_templates WHERE id IN ({', '.join('?' * len(missing))})", missing).fetchall()
+            compiled = {row['id']: compile_template_plan(row, url_map) for row in rows}
+            with _plans_lock:
+                if _plans_version == version and version is not None: _plans.update(compiled); _url_map = url_map
+            plans.update({tid: compiled[int(tid)] for tid in template_ids if int(tid) in compiled})
+        return plans
+    finally: conn.close()
+
+def run_template(template_id, prefetched=None):
+    plan = get_template_plans([template_id]).get(template_id)
+    if not plan: return False, f"找不到範本 ID: {template_id}"
+    return _run_plan(plan, prefetched)
+
+def _run_plan(plan, prefetched=None):
+    try: return db.run_with_retry(run_monitor_logic if plan.is_monitor else run_standard_logic, plan, prefetched)
+    except sqlite3.OperationalError as e: return False, f"範本 ID {plan.template_id} 寫入時資料庫持續鎖定: {e}"
+
+def _collect_template_urls(columns_config, url_map):
+    """找出範本需要抓取的所有 URL 及其逾時秒數 {url: timeout}"""
+    jobs = {}
+    for col_def in columns_config:
+        try:
+            if col_def['type'] == '設備狀態監控': url_id, timeout = col_def['value']['url_id'], MONITOR_TIMEOUT
+            elif col_def['type'] == 'URL': url_id, timeout = col_def['value'], STANDARD_TIMEOUT
+            else: continue
+            url, _ = url_map.get(int(url_id), (None, None))
+        except (KeyError, ValueError, TypeError): continue
+        if url: jobs[url] = max(jobs.get(url, 0), timeout)
+    return jobs
+
+def run_templates(template_ids):
+    """
+    一次執行多個範本：先以執行緒池同時抓取所有範本的 URL，再依序寫入資料庫。
+    回傳 [(template_id, ok, msg), ...]，順序與 template_ids 相同。
+    """
+    plans = get_template_plans(template_ids); jobs = {}
+    for plan in plans.values():
+        for url, timeout in plan.url_jobs.items(): jobs[url] = max(jobs.get(url, 0), timeout)
+    prefetched = fetch_all(jobs); results = []
+    for template_id in template_ids:
+        if template_id not in plans: results.append((template_id, False, f"找不到範本 ID: {template_id}")); continue
+        ok, msg = _run_plan(plans[template_id], prefetched); results.append((template_id, ok, msg))
+    return results
+
+def _get_url_text(url, timeout, prefetched):
+    """優先使用已同時抓取的結果，沒有時才單獨抓取；失敗時拋出例外"""
+    if prefetched is not None and url in prefetched:
+        ok, text = prefetched[url]
+        if not ok: raise requests.RequestException(text)
+        return text
+    return fetch_url(url, timeout)
+
+def run_monitor_logic(plan, prefetched=None):
+    """
+    一次處理範本中的所有設備：狀態在記憶體中比對，只有開機/關機轉換時才寫入 (轉換前再以資料表確認該設備的最後紀錄)；
+    沒有轉換時不連線資料庫，只每隔 device_monitor.HEARTBEAT_SECONDS 更新一次 last_run_time。
+    """
+    if plan.error: return False, plan.error
+    template_id, table_name = plan.template_id, plan.table_name
+    statuses, fetch_errors = device_monitor.read_statuses(plan.devices, lambda url: _get_url_text(url, MONITOR_TIMEOUT, prefetched))
+    if all(status is None for status in statuses.values()) and fetch_errors: return True, f"範本 '{table_name}' (監控模式) URL抓取失敗: {'; '.join(fetch_errors)}"
+    running = device_monitor.states.get(table_name, plan.device_ids); transitions = None; conn = None
+    if running is not None:
+        transitions = device_monitor.find_transitions(plan.devices, statuses, running)
+        if not transitions and not device_monitor.states.heartbeat_due(table_name): return True, f"範本 '{table_name}' (監控模式) 狀態未變化或無效，無操作。"
+    conn = db.connect(); c = conn.cursor()
+    try:
+        if running is None:
+            running = device_monitor.states.load(c, table_name, plan.device_ids); transitions = device_monitor.find_transitions(plan.devices, statuses, running)
+            if not transitions and not device_monitor.states.heartbeat_due(table_name): return True, f"範本 '{table_name}' (監控模式) 狀態未變化或無效，無操作。"
+        now_str = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"); changes, messages = {}, []
+        for device, action in transitions:
+            c.execute(plan.select_last_sql, (device.device_id,)); last_log = c.fetchone(); open_id = last_log[0] if last_log is not None and last_log[1] is None else None
+            if action == 'on' and open_id is None: c.execute(plan.insert_sql, (device.device_id, now_str)); changes[device.device_id] = c.lastrowid; messages.append(f"偵測到設備 '{device.device_id}' 開機，已新增紀錄。")
+            elif action == 'off' and open_id is not None:
+                if schema_cache.has_column(conn, table_name, 'duration_seconds'): c.execute(plan.close_duration_sql, (now_str, now_str, open_id))
+                else: c.execute(plan.close_sql, (now_str, open_id))
+                changes[device.device_id] = None; messages.append(f"偵測到設備 '{device.device_id}' 關機，已更新紀錄。")
+            else: changes[device.device_id] = open_id  # 記憶體狀態與資料表不一致 (例如其他程序已寫入)：以資料表為準
+        touch_template(c, template_id, now_str, changed=bool(messages)); conn.commit(); device_monitor.states.confirm(table_name, changes)
+        if len(messages) > 3: messages = [f"範本 '{table_name}' (監控模式) 共 {len(messages)} 台設備狀態改變，已更新紀錄。"]
+        log_message = " ".join(messages) or f"範本 '{table_name}' (監控模式) 狀態未變化或無效，無操作。"
+        return True, log_message + (f" (部分 URL 抓取失敗: {'; '.join(fetch_errors)})" if fetch_errors else "")
+    except sqlite3.OperationalError as e: 
+        conn.rollback(); device_monitor.states.invalidate(table_name)
+        if db.is_busy_error(e): raise
+        if "no such column" in str(e): 
+            return False, f"執行監控範本 '{table_name}' 失敗！\n錯誤: {e}\n\n請檢查資料表是否包含 'device_id', 'start_time', 'end_time' 等必要欄位。"
+        return False, f"執行監控範本 '{table_name}' 時資料庫出錯: {e}"
+    except Exception as e: 
+        conn.rollback(); device_monitor.states.invalidate(table_name)
+        return False, f"執行監控範本 '{table_name}' 時發生未知錯誤: {e}"
+    finally: 
+        conn.close()
+
+def run_standard_logic(plan, prefetched=None):
+    template_id, table_name = plan.template_id, plan.table_name; values = []
+    for kind, value in plan.steps:
+        if kind == 'url':
+            url, error = value
+            if error: return False, error
+            try: values.append(_get_url_text(url, STANDARD_TIMEOUT, prefetched))
+            except Exception as e: return False, f"在範本 '{table_name}' 中抓取URL失敗 ({url}): {e}"
+        elif kind == 'now': values.append(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+        elif kind == 'eval':
+            code, error = value
+            if error: values.append(error); continue
+            try: values.append(str(eval(code)))
+            except Exception as e: values.append(f"公式錯誤: {e}")
+        else: values.append(value)
+    data_row = {col: coerce_value(value, dtype) for (col, dtype), value in zip(plan.column_dtypes, values)}; dtypes = dict(plan.column_dtypes); formula_warnings = []
+    conn = db.connect(); c = conn.cursor()
+    try:
+        row_id, existing_id = None, None; result = None; time_col = plan.time_col; old_time = None
+        if plan.key_sql and data_row[plan.unique_key] is not None: c.execute(plan.key_sql, (data_row[plan.unique_key],)); result = c.fetchone()
+        if result: existing_id = result[0]; old_time = result[1] if time_col else None
+        if existing_id is not None: row_id = existing_id; c.execute(plan.update_sql, tuple(data_row.values()) + (row_id,))
+        else: c.execute(plan.insert_sql, tuple(data_row.values())); row_id = c.lastrowid
+        formulas = formula_engine.get_formulas(table_name, plan.columns_config, time_col) if plan.deferred else None
+        if plan.deferred and row_id is not None:
+            update_payload = {}; formula_results = formulas.evaluate(c, row_id, data_row, appended=existing_id is None)
+            for column in plan.deferred:
+                result = formula_results.get(column)
+                if isinstance(result, str) and dtypes.get(column) in ('REAL', 'INTEGER'): formula_warnings.append(f"{column}: {result}")
+                update_payload[column] = coerce_value(result, dtypes.get(column, 'TEXT'))
+            c.execute(plan.formula_update_sql, tuple(update_payload.values()) + (row_id,)); data_row.update(update_payload)
+        if time_col:  # 同步更新彙總資料：新增列直接累加，就地更新的列則重建受影響的月份
+            rollup_columns = plan.rollup_columns
+            if existing_id is None: rollup.apply_sample(c, table_name, data_row.get(time_col), {col: data_row.get(col) for col in rollup_columns})
+            else: rollup.rebuild_sample_months(c, table_name, time_col, rollup_columns, [old_time, data_row.get(time_col)])
+        alarms = alarm_engine.engine.evaluate(c, table_name, data_row, data_row.get(time_col) if time_col else None)  # 只檢查以此資料表為來源的警報規則
+        touch_template(c, template_id); conn.commit()
+        if formulas: formulas.confirm(data_row)
+        alarm_engine.engine.confirm(alarms)
+        return True, f"範本 '{table_name}' 執行成功。" + (f" (公式警告: {'; '.join(formula_warnings)})" if formula_warnings else "")
+    except Exception as e:
+        conn.rollback(); formula_engine.invalidate(table_name)
+        if db.is_busy_error(e): raise
+        return False, f"執行範本 '{table_name}' 時資料庫出錯: {e}"
+    finally: conn.close()
+
+def get_table_names():
+    conn = db.connect()
+    try: return sorted(schema_cache.table_names(conn))
+    finally: conn.close()
+def get_table_columns(table_name):
+    conn = db.connect()
+    try: return schema_cache.get_columns(conn, table_name) or []
+    finally: conn.close()
+def get_table_page(table_name, after_key=None, before_key=None, limit=TABLE_PAGE_SIZE):
+    """
+    以 keyset 分頁讀取資料表，回傳 [(key, row tuple), ...] (依 key 遞增)。
+    after_key: 取 key 之後的 limit 筆 (None 代表從頭)；before_key: 取 key 之前的 limit 筆。
+    key 為 rowid (範本資料表即 id)，只需走主鍵索引；WITHOUT ROWID 的資料表改以位置作為 key。
+    """
+    conn = db.connect(); c = conn.cursor()
+    try:
+        try:
+            if before_key is not None: rows = c.execute(f'SELECT rowid, * FROM "{table_name}" WHERE rowid < ? ORDER BY rowid DESC LIMIT ?', (before_key, limit)).fetchall()[::-1]
+            elif after_key is not None: rows = c.execute(f'SELECT rowid, * FROM "{table_name}" WHERE rowid > ? ORDER BY rowid LIMIT ?', (after_key, limit)).fetchall()
+            else: rows = c.execute(f'SELECT rowid, * FROM "{table_name}" ORDER BY rowid LIMIT ?', (limit,)).fetchall()
+            return [(row[0], tuple(row[1:])) for row in rows]
+        except sqlite3.OperationalError as e:
+            if 'rowid' not in str(e): raise
+        if before_key is not None: offset = max(0, before_key - limit); limit = before_key - offset
+        else: offset = 0 if after_key is None else after_key + 1
+        rows = c.execute(f'SELECT * FROM "{table_name}" LIMIT ? OFFSET ?', (limit, offset)).fetchall()
+        return [(offset + i, tuple(row)) for i, row in enumerate(rows)]
+    except sqlite3.OperationalError: return []
+    finally: conn.close()
+def get_table_row_count(table_name):
+    conn = db.connect()
+    try: return conn.execute(f'SELECT COUNT(*) FROM "{table_name}"').fetchone()[0]
+    except sqlite3.OperationalError: return 0
+    finally: conn.close()
+def get_table_data(table_name):
+    conn = db.connect(); conn.row_factory = sqlite3.Row; c = conn.cursor()
+    try: c.execute(f'PRAGMA table_info("{table_name}")'); columns = [row['name'] for row in c.fetchall()]; c.execute(f'SELECT * FROM "{table_name}"'); rows = c.fetchall(); return columns, rows
+    except sqlite3.OperationalError: return [], []
+    finally: conn.close()
+def clear_table_data(table_name):
+    conn = db.connect(); c = conn.cursor()
+    try:
+        if not table_name.isidentifier(): return False, "無效的資料表名稱"
+        if schema_cache.is_internal(table_name): return False, f"'{table_name}' 為系統內部資料表，不可清空"
+        c.execute(f'DELETE FROM "{table_name}"'); c.execute(f"DELETE FROM sqlite_sequence WHERE name='{table_name}'"); rollup.drop_rollups(c, table_name); retention.forget(c, table_name); bump_data_version(c, table_name); conn.commit(); formula_engine.invalidate(table_name); device_monitor.states.invalidate(table_name); return True, f"資料表 '{table_name}' 的內容已清空。"
+    except Exception as e: conn.rollback(); return False, f"清空資料表 '{table_name}' 失敗: {e}"
+    finally: conn.close()
@@ -0,0 +1,153 @@
+# ems_project/collector_daemon.py
+# 無介面的背景資料收集服務：依各範本的取樣間隔排程執行，不需要 tkinter / matplotlib / 顯示器
+#
+# 用法:
+#   python collector_daemon.py                 # 執行所有範本
+#   python collector_daemon.py --templates 4 8 # 只執行指定 ID 的範本
+#   python collector_daemon.py --once          # 每個範本執行一次後結束
+
+import argparse
+import datetime
+import heapq
+import signal
+import threading
+import time
+
+import db
+import fetch_engine
+import retention
+from collector_core import init_db, get_templates, get_template_interval, run_templates
+
+TEMPLATE_RELOAD_SECONDS = 60  # 多久重新讀取一次範本清單與取樣間隔
+RETENTION_CHECK_SECONDS = 3600  # 多久檢查一次是否有超過保留期限、需要封存的月份
+
+
+def _log(message):
+    print(f"[{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {message}", flush=True)
+
+
+class CollectorDaemon:
+    """
+    以優先佇列 (heap) 排程各範本：每筆項目為 (下次執行時間, 範本 ID)。
+    下次執行時間以「上一次的排定時間 + 間隔」計算，不受執行耗時影響，因此不會漂移；
+    若落後超過一個間隔，則跳過錯過的時段而不是連續補跑。
+    同一時間到期的範本會合併成一批，交給 run_templates 同時抓取 URL。
+    """
+
+    def __init__(self, template_ids=None):
+        self.template_ids = {str(tid) for tid in template_ids} if template_ids else None
+        self.stop_event = threading.Event()
+        self.intervals = {}
+        self.names = {}
+        self.schedule = []
+        self.next_reload = 0.0
+        self.next_retention = 0.0
+
+    def _sync_templates(self, now):
+        """重新讀取範本清單；新增的範本立即排入，刪除的範本在出佇列時略過"""
+        templates = {str(t['id']): t for t in get_templates()}
+        if self.template_ids is not None:
+            templates = {tid: t for tid, t in templates.items() if tid in self.template_ids}
+        for tid, template in templates.items():
+            if tid not in self.intervals:
+                heapq.heappush(self.schedule, (now, tid))
+            self.intervals[tid] = get_template_interval(template)
+            self.names[tid] = template['template_name']
+        for tid in list(self.intervals):
+            if tid not in templates:
+                del self.intervals[tid]
+        self.next_reload = now + TEMPLATE_RELOAD_SECONDS
+
+    def _pop_due(self, now):
+        due = []
+        while self.schedule and self.schedule[0][0] <= now:
+            scheduled_at, tid = heapq.heappop(self.schedule)
+            if tid in self.intervals:
+                due.append((scheduled_at, tid))
+        return due
+
+    def _reschedule(self, scheduled_at, tid, now):
+        interval = self.intervals.get(tid)
+        if interval is None:
+            return
+        next_at = scheduled_at + interval
+        if next_at <= now:
+            missed = int((now - scheduled_at) // interval)
+            next_at = scheduled_at + (missed + 1) * interval
+        heapq.heappush(self.schedule, (next_at, tid))
+
+    def run_cycle(self, template_ids):
+        cycle_start = time.monotonic()
+        results = run_templates(template_ids)
+        elapsed = time.monotonic() - cycle_start
+        failed = [(tid, msg) for tid, ok, msg in results if not ok]
+        _log(f"執行 {len(results)} 個範本，成功 {len(results) - len(failed)}，耗時 {elapsed:.2f} 秒")
+        for tid, msg in failed:
+            _log(f"  失敗 {self.names.get(tid, tid)}: {msg}")
+        return results
+
+    def run_retention(self):
+        """封存超過保留期限的原始資料；沒有到期的月份時只是每個範本一次索引查詢"""
+        conn = db.connect()
+        try:
+            archived, errors = retention.archive_expired(conn)
+        except Exception as e:
+            archived, errors = [], [str(e)]
+        finally:
+            conn.close()
+        for table_name, month, count in archived:
+            _log(f"已封存 {table_name} {month}: {count} 筆")
+        for message in errors:
+            _log(f"  封存失敗 {message}")
+        self.next_retention = time.monotonic() + RETENTION_CHECK_SECONDS
+
+    def run(self, once=False):
+        init_db()
+        self._sync_templates(time.monotonic())
+        if not self.intervals:
+            _log("沒有可執行的範本，結束。")
+            return
+        _log(f"背景收集服務啟動，共 {len(self.intervals)} 個範本。")
+        if once:
+            self.run_cycle(sorted(self.intervals, key=int))
+            return
+        while not self.stop_event.is_set():
+            now = time.monotonic()
+            if now >= self.next_reload:
+                self._sync_templates(now)
+            if now >= self.next_retention:
+                self.run_retention()
+                continue
+            due = self._pop_due(now)
+            if due:
+                self.run_cycle([tid for _, tid in due])
+                finished = time.monotonic()
+                for scheduled_at, tid in due:
+                    self._reschedule(scheduled_at, tid, finished)
+                continue
+            next_due = self.schedule[0][0] if self.schedule else self.next_reload
+            self.stop_event.wait(timeout=max(0.0, min(next_due, self.next_reload, self.next_retention) - now))
+        _log("背景收集服務已停止。")
+
+    def stop(self, *_):
+        self.stop_event.set()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="EMS 背景資料收集服務")
+    parser.add_argument("--templates", nargs="*", help="只執行指定 ID 的範本 (預設全部)")
+    parser.add_argument("--once", action="store_true", help="每個範本執行一次後結束")
+    args = parser.parse_args()
+
+    daemon = CollectorDaemon(args.templates)
+    signal.signal(signal.SIGINT, daemon.stop)
+    signal.signal(signal.SIGTERM, daemon.stop)
+    try:
+        daemon.run(once=args.once)
+    finally:
+        fetch_engine.shutdown()
+        db.close_all()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,220 @@
+# ems_project/dashboard_query.py
+# 儀表板查詢規劃：一次載入所有圖表/數據系列設定並快取，同一來源表的圖表共用一次分組掃描
+
+import hashlib
+import json
+import threading
+import time
+from datetime import datetime, timedelta
+
+import retention
+import rollup
+import schema_cache
+
+# 各時間群組對應的 X 軸分組格式
+GROUPING_FORMATS = {'hour': '%H', 'day': '%d', 'month': '%m'}
+
+RESULT_TTL_SECONDS = 60  # 圖表結果快取的最長保留秒數
+
+_config_cache = None
+_config_lock = threading.Lock()
+_config_generation = 0  # 每次圖表設定變更時遞增，串流推播據此判斷是否需要重送全部圖表
+
+# (chart_id, 時間區間起點) -> {'expires', 'version', 'payload', 'digest'}
+_result_cache = {}
+_result_lock = threading.Lock()
+
+
+def dashboard_time_range(time_grouping, now=None):
+    """回傳儀表板時間群組對應的半開區間 [start, end)，格式為 'YYYY-MM-DD' 以便直接比對時間欄位字串並使用索引"""
+    now = now or datetime.now()
+    if time_grouping == 'day':
+        start = now.replace(day=1)
+        end = (start + timedelta(days=32)).replace(day=1)
+    elif time_grouping == 'month':
+        start = now.replace(month=1, day=1)
+        end = start.replace(year=start.year + 1)
+    else:
+        start = now
+        end = now + timedelta(days=1)
+    return start.strftime('%Y-%m-%d'), end.strftime('%Y-%m-%d')
+
+
+def _load_chart_configs(conn):
+    rows = conn.execute("""
+        SELECT c.id, c.chart_title, c.source_table_name, c.time_column, c.time_grouping, c.display_order,
+               s.id AS series_id, s.chart_id, s.source_column_name, s.series_label, s.chart_type, s.y_axis_id, s.aggregation_method
+        FROM DashboardCharts c LEFT JOIN DashboardSeries s ON s.chart_id = c.id
+        ORDER BY c.display_order, c.id, s.id
+    """).fetchall()
+    charts, by_id = [], {}
+    for row in rows:
+        chart = by_id.get(row['id'])
+        if chart is None:
+            chart = {key: row[key] for key in ('id', 'chart_title', 'source_table_name', 'time_column', 'time_grouping', 'display_order')}
+            chart['series'] = []
+            by_id[row['id']] = chart
+            charts.append(chart)
+        if row['series_id'] is not None:
+            chart['series'].append({
+                'id': row['series_id'], 'chart_id': row['chart_id'], 'source_column_name': row['source_column_name'],
+                'series_label': row['series_label'], 'chart_type': row['chart_type'], 'y_axis_id': row['y_axis_id'],
+                'aggregation_method': row['aggregation_method'],
+            })
+    return charts
+
+
+def get_chart_configs(conn):
+    """回傳所有圖表設定 (含 series)，在設定變更前都使用快取結果"""
+    global _config_cache
+    with _config_lock:
+        if _config_cache is None:
+            _config_cache = _load_chart_configs(conn)
+        return _config_cache
+
+
+def invalidate_chart_configs():
+    """圖表設定新增/修改/刪除後呼叫，下次查詢時重新載入"""
+    global _config_cache, _config_generation
+    with _config_lock:
+        _config_cache = None
+        _config_generation += 1
+    with _result_lock:
+        _result_cache.clear()
+
+
+def get_config_generation():
+    return _config_generation
+
+
+def get_source_versions(conn):
+    """
+    以 data_templates.data_version 作為各來源表的資料版本 ({資料表名稱: 版本})。
+    每次寫入資料都會在同一交易中遞增 data_version，因此版本不變代表資料未變 (同一秒內的多次寫入也能分辨)。
+    尚未遷移的資料庫沿用 last_run_time。
+    """
+    column = 'data_version' if schema_cache.has_column(conn, 'data_templates', 'data_version') else 'last_run_time'
+    return {row[0]: row[1] for row in conn.execute(f"SELECT template_name, {column} FROM data_templates")}
+
+
+def _agg_func(series):
+    method = series.get('aggregation_method')
+    return "SUM" if method and method.lower() == 'sum' else "AVG"
+
+
+def plan_dashboard_queries(charts):
+    """
+    將來源表、時間欄位與時間群組相同的圖表合併為同一個查詢。
+    回傳 [{'table', 'time_column', 'grouping', 'aggregates': {(func, column): alias}, 'charts': [...]}, ...]
+    """
+    groups = {}
+    for chart in charts:
+        if not chart['series']:
+            continue
+        grouping = chart.get('time_grouping') or 'hour'
+        if grouping not in GROUPING_FORMATS:
+            grouping = 'hour'
+        key = (chart['source_table_name'], chart['time_column'], grouping)
+        group = groups.setdefault(key, {'table': key[0], 'time_column': key[1], 'grouping': grouping, 'aggregates': {}, 'charts': []})
+        for series in chart['series']:
+            agg_key = (_agg_func(series), series['source_column_name'])
+            if agg_key not in group['aggregates']:
+                group['aggregates'][agg_key] = f"c{len(group['aggregates'])}"
+        group['charts'].append(chart)
+    return list(groups.values())
+
+
+def _run_group_query(conn, group, now=None):
+    time_col = group['time_column']
+    range_start, range_end = dashboard_time_range(group['grouping'], now)
+    if rollup.has_rollup(conn, group['table'], time_col):
+        # 時間群組與彙總層級一致 (每小時/每日/每月)，直接讀取彙總值
+        label_start, label_length = rollup.TIER_LABELS[group['grouping']]
+        return rollup.query_rollup(conn, group['table'], group['grouping'], range_start, range_end, group['aggregates'], label_start, label_length)
+    # 沒有彙總資料時分組讀取原始資料 (包含已封存的分區)
+    aggregates = [(func, f'"{column}"', alias) for (func, column), alias in group['aggregates'].items()]
+    return retention.aggregate_range(conn, group['table'], time_col, f"""strftime('{GROUPING_FORMATS[group['grouping']]}', "{time_col}")""",
+                                     aggregates, range_start, range_end)
+
+
+def build_chart_payload(chart, rows, aliases):
+    """
+    由分組查詢結果產生單一圖表的前端資料。
+    數值欄位以 REAL/INTEGER 儲存，彙總結果已是數值，只需將空值補 0。
+    """
+    chart_data = {'chartId': chart['id'], 'tableName': chart['chart_title'], 'labels': [row[0] for row in rows], 'datasets': []}
+    for series in chart['series']:
+        func = _agg_func(series)
+        alias = aliases[(func, series['source_column_name'])]
+        values = [row[alias] if isinstance(row[alias], (int, float)) else 0 for row in rows]
+        agg_label = "(累加)" if func == "SUM" else "(平均)"
+        chart_data['datasets'].append({'label': f"{series['series_label']} {agg_label}", 'data': values, 'type': series['chart_type'], 'yAxisID': series['y_axis_id']})
+    return chart_data
+
+
+def _get_cached(key, version, now_ts):
+    with _result_lock:
+        entry = _result_cache.get(key)
+    if entry and entry['expires'] > now_ts and entry['version'] == version:
+        return entry
+    return None
+
+
+def _store(key, version, payload, now_ts):
+    digest = hashlib.md5(json.dumps(payload, ensure_ascii=False, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+    entry = {'expires': now_ts + RESULT_TTL_SECONDS, 'version': version, 'payload': payload, 'digest': digest}
+    with _result_lock:
+        _result_cache[key] = entry
+    return entry
+
+
+def build_chart_entries(conn, now=None):
+    """
+    計算所有圖表的快取項目，依圖表顯示順序回傳 [(圖表 ID, 快取項目), ...]。
+    結果依 (圖表 ID, 時間區間) 快取；來源表版本改變或超過 TTL 時才重新查詢。
+    """
+    charts = get_chart_configs(conn)
+    versions = get_source_versions(conn)
+    now_ts = time.monotonic()
+    entries = {}
+    for group in plan_dashboard_queries(charts):
+        range_start, _ = dashboard_time_range(group['grouping'], now)
+        version = versions.get(group['table'])
+        keys = {chart['id']: (chart['id'], range_start) for chart in group['charts']}
+        cached = {chart_id: _get_cached(key, version, now_ts) for chart_id, key in keys.items()}
+        if all(cached.values()):
+            entries.update(cached)
+            continue
+        rows = _run_group_query(conn, group, now)
+        for chart in group['charts']:
+            payload = build_chart_payload(chart, rows, group['aggregates']) if rows else None
+            entries[chart['id']] = _store(keys[chart['id']], version, payload, now_ts)
+    return [(chart['id'], entries[chart['id']]) for chart in charts if chart['id'] in entries]
+
+
+def build_dashboard(conn, now=None):
+    """計算所有圖表的資料，依圖表顯示順序回傳 (資料, ETag)"""
+    ordered = [entry for _, entry in build_chart_entries(conn, now)]
+    etag = hashlib.md5('|'.join(entry['digest'] for entry in ordered).encode('utf-8')).hexdigest()
+    return [entry['payload'] for entry in ordered if entry['payload'] is not None], etag
+
+
+def chart_delta(old, new):
+    """
+    比較同一張圖表前後兩次的資料，回傳有變動的分組點 [{'label', 'values'}, ...]。
+    圖表標題/數據系列改變或有分組點消失 (例如跨日) 時回傳 None，代表需要重送整張圖表。
+    """
+    if old is None or new is None:
+        return None
+    meta = lambda payload: (payload['tableName'], [(ds['label'], ds['type'], ds['yAxisID']) for ds in payload['datasets']])
+    if meta(old) != meta(new):
+        return None
+    old_points = {label: [ds['data'][i] for ds in old['datasets']] for i, label in enumerate(old['labels'])}
+    if not set(old_points) <= set(new['labels']):
+        return None
+    points = []
+    for i, label in enumerate(new['labels']):
+        values = [ds['data'][i] for ds in new['datasets']]
+        if old_points.get(label) != values:
+            points.append({'label': label, 'values': values})
+    return points
@@ -0,0 +1,143 @@
+# ems_project/dashboard_stream.py
+# 儀表板即時推播 (Server-Sent Events)：單一背景執行緒監看資料庫提交，
+# 只在圖表來源表有新資料時重新計算，並只推送有變動的分組點給所有連線中的畫面
+
+import json
+import queue
+import sqlite3
+import threading
+import time
+
+import db
+from dashboard_query import build_chart_entries, chart_delta, get_config_generation
+
+POLL_SECONDS = 0.5          # 檢查資料庫是否有新提交的間隔
+FULL_REFRESH_SECONDS = 60   # 即使沒有新提交也重新計算一次 (處理跨日/跨月的時間區間變化)
+KEEPALIVE_SECONDS = 15      # 沒有事件時送出註解行，避免連線被代理伺服器關閉
+SUBSCRIBER_QUEUE_SIZE = 100
+
+
+def format_event(event, data):
+    """組成一則 SSE 訊息"""
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False, default=str)}\n\n"
+
+
+class DashboardBroadcaster:
+    """
+    所有連線共用一個監看執行緒：以 PRAGMA data_version 偵測其他連線 (收集程式、背景服務) 的提交，
+    有提交時才重新計算圖表 (未變動的來源表直接使用 dashboard_query 的快取)，
+    再與上次推送的內容比較，只送出變動的分組點。沒有連線時執行緒自動結束。
+    """
+
+    def __init__(self):
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._payloads = {}
+
+    def subscribe(self):
+        q = queue.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        with self._lock:
+            self._subscribers.add(q)
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="dashboard-stream", daemon=True)
+                self._thread.start()
+        return q
+
+    def unsubscribe(self, q):
+        with self._lock:
+            self._subscribers.discard(q)
+
+    def _publish(self, message):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for q in subscribers:
+            try:
+                q.put_nowait(message)
+            except queue.Full:
+                # 跟不上 (或已斷線) 的連線：清空待送事件，改為通知前端重新連線
+                self.unsubscribe(q)
+                while not q.empty():
+                    try:
+                        q.get_nowait()
+                    except queue.Empty:
+                        break
+                q.put_nowait(None)
+
+    def _refresh(self, conn, config_changed):
+        entries = build_chart_entries(conn)
+        payloads = {chart_id: entry['payload'] for chart_id, entry in entries}
+        if config_changed:
+            self._payloads = payloads
+            self._publish(format_event('snapshot', [p for p in payloads.values() if p is not None]))
+            return
+        previous, self._payloads = self._payloads, payloads
+        for chart_id, payload in payloads.items():
+            old = previous.get(chart_id)
+            if old == payload:
+                continue
+            points = chart_delta(old, payload)
+            if points is None:
+                self._publish(format_event('chart', {'chartId': chart_id, 'chart': payload}))
+            elif points:
+                self._publish(format_event('delta', {'chartId': chart_id, 'points': points}))
+
+    def _run(self):
+        conn = db.connect()
+        conn.row_factory = sqlite3.Row
+        try:
+            data_version = None
+            generation = get_config_generation()
+            self._payloads = {chart_id: entry['payload'] for chart_id, entry in build_chart_entries(conn)}
+            last_refresh = time.monotonic()
+            while True:
+                with self._lock:
+                    if not self._subscribers:
+                        self._thread = None
+                        return
+                time.sleep(POLL_SECONDS)
+                current_version = conn.execute("PRAGMA data_version").fetchone()[0]
+                current_generation = get_config_generation()
+                now = time.monotonic()
+                if current_version == data_version and current_generation == generation and now - last_refresh < FULL_REFRESH_SECONDS:
+                    continue
+                config_changed = current_generation != generation
+                data_version, generation, last_refresh = current_version, current_generation, now
+                try:
+                    self._refresh(conn, config_changed)
+                except Exception as e:
+                    print(f"儀表板推播計算失敗: {e}")
+        finally:
+            conn.close()
+
+    def open_stream(self, conn):
+        """
+        建立單一連線的事件產生器：先送出完整圖表 (snapshot)，之後只送變動。
+        先訂閱再計算 snapshot；推送的都是分組點的最新值，重複套用不會出錯。
+        """
+        q = self.subscribe()
+        try:
+            snapshot = [entry['payload'] for _, entry in build_chart_entries(conn) if entry['payload'] is not None]
+        except Exception:
+            self.unsubscribe(q)
+            raise
+        return self._events(q, snapshot)
+
+    def _events(self, q, snapshot):
+        try:
+            yield format_event('snapshot', snapshot)
+            while True:
+                try:
+                    message = q.get(timeout=KEEPALIVE_SECONDS)
+                except queue.Empty:
+                    yield ": keepalive\n\n"
+                    continue
+                if message is None:
+                    yield format_event('reload', {})
+                    return
+                yield message
+        finally:
+            self.unsubscribe(q)
+
+
+broadcaster = DashboardBroadcaster()
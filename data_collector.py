@@ -2,18 +2,19 @@
 
 import tkinter as tk
 from tkinter import ttk, messagebox, simpledialog, filedialog
-import sqlite3
-import requests
 import datetime
 import json
 import threading
 import time
-import pandas as pd
-from openpyxl.drawing.image import Image as OpenpyxlImage
 import io
-import calendar
 import ctypes
-import os
+import db
+import analysis_query
+from collector_core import (
+    COLUMN_DTYPES, TABLE_PAGE_SIZE, init_db, get_urls, add_url, delete_url, update_url,
+    get_templates, get_template_details, get_template_interval, save_template, delete_template,
+    run_templates, get_table_names, get_table_columns, get_table_page, get_table_row_count, clear_table_data,
+)
 
 # --- 函式庫可用性檢查 ---
 try:
@@ -33,227 +34,6 @@ try:
 except ImportError:
     TKCALENDAR_AVAILABLE = False
 
-# --- 全域設定 ---
-BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-DB_NAME = "url_manager.db"
-DB_PATH = os.path.join(BASE_DIR, DB_NAME)
-
-# --- 資料庫初始化與遷移 ---
-def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    
-    # 原有表格
-    c.execute('''CREATE TABLE IF NOT EXISTS url_list (id INTEGER PRIMARY KEY AUTOINCREMENT, url TEXT NOT NULL UNIQUE, description TEXT)''')
-    c.execute('''CREATE TABLE IF NOT EXISTS data_templates (id INTEGER PRIMARY KEY AUTOINCREMENT, template_name TEXT NOT NULL UNIQUE, description TEXT, columns_config TEXT NOT NULL, unique_key_column TEXT, last_run_time TEXT)''')
-    
-    # ISO 50001 相關表格
-    # 1. 儲存迴歸基線的主體資訊 (公式)
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS RegressionBaselines (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            name TEXT NOT NULL UNIQUE,          -- 例如: 114年度 全廠用電基線
-            year INTEGER NOT NULL,              -- 基線對應的年度
-            formula_intercept REAL NOT NULL,    -- 公式的常數項 (截距)
-            formula_r2 REAL,                    -- R 平方值
-            notes TEXT,                         -- 備註事項
-            created_at TEXT DEFAULT CURRENT_TIMESTAMP
-        )
-    ''')
-
-    # 2. 儲存迴歸公式的因子係數
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS RegressionFactors (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            baseline_id INTEGER NOT NULL,
-            factor_name TEXT NOT NULL,          -- 因子名稱 (例如: 工時, 外氣溫度)
-            coefficient REAL NOT NULL,          -- 係數
-            FOREIGN KEY (baseline_id) REFERENCES RegressionBaselines (id) ON DELETE CASCADE
-        )
-    ''')
-
-    # 3. 儲存每個月的實際監測數據 (人工輸入)
-    c.execute('''
-        CREATE TABLE IF NOT EXISTS MonitoredData (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            baseline_id INTEGER NOT NULL,
-            month INTEGER NOT NULL,             -- 1 到 12
-            -- 使用 JSON 儲存所有因子數據, 例如: {"工時": 37808, "外氣溫度": 16}
-            factors_json TEXT NOT NULL,         
-            actual_consumption REAL,            -- 實際能源消耗量
-            UNIQUE (baseline_id, month),
-            FOREIGN KEY (baseline_id) REFERENCES RegressionBaselines (id) ON DELETE CASCADE
-        )
-    ''')
-
-    conn.commit()
-    conn.close()
-
-# --- URL 管理函式 ---
-def get_urls():
-    conn = sqlite3.connect(DB_PATH); conn.row_factory = sqlite3.Row; c = conn.cursor()
-    c.execute("SELECT id, url, description FROM url_list ORDER BY description")
-    urls = c.fetchall(); conn.close(); return urls
-
-def add_url(url, description):
-    if not url: return False, "URL不能為空"
-    conn = sqlite3.connect(DB_PATH); c = conn.cursor()
-    try: c.execute("INSERT INTO url_list (url, description) VALUES (?, ?)", (url, description)); conn.commit(); return True, "URL 已新增"
-    except sqlite3.IntegrityError: return False, "此 URL 已存在"
-    finally: conn.close()
-
-def delete_url(url_id):
-    conn = sqlite3.connect(DB_PATH); c = conn.cursor(); c.execute("DELETE FROM url_list WHERE id = ?", (url_id,)); conn.commit(); conn.close()
-
-def update_url(url_id, url, description):
-    if not url: return False, "URL不能為空"
-    conn = sqlite3.connect(DB_PATH); c = conn.cursor()
-    try: c.execute("UPDATE url_list SET url = ?, description = ? WHERE id = ?", (url, description, url_id)); conn.commit(); return True, "URL 已更新"
-    except sqlite3.IntegrityError: return False, "此 URL 已存在於另一筆記錄中"
-    except Exception as e: conn.rollback(); return False, f"更新時發生錯誤: {e}"
-    finally: conn.close()
-
-# --- 資料範本 (核心功能) ---
-def get_templates():
-    conn = sqlite3.connect(DB_PATH); conn.row_factory = sqlite3.Row; c = conn.cursor()
-    c.execute("SELECT id, template_name, description, unique_key_column, last_run_time FROM data_templates")
-    templates = c.fetchall(); conn.close(); return templates
-
-def get_template_details(template_id):
-    conn = sqlite3.connect(DB_PATH); conn.row_factory = sqlite3.Row; c = conn.cursor()
-    c.execute("SELECT * FROM data_templates WHERE id = ?", (template_id,))
-    template = c.fetchone(); conn.close(); return template
-
-def save_template(template_id, name, desc, columns_config, unique_key):
-    conn = sqlite3.connect(DB_PATH); c = conn.cursor(); config_json = json.dumps(columns_config, ensure_ascii=False)
-    if template_id: c.execute("UPDATE data_templates SET template_name=?, description=?, columns_config=?, unique_key_column=? WHERE id=?", (name, desc, config_json, unique_key, template_id))
-    else: c.execute("INSERT INTO data_templates (template_name, description, columns_config, unique_key_column) VALUES (?, ?, ?, ?)", (name, desc, config_json, unique_key))
-    try:
-        c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name=?", (name,))
-        if not c.fetchone():
-            col_defs = ", ".join([f'"{col["name"]}" TEXT' for col in columns_config if col['type'] != '設備狀態監控'])
-            c.execute(f'CREATE TABLE "{name}" (id INTEGER PRIMARY KEY AUTOINCREMENT, {col_defs})')
-        else:
-            c.execute(f'PRAGMA table_info("{name}")')
-            existing_cols = [row[1] for row in c.fetchall()]
-            for col_def in columns_config:
-                if col_def["type"] == '設備狀態監控': continue
-                if col_def["name"] not in existing_cols: c.execute(f'ALTER TABLE "{name}" ADD COLUMN "{col_def["name"]}" TEXT')
-        conn.commit(); return True, "範本已儲存，資料表結構已同步。"
-    except Exception as e: conn.rollback(); return False, f"儲存範本時發生錯誤: {e}"
-    finally: conn.close()
-
-def delete_template(template_id):
-    conn = sqlite3.connect(DB_PATH); c = conn.cursor(); c.execute("SELECT template_name FROM data_templates WHERE id = ?", (template_id,)); result = c.fetchone()
-    if result: c.execute("DELETE FROM data_templates WHERE id = ?", (template_id,)); c.execute(f'DROP TABLE IF EXISTS "{result[0]}"'); conn.commit()
-    conn.close()
-
-def _execute_db_function(c, function_call, table_name):
-    try:
-        func_name, rest = function_call.split('(', 1); params_str = rest.rsplit(')', 1)[0]; params = eval(f"({params_str})")
-        if not isinstance(params, tuple): params = (params,)
-    except Exception as e: return f"公式語法錯誤: {e}"
-    try:
-        if func_name.strip() == 'get_diff':
-            if len(params) != 2: return "get_diff需要2個參數('欄位名', 行數)"
-            target_column, offset = params
-            if not isinstance(target_column, str) or not target_column.isidentifier(): return "無效的欄位名稱"
-            if not isinstance(offset, int) or offset < 1: return "行數偏移量必須是正整數"
-            limit = offset + 1; query = f'SELECT "{target_column}" FROM "{table_name}" ORDER BY id DESC LIMIT {limit}'; c.execute(query); rows = c.fetchall()
-            if len(rows) < limit: return "0.00"
-            try: latest_value = float(rows[0][0]); previous_value = float(rows[offset][0]); diff = latest_value - previous_value; return f"{diff:+.2f}"
-            except (ValueError, TypeError, IndexError): return "非數值或資料不足"
-        else: return f"未知的資料庫函式: {func_name}"
-    except Exception as e: return f"公式執行錯誤: {e}"
-
-def run_template(template_id, url_map):
-    template_details = get_template_details(template_id)
-    if not template_details: return False, f"找不到範本 ID: {template_id}"
-    table_name = template_details['template_name']; columns_config = json.loads(template_details['columns_config']); monitor_config = next((col for col in columns_config if col['type'] == '設備狀態監控'), None)
-    if monitor_config: return run_monitor_logic(template_id, table_name, monitor_config, url_map)
-    else: return run_standard_logic(template_id, table_name, columns_config, template_details['unique_key_column'], url_map)
-
-def run_monitor_logic(template_id, table_name, config, url_map):
-    try:
-        params = config['value']; url_id = params['url_id']; device_id = params['device_id']; on_val = params['on_val']; off_val = params['off_val']; url, _ = url_map.get(int(url_id), (None, None))
-        if not url: return False, f"監控範本 '{table_name}' 中找不到 URL ID: {url_id}"
-    except (KeyError, ValueError) as e: return False, f"監控範本 '{table_name}' 的設定不完整或格式錯誤: {e}"
-    conn = sqlite3.connect(DB_PATH); conn.row_factory = sqlite3.Row; c = conn.cursor()
-    try:
-        try: resp = requests.get(url, timeout=10); resp.raise_for_status(); current_status = resp.text.strip()
-        except Exception as e: return True, f"範本 '{table_name}' (監控模式) URL抓取失敗: {e}"
-        c.execute(f'SELECT id, end_time FROM "{table_name}" WHERE device_id = ? ORDER BY id DESC LIMIT 1', (device_id,)); last_log = c.fetchone()
-        is_running = (last_log is not None and last_log['end_time'] is None); now_str = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"); log_message = f"範本 '{table_name}' (監控模式) 狀態未變化或無效，無操作。"
-        if current_status == on_val and not is_running: c.execute(f'INSERT INTO "{table_name}" (device_id, start_time) VALUES (?, ?)', (device_id, now_str)); log_message = f"偵測到設備 '{device_id}' 開機，已新增紀錄。"
-        elif current_status == off_val and is_running:
-            c.execute(f'PRAGMA table_info("{table_name}")'); columns_info = c.fetchall(); has_duration_col = any(col['name'] == 'duration_seconds' for col in columns_info)
-            if has_duration_col: c.execute(f"""UPDATE "{table_name}" SET end_time = ?, duration_seconds = CAST(strftime('%s', ?) - strftime('%s', start_time) AS INTEGER) WHERE id = ?""", (now_str, now_str, last_log['id']))
-            else: c.execute(f'UPDATE "{table_name}" SET end_time = ? WHERE id = ?', (now_str, last_log['id']))
-            log_message = f"偵測到設備 '{device_id}' 關機，已更新紀錄。"
-        c.execute("UPDATE data_templates SET last_run_time = ? WHERE id = ?", (now_str, template_id)); conn.commit(); return True, log_message
-    except sqlite3.OperationalError as e: 
-        conn.rollback()
-        if "no such column" in str(e): 
-            return False, f"執行監控範本 '{table_name}' 失敗！\n錯誤: {e}\n\n請檢查資料表是否包含 'device_id', 'start_time', 'end_time' 等必要欄位。"
-        return False, f"執行監控範本 '{table_name}' 時資料庫出錯: {e}"
-    except Exception as e: 
-        conn.rollback()
-        return False, f"執行監控範本 '{table_name}' 時發生未知錯誤: {e}"
-    finally: 
-        conn.close()
-
-def run_standard_logic(template_id, table_name, columns_config, unique_key, url_map):
-    data_row = {}; deferred_db_evals = []
-    for col_def in columns_config:
-        col_name, source_type, source_value = col_def["name"], col_def["type"], col_def["value"]
-        if source_type == "動態公式" and source_value.lower().startswith("db_eval:"): deferred_db_evals.append({'column': col_name, 'formula': source_value}); data_row[col_name] = None; continue
-        if source_type == "URL":
-            try:
-                url_id = int(source_value)
-                url, _ = url_map.get(url_id, (None, None))
-                if not url:
-                    return False, f"在範本 '{table_name}' 中找不到 URL ID: {url_id}"
-                resp = requests.get(url, timeout=15)
-                resp.raise_for_status()
-                data_row[col_name] = resp.text
-            except Exception as e:
-                return False, f"在範本 '{table_name}' 中抓取URL失敗 ({url}): {e}"
-        elif source_type == "靜態值": data_row[col_name] = source_value
-        elif source_type == "動態公式":
-            if source_value.lower() == "now": data_row[col_name] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            elif source_value.lower().startswith("eval:"):
-                try: data_row[col_name] = str(eval(source_value[5:]))
-                except Exception as e: data_row[col_name] = f"公式錯誤: {e}"
-            else: data_row[col_name] = source_value
-    conn = sqlite3.connect(DB_PATH); c = conn.cursor()
-    try:
-        row_id, existing_id = None, None; result = None
-        if unique_key and unique_key in data_row and data_row[unique_key] is not None: c.execute(f'SELECT id FROM "{table_name}" WHERE "{unique_key}" = ?', (data_row[unique_key],)); result = c.fetchone()
-        if result: existing_id = result[0]
-        if existing_id is not None: row_id = existing_id; set_clauses = ", ".join([f'"{k}" = ?' for k in data_row]); c.execute(f'UPDATE "{table_name}" SET {set_clauses} WHERE id = ?', tuple(list(data_row.values()) + [row_id]))
-        else: cols = ", ".join([f'"{k}"' for k in data_row.keys()]); placeholders = ", ".join(["?"] * len(data_row)); c.execute(f'INSERT INTO "{table_name}" ({cols}) VALUES ({placeholders})', tuple(data_row.values())); row_id = c.lastrowid
-        if deferred_db_evals and row_id is not None:
-            update_payload = {}
-            for task in deferred_db_evals: formula_full = task['formula']; function_call = formula_full[8:].strip(); result = _execute_db_function(c, function_call, table_name); update_payload[task['column']] = result
-            if update_payload: set_clauses = ", ".join([f'"{k}" = ?' for k in update_payload.keys()]); c.execute(f'UPDATE "{table_name}" SET {set_clauses} WHERE id = ?', tuple(list(update_payload.values()) + [row_id]))
-        c.execute("UPDATE data_templates SET last_run_time = ? WHERE id = ?", (datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"), template_id)); conn.commit(); return True, f"範本 '{table_name}' 執行成功。"
-    except Exception as e: conn.rollback(); return False, f"執行範本 '{table_name}' 時資料庫出錯: {e}"
-    finally: conn.close()
-
-def get_table_names():
-    conn = sqlite3.connect(DB_PATH); c = conn.cursor(); c.execute("SELECT name FROM sqlite_master WHERE type='table' AND name NOT LIKE 'sqlite_%' ORDER BY name"); tables = [row[0] for row in c.fetchall()]; conn.close(); return tables
-def get_table_data(table_name):
-    conn = sqlite3.connect(DB_PATH); conn.row_factory = sqlite3.Row; c = conn.cursor()
-    try: c.execute(f'PRAGMA table_info("{table_name}")'); columns = [row['name'] for row in c.fetchall()]; c.execute(f'SELECT * FROM "{table_name}"'); rows = c.fetchall(); return columns, rows
-    except sqlite3.OperationalError: return [], []
-    finally: conn.close()
-def clear_table_data(table_name):
-    conn = sqlite3.connect(DB_PATH); c = conn.cursor()
-    try:
-        if not table_name.isidentifier(): return False, "無效的資料表名稱"
-        c.execute(f'DELETE FROM "{table_name}"'); c.execute(f"DELETE FROM sqlite_sequence WHERE name='{table_name}'"); conn.commit(); return True, f"資料表 '{table_name}' 的內容已清空。"
-    except Exception as e: conn.rollback(); return False, f"清空資料表 '{table_name}' 失敗: {e}"
-    finally: conn.close()
 
 class UrlManagerWindow(tk.Toplevel):
     def __init__(self, parent):
@@ -284,11 +64,11 @@ class UrlManagerWindow(tk.Toplevel):
 
 class TemplateEditor(tk.Toplevel):
     def __init__(self, parent_window, app_instance, template_id=None):
-        super().__init__(parent_window); self.transient(parent_window); self.app_instance = app_instance; self.template_id = template_id; self.all_urls = get_urls(); self.url_map = {r['id']: (r['url'], r['description']) for r in self.all_urls}; self.url_display_map = {f"{r['description'] or '無說明'} ({r['url']})": r['id'] for r in self.all_urls}; self.url_display_list = sorted(list(self.url_display_map.keys())); self.title("編輯資料範本"); self.geometry("600x500"); self.columns_data = []; self.setup_widgets();
+        super().__init__(parent_window); self.transient(parent_window); self.app_instance = app_instance; self.template_id = template_id; self.all_urls = get_urls(); self.url_map = {r['id']: (r['url'], r['description']) for r in self.all_urls}; self.url_display_map = {f"{r['description'] or '無說明'} ({r['url']})": r['id'] for r in self.all_urls}; self.url_display_list = sorted(list(self.url_display_map.keys())); self.title("編輯資料範本"); self.geometry("600x530"); self.columns_data = []; self.setup_widgets();
         if self.template_id: self.load_template_data()
         self.grab_set(); self.protocol("WM_DELETE_WINDOW", self.destroy); self.wait_window(self)
     def setup_widgets(self):
-        frm_info = ttk.LabelFrame(self, text="基本資訊"); frm_info.pack(padx=10, pady=10, fill="x"); ttk.Label(frm_info, text="範本/資料表名稱:").grid(row=0, column=0, padx=5, pady=5, sticky="w"); self.ent_name = ttk.Entry(frm_info, width=30); self.ent_name.grid(row=0, column=1, padx=5, pady=5, sticky="ew"); ttk.Label(frm_info, text="說明:").grid(row=1, column=0, padx=5, pady=5, sticky="w"); self.ent_desc = ttk.Entry(frm_info, width=50); self.ent_desc.grid(row=1, column=1, padx=5, pady=5, sticky="ew"); ttk.Label(frm_info, text="唯一鍵 (用於更新):").grid(row=2, column=0, padx=5, pady=5, sticky="w"); self.cmb_unique_key = ttk.Combobox(frm_info, state="readonly"); self.cmb_unique_key.grid(row=2, column=1, padx=5, pady=5, sticky="ew")
+        frm_info = ttk.LabelFrame(self, text="基本資訊"); frm_info.pack(padx=10, pady=10, fill="x"); ttk.Label(frm_info, text="範本/資料表名稱:").grid(row=0, column=0, padx=5, pady=5, sticky="w"); self.ent_name = ttk.Entry(frm_info, width=30); self.ent_name.grid(row=0, column=1, padx=5, pady=5, sticky="ew"); ttk.Label(frm_info, text="說明:").grid(row=1, column=0, padx=5, pady=5, sticky="w"); self.ent_desc = ttk.Entry(frm_info, width=50); self.ent_desc.grid(row=1, column=1, padx=5, pady=5, sticky="ew"); ttk.Label(frm_info, text="唯一鍵 (用於更新):").grid(row=2, column=0, padx=5, pady=5, sticky="w"); self.cmb_unique_key = ttk.Combobox(frm_info, state="readonly"); self.cmb_unique_key.grid(row=2, column=1, padx=5, pady=5, sticky="ew"); ttk.Label(frm_info, text="取樣間隔(秒):").grid(row=3, column=0, padx=5, pady=5, sticky="w"); self.ent_interval = ttk.Entry(frm_info, width=10); self.ent_interval.grid(row=3, column=1, padx=5, pady=5, sticky="w"); ttk.Label(frm_info, text="原始資料保留(天):").grid(row=4, column=0, padx=5, pady=5, sticky="w"); self.ent_retention = ttk.Entry(frm_info, width=10); self.ent_retention.grid(row=4, column=1, padx=5, pady=5, sticky="w")
         frm_cols = ttk.LabelFrame(self, text="欄位定義 (雙擊可編輯)"); frm_cols.pack(padx=10, pady=5, fill="both", expand=True); self.tree = ttk.Treeview(frm_cols, columns=("name", "type", "value"), show="headings"); self.tree.heading("name", text="欄位名稱"); self.tree.heading("type", text="資料來源類型"); self.tree.heading("value", text="來源/內容"); self.tree.column("name", width=120); self.tree.column("type", width=100); self.pack_propagate(False); self.tree.pack(side="left", fill="both", expand=True); self.tree.bind("<Double-1>", self.on_double_click_column)
         frm_col_btns = ttk.Frame(frm_cols); frm_col_btns.pack(side="left", fill="y", padx=5); ttk.Button(frm_col_btns, text="新增欄位", command=self.add_column).pack(pady=2); ttk.Button(frm_col_btns, text="刪除選取", command=self.delete_column).pack(pady=2)
         frm_main_btns = ttk.Frame(self); frm_main_btns.pack(pady=10); ttk.Button(frm_main_btns, text="儲存範本", command=self.save).pack(side="left", padx=10); ttk.Button(frm_main_btns, text="取消", command=self.destroy).pack(side="left", padx=10)
@@ -297,6 +77,8 @@ class TemplateEditor(tk.Toplevel):
         if details['description']: self.ent_desc.insert(0, details['description'])
         self.columns_data = json.loads(details['columns_config']); self.refresh_treeview()
         if details['unique_key_column']: self.cmb_unique_key.set(details['unique_key_column'])
+        if details['sample_interval'] is not None: self.ent_interval.insert(0, f"{details['sample_interval']:g}")
+        if details['retention_days'] is not None: self.ent_retention.insert(0, str(details['retention_days']))
     def refresh_treeview(self):
         self.tree.delete(*self.tree.get_children()); col_names = []
         for i, col in enumerate(self.columns_data):
@@ -305,7 +87,7 @@ class TemplateEditor(tk.Toplevel):
                 try: uid = int(col['value']); url, desc = self.url_map.get(uid, ('unknown_url', '')); display_value = f"{desc or '無說明'} ({url})"
                 except (ValueError, TypeError): display_value = "無效的URL ID"
             elif col['type'] == '設備狀態監控':
-                try: params = col['value']; uid = int(params['url_id']); _, desc = self.url_map.get(uid, ('', '')); display_value = f"監控 '{params['device_id']}' (URL: {desc})"
+                try: params = col['value']; uid = int(params['url_id']); _, desc = self.url_map.get(uid, ('', '')); devices = params['devices'] if 'devices' in params else [params['device_id']]; display_value = f"監控 {len(devices)} 台設備 '{', '.join(d if isinstance(d, str) else d['device_id'] for d in devices)}' (URL: {desc})"
                 except Exception: display_value = "監控設定無效"
             if col['type'] != '設備狀態監控': col_names.append(col['name'])
             self.tree.insert("", "end", iid=i, values=(col['name'], col['type'], display_value))
@@ -327,12 +109,19 @@ class TemplateEditor(tk.Toplevel):
         try: del self.columns_data[int(selected_item[0])]; self.refresh_treeview()
         except (ValueError, IndexError): messagebox.showerror("錯誤", "無法刪除選取的項目，請重試", parent=self)
     def save(self):
-        name, desc, unique_key = self.ent_name.get().strip(), self.ent_desc.get().strip(), self.cmb_unique_key.get().strip()
+        name, desc, unique_key, interval_text = self.ent_name.get().strip(), self.ent_desc.get().strip(), self.cmb_unique_key.get().strip(), self.ent_interval.get().strip()
+        try: sample_interval = float(interval_text) if interval_text else None
+        except ValueError: messagebox.showerror("錯誤", "取樣間隔必須是數字 (秒)，留空則使用預設值。", parent=self); return
+        if sample_interval is not None and sample_interval < 1: messagebox.showerror("錯誤", "取樣間隔必須大於等於 1 秒", parent=self); return
+        retention_text = self.ent_retention.get().strip()
+        try: retention_days = int(retention_text) if retention_text else None
+        except ValueError: messagebox.showerror("錯誤", "原始資料保留天數必須是整數，留空則永久保留。", parent=self); return
+        if retention_days is not None and retention_days < 1: messagebox.showerror("錯誤", "原始資料保留天數必須大於等於 1 天", parent=self); return
         if not name or not name.isidentifier(): messagebox.showerror("錯誤", "範本名稱不正確，只能包含字母、數字和底線，且不能以數字開頭。", parent=self); return
         if not self.columns_data: messagebox.showerror("錯誤", "至少需要定義一個欄位", parent=self); return
         if len([c for c in self.columns_data if c['type'] == '設備狀態監控']) > 1: messagebox.showerror("錯誤", "一個範本中最多只能定義一個 '設備狀態監控' 欄位。", parent=self); return
         if not self.template_id and any(t['template_name'].lower() == name.lower() for t in get_templates()): messagebox.showerror("錯誤", f"範本名稱 '{name}' 已存在", parent=self); return
-        ok, msg = save_template(self.template_id, name, desc, self.columns_data, unique_key)
+        ok, msg = save_template(self.template_id, name, desc, self.columns_data, unique_key, sample_interval, retention_days)
         if ok: messagebox.showinfo("成功", msg, parent=self); self.app_instance.refresh_all(); self.destroy()
         else: messagebox.showerror("失敗", msg, parent=self)
 
@@ -340,14 +129,15 @@ class ColumnDialog(simpledialog.Dialog):
     def __init__(self, parent, title, url_list, editor_parent, initial_data=None):
         self.url_list = url_list; self.editor_parent = editor_parent; self.url_display_map = parent.url_display_map; self.initial_data = initial_data; super().__init__(parent, title)
     def body(self, master):
-        self.result = None; ttk.Label(master, text="欄位名稱:").grid(row=0, sticky="w", padx=5, pady=2); self.ent_name = ttk.Entry(master, width=40); self.ent_name.grid(row=0, column=1, pady=2); ttk.Label(master, text="資料來源類型:").grid(row=1, sticky="w", padx=5, pady=2); self.cmb_type = ttk.Combobox(master, values=["URL", "靜態值", "動態公式", "設備狀態監控"], state="readonly", width=38); self.cmb_type.grid(row=1, column=1, pady=2); self.cmb_type.bind("<<ComboboxSelected>>", self.on_type_change); self.frm_standard = ttk.Frame(master); self.frm_standard.grid(row=2, column=0, columnspan=2, sticky="ew"); self.frm_monitor = ttk.Frame(master); self.lbl_value = ttk.Label(self.frm_standard, text="來源/內容:"); self.lbl_value.grid(row=0, sticky="w", padx=5); self.cmb_url = ttk.Combobox(self.frm_standard, values=self.url_list, state="readonly", width=40); self.ent_value = ttk.Entry(self.frm_standard, width=42)
-        ttk.Label(self.frm_monitor, text="狀態URL:").grid(row=0, column=0, sticky="w", padx=5, pady=3); self.cmb_monitor_url = ttk.Combobox(self.frm_monitor, values=self.url_list, state="readonly", width=38); self.cmb_monitor_url.grid(row=0, column=1, pady=3); ttk.Label(self.frm_monitor, text="設備唯一ID:").grid(row=1, column=0, sticky="w", padx=5, pady=3); self.ent_monitor_device_id = ttk.Entry(self.frm_monitor, width=40); self.ent_monitor_device_id.grid(row=1, column=1, pady=3); ttk.Label(self.frm_monitor, text="開機回傳值:").grid(row=2, column=0, sticky="w", padx=5, pady=3); self.ent_monitor_on_val = ttk.Entry(self.frm_monitor, width=40); self.ent_monitor_on_val.grid(row=2, column=1, pady=3); ttk.Label(self.frm_monitor, text="關機回傳值:").grid(row=3, column=0, sticky="w", padx=5, pady=3); self.ent_monitor_off_val = ttk.Entry(self.frm_monitor, width=40); self.ent_monitor_off_val.grid(row=3, column=1, pady=3); ttk.Label(self.frm_monitor, text="提示: 使用此類型，範本需包含\ndevice_id, start_time, end_time,\nduration_seconds等欄位。", foreground="blue").grid(row=4, column=0, columnspan=2, pady=5)
+        self.result = None; ttk.Label(master, text="欄位名稱:").grid(row=0, sticky="w", padx=5, pady=2); self.ent_name = ttk.Entry(master, width=40); self.ent_name.grid(row=0, column=1, pady=2); ttk.Label(master, text="資料來源類型:").grid(row=1, sticky="w", padx=5, pady=2); self.cmb_type = ttk.Combobox(master, values=["URL", "靜態值", "動態公式", "設備狀態監控"], state="readonly", width=38); self.cmb_type.grid(row=1, column=1, pady=2); self.cmb_type.bind("<<ComboboxSelected>>", self.on_type_change); self.frm_standard = ttk.Frame(master); self.frm_standard.grid(row=2, column=0, columnspan=2, sticky="ew"); self.frm_monitor = ttk.Frame(master); self.lbl_value = ttk.Label(self.frm_standard, text="來源/內容:"); self.lbl_value.grid(row=0, sticky="w", padx=5); self.cmb_url = ttk.Combobox(self.frm_standard, values=self.url_list, state="readonly", width=40); self.ent_value = ttk.Entry(self.frm_standard, width=42); ttk.Label(self.frm_standard, text="儲存型別:").grid(row=1, sticky="w", padx=5, pady=2); self.cmb_dtype = ttk.Combobox(self.frm_standard, values=["自動"] + list(COLUMN_DTYPES), state="readonly", width=38); self.cmb_dtype.grid(row=1, column=1, pady=2); self.cmb_dtype.set("自動")
+        ttk.Label(self.frm_monitor, text="狀態URL:").grid(row=0, column=0, sticky="w", padx=5, pady=3); self.cmb_monitor_url = ttk.Combobox(self.frm_monitor, values=self.url_list, state="readonly", width=38); self.cmb_monitor_url.grid(row=0, column=1, pady=3); ttk.Label(self.frm_monitor, text="設備ID (多台以逗號分隔):").grid(row=1, column=0, sticky="w", padx=5, pady=3); self.ent_monitor_device_id = ttk.Entry(self.frm_monitor, width=40); self.ent_monitor_device_id.grid(row=1, column=1, pady=3); ttk.Label(self.frm_monitor, text="開機回傳值:").grid(row=2, column=0, sticky="w", padx=5, pady=3); self.ent_monitor_on_val = ttk.Entry(self.frm_monitor, width=40); self.ent_monitor_on_val.grid(row=2, column=1, pady=3); ttk.Label(self.frm_monitor, text="關機回傳值:").grid(row=3, column=0, sticky="w", padx=5, pady=3); self.ent_monitor_off_val = ttk.Entry(self.frm_monitor, width=40); self.ent_monitor_off_val.grid(row=3, column=1, pady=3); ttk.Label(self.frm_monitor, text="提示: 使用此類型，範本需包含\ndevice_id, start_time, end_time,\nduration_seconds等欄位。", foreground="blue").grid(row=4, column=0, columnspan=2, pady=5)
         if self.initial_data:
             self.ent_name.insert(0, self.initial_data.get('name', '')); col_type = self.initial_data.get('type', 'URL'); self.cmb_type.set(col_type); value = self.initial_data.get('value', '')
             if col_type == 'URL': display_text = next((text for text, uid in self.url_display_map.items() if str(uid) == value), ""); self.cmb_url.set(display_text)
             elif col_type == '設備狀態監控' and isinstance(value, dict):
-                 url_id = value.get('url_id', ''); display_text = next((text for text, uid in self.url_display_map.items() if str(uid) == str(url_id)), ""); self.cmb_monitor_url.set(display_text); self.ent_monitor_device_id.insert(0, value.get('device_id', '')); self.ent_monitor_on_val.insert(0, value.get('on_val', '255')); self.ent_monitor_off_val.insert(0, value.get('off_val', '0'))
+                 url_id = value.get('url_id', ''); display_text = next((text for text, uid in self.url_display_map.items() if str(uid) == str(url_id)), ""); self.cmb_monitor_url.set(display_text); self.ent_monitor_device_id.insert(0, ", ".join(d if isinstance(d, str) else d['device_id'] for d in value['devices']) if 'devices' in value else value.get('device_id', '')); self.ent_monitor_on_val.insert(0, value.get('on_val', '255')); self.ent_monitor_off_val.insert(0, value.get('off_val', '0'))
             else: self.ent_value.insert(0, value)
+            if self.initial_data.get('dtype') in COLUMN_DTYPES: self.cmb_dtype.set(self.initial_data['dtype'])
         else: self.cmb_type.current(0); self.ent_monitor_on_val.insert(0, '255'); self.ent_monitor_off_val.insert(0, '0')
         self.on_type_change(); return self.ent_name
     def on_type_change(self, event=None):
@@ -372,11 +162,19 @@ class ColumnDialog(simpledialog.Dialog):
         elif col_type == "設備狀態監控":
             url_display = self.cmb_monitor_url.get(); device_id = self.ent_monitor_device_id.get().strip(); on_val = self.ent_monitor_on_val.get().strip(); off_val = self.ent_monitor_off_val.get().strip()
             if not all([url_display, device_id, on_val, off_val]): messagebox.showerror("錯誤", "監控設定的所有欄位都不能為空", parent=self.editor_parent); return
-            value = {"url_id": str(self.url_display_map.get(url_display)), "device_id": device_id, "on_val": on_val, "off_val": off_val}
+            device_ids = [d.strip() for d in device_id.split(',') if d.strip()]; original = self.initial_data.get('value') if self.initial_data and isinstance(self.initial_data.get('value'), dict) else {}
+            if not device_ids or len(set(device_ids)) != len(device_ids): messagebox.showerror("錯誤", "設備ID不能為空或重複", parent=self.editor_parent); return
+            value = {"url_id": str(self.url_display_map.get(url_display)), "device_id": device_ids[0], "on_val": on_val, "off_val": off_val}
+            if len(device_ids) > 1:  # 多台設備由同一個 URL 回傳的 JSON 物件以設備ID讀取狀態；設備ID未變更時保留原本個別設定的 url_id / status_key
+                original_devices = original.get('devices') or []
+                devices = original_devices if [d if isinstance(d, str) else d['device_id'] for d in original_devices] == device_ids else device_ids
+                value = {"url_id": value["url_id"], "on_val": on_val, "off_val": off_val, "devices": devices}
+                if original.get('status_key'): value["status_key"] = original['status_key']
         else:
             value = self.ent_value.get().strip()
             if not value: messagebox.showerror("錯誤", "來源內容不能為空", parent=self.editor_parent); self.ent_value.focus_set(); return
         self.result = {"name": name, "type": col_type, "value": value}
+        if col_type != "設備狀態監控" and self.cmb_dtype.get() in COLUMN_DTYPES: self.result["dtype"] = self.cmb_dtype.get()
 
 # 在 data_collector.py 中，找到 class AnalysisWindow(tk.Toplevel): 並用以下完整內容替換
 
@@ -392,6 +190,8 @@ class AnalysisWindow(tk.Toplevel):
             self.destroy()
             return
 
+        self.analysis_thread = None
+        self.last_result = None  # (查詢參數, 結果)，匯出時若設定相同直接使用
         self.setup_widgets()
         self.grab_set()
         self.wait_window()
@@ -506,7 +306,7 @@ class AnalysisWindow(tk.Toplevel):
         table_name = self.cmb_tables.get()
         if not table_name: return
         try:
-            columns, _ = get_table_data(table_name)
+            columns = get_table_columns(table_name)
             self.cmb_date_col['values'] = columns
             likely_date_cols = [c for c in columns if any(keyword in c.lower() for keyword in ['time', 'date'])]
             if likely_date_cols:
@@ -525,6 +325,7 @@ class AnalysisWindow(tk.Toplevel):
             messagebox.showerror("錯誤", f"讀取資料表欄位失敗: {e}", parent=self)
 
     def _get_analysis_params(self):
+        """讀取介面設定，回傳 (查詢參數, 繪圖資訊)；設定不完整時顯示提示並回傳 None"""
         table = self.cmb_tables.get()
         date_col = self.cmb_date_col.get()
         grouping = self.cmb_grouping.get()
@@ -535,128 +336,101 @@ class AnalysisWindow(tk.Toplevel):
         
         try:
             if grouping.startswith('每日'):
-                sel_date = self.cal_daily.get_date()
-                start_dt = datetime.datetime.combine(sel_date, datetime.time.min)
-                end_dt = datetime.datetime.combine(sel_date, datetime.time.max)
-                group_by_logic = lambda ts: ts.hour
-                index_name = '小時'
+                tier = 'hour'
+                start_dt, end_dt = analysis_query.day_range(self.cal_daily.get_date())
             elif grouping.startswith('月度'):
-                year, month = int(self.spin_month_y.get()), int(self.spin_month_m.get())
-                start_dt = datetime.datetime(year, month, 1)
-                _, last_day = calendar.monthrange(year, month)
-                end_dt = datetime.datetime(year, month, last_day, 23, 59, 59)
-                group_by_logic = lambda ts: ts.day
-                index_name = '日期 (日)'
-            elif grouping.startswith('年度'):
-                year = int(self.spin_year.get())
-                start_dt = datetime.datetime(year, 1, 1)
-                end_dt = datetime.datetime(year, 12, 31, 23, 59, 59)
-                group_by_logic = lambda ts: ts.month
-                index_name = '月份'
+                tier = 'day'
+                start_dt, end_dt = analysis_query.month_range(int(self.spin_month_y.get()), int(self.spin_month_m.get()))
+            else:
+                tier = 'month'
+                start_dt, end_dt = analysis_query.year_range(int(self.spin_year.get()))
         except (ValueError, TypeError) as e:
             messagebox.showerror("錯誤", f"時間選擇無效，請檢查輸入: {e}", parent=self)
             return None
-        
-        conn = sqlite3.connect(DB_NAME)
-        try:
-            query = f'SELECT * FROM "{table}" WHERE "{date_col}" BETWEEN ? AND ?'
-            df = pd.read_sql_query(query, conn, params=(start_dt, end_dt))
-        except Exception as e:
-            messagebox.showerror("資料庫錯誤", f"從資料庫讀取資料失敗: {e}", parent=self)
-            conn.close()
-            return None
-        finally:
-            conn.close()
-
-        if df.empty:
-            messagebox.showinfo("提示", f"在指定的時間範圍 ({start_dt.date()} 至 {end_dt.date()}) 內找不到資料。", parent=self)
-            return None
 
-        try:
-            df[date_col] = pd.to_datetime(df[date_col], errors='coerce')
-            invalid_dates = df[date_col].isnull().sum()
-            if invalid_dates > 0 and invalid_dates < len(df):
-                messagebox.showwarning("資料警告", f"欄位 '{date_col}' 中有 {invalid_dates} 筆資料無法解析為有效日期，已被忽略。", parent=self)
-            if df[date_col].isnull().all():
-                messagebox.showerror("資料格式錯誤", f"您選擇的時間欄位 '{date_col}' 無法被解析為有效的日期時間格式。\n請選擇其他欄位。", parent=self)
-                return None
-            df.dropna(subset=[date_col], inplace=True)
-        except Exception as e:
-            messagebox.showerror("資料處理錯誤", f"無法解析時間欄位 '{date_col}': {e}", parent=self)
-            return None
-
-        agg_dict = {}
-        plot_info = []
+        fields, plot_info = [], []
         for field in self.fields:
-            if field['chk_var'].get():
-                col = field['cmb_col'].get()
-                agg_method = 'sum' if 'Sum' in field['cmb_agg'].get() else 'mean'
-                if col and agg_method:
-                    try:
-                        df[col] = pd.to_numeric(df[col], errors='coerce')
-                        invalid_nums = df[col].isnull().sum()
-                        if invalid_nums > 0 and invalid_nums < len(df):
-                            messagebox.showwarning("資料警告", f"欄位 '{col}' 中有 {invalid_nums} 筆資料無法轉換為數值，已設為 0。", parent=self)
-                        df[col].fillna(0, inplace=True)
-                        agg_dict[col] = agg_method
-                        plot_info.append({'col': col, 'chart_type': field['cmb_chart'].get()})
-                    except Exception as e:
-                        messagebox.showerror("資料處理錯誤", f"無法處理欄位 '{col}': {e}", parent=self)
-                        return None
-        if not agg_dict:
+            if field['chk_var'].get() and field['cmb_col'].get():
+                fields.append((field['cmb_col'].get(), 'SUM' if 'Sum' in field['cmb_agg'].get() else 'AVG'))
+                plot_info.append({'col': field['cmb_col'].get(), 'chart_type': field['cmb_chart'].get(), 'agg_text': field['cmb_agg'].get().split(' ')[0]})
+        if not fields:
             messagebox.showwarning("未選分析欄位", "請至少勾選並設定一個分析欄位。", parent=self)
             return None
+        return (table, date_col, tier, start_dt, end_dt, tuple(fields)), plot_info
 
-        try:
-            df_grouped = df.groupby(df[date_col].dt.floor('S').apply(group_by_logic)).agg(agg_dict)
-            df_grouped = df_grouped.loc[df_grouped.any(axis=1)]
-            
-            if df_grouped.empty:
-                messagebox.showinfo("提示", "在指定時間範圍內，選取的欄位無有效數據可顯示。", parent=self)
-                return None
-            
-            df_grouped.index.name = index_name
-            return df_grouped, plot_info
-        except Exception as e:
-            messagebox.showerror("資料處理錯誤", f"分組與聚合資料時發生錯誤: {e}", parent=self)
-            return None
+    def _run_analysis(self, params, on_done):
+        """在背景執行緒查詢 (SQL 或彙總資料表分組)，完成後於介面執行緒呼叫 on_done(result)"""
+        if self.analysis_thread and self.analysis_thread.is_alive():
+            messagebox.showinfo("提示", "分析查詢進行中，請稍候。", parent=self)
+            return
+        outcome = {}
+
+        def worker():
+            conn = db.connect()
+            try:
+                outcome['result'] = analysis_query.run_analysis(conn, *params[:5], list(params[5]))
+            except Exception as e:
+                outcome['error'] = e
+            finally:
+                conn.close()
+
+        def poll():
+            if self.analysis_thread.is_alive():
+                self.after(100, poll)
+                return
+            self.config(cursor="")
+            if 'error' in outcome:
+                messagebox.showerror("資料庫錯誤", f"分析資料時發生錯誤: {outcome['error']}", parent=self)
+                return
+            result = outcome['result']
+            for warning in result.warnings:
+                messagebox.showwarning("資料警告", warning, parent=self)
+            if not result.rows:
+                start_dt, end_dt = params[3], params[4]
+                messagebox.showinfo("提示", f"在指定的時間範圍 ({start_dt.date()} 至 {(end_dt - datetime.timedelta(seconds=1)).date()}) 內，選取的欄位無有效數據可顯示。", parent=self)
+                return
+            self.last_result = (params, result)
+            on_done(result)
+
+        self.config(cursor="watch")
+        self.analysis_thread = threading.Thread(target=worker, daemon=True)
+        self.analysis_thread.start()
+        self.after(100, poll)
 
     def on_preview_chart(self):
-        result = self._get_analysis_params()
-        if not result:
+        request = self._get_analysis_params()
+        if not request:
             return
-        
-        aggregated_df, plot_info = result
+        params, plot_info = request
+        self._run_analysis(params, lambda result: self._draw_chart(result, plot_info))
+
+    def _draw_chart(self, result, plot_info):
         self.figure.clear()
         self.ax1 = self.figure.add_subplot(111)
         self.ax2 = None
         
-        active_plots_info = [info for info in plot_info if info['col'] in aggregated_df.columns]
-        if len(active_plots_info) > 1:
+        if len(plot_info) > 1:
             self.ax2 = self.ax1.twinx()
 
         colors = ['#1f77b4', '#ff7f0e']
         lines, labels = [], []
         
-        x_ticks = range(len(aggregated_df.index))
-        x_labels = aggregated_df.index.astype(str)
+        x_ticks = range(len(result.labels))
+        x_labels = [str(label) for label in result.labels]
 
-        for i, info in enumerate(active_plots_info):
+        for i, info in enumerate(plot_info):
             ax = self.ax1 if i == 0 else self.ax2
             col_name = info['col']
-            chart_type = info['chart_type']
-            
-            field_widget = next((f for f in self.fields if f['cmb_col'].get() == col_name), self.fields[i])
-            agg_method_text = field_widget['cmb_agg'].get().split(' ')[0]
-            label = f"{col_name} ({agg_method_text})"
+            values = [row[i] for row in result.rows]
+            label = f"{col_name} ({info['agg_text']})"
 
-            if chart_type == '直條圖':
+            if info['chart_type'] == '直條圖':
                 bar_width = 0.4
-                offset = -bar_width/2 if len(active_plots_info) > 1 and i == 0 else bar_width/2 if len(active_plots_info) > 1 else 0
-                bar_container = ax.bar([x + offset for x in x_ticks], aggregated_df[col_name], color=colors[i], alpha=0.7, label=label, width=bar_width)
+                offset = -bar_width/2 if len(plot_info) > 1 and i == 0 else bar_width/2 if len(plot_info) > 1 else 0
+                bar_container = ax.bar([x + offset for x in x_ticks], values, color=colors[i], alpha=0.7, label=label, width=bar_width)
                 lines.append(bar_container[0])
             else:
-                line_plot = ax.plot(x_ticks, aggregated_df[col_name], color=colors[i], marker='o', label=label)
+                line_plot = ax.plot(x_ticks, values, color=colors[i], marker='o', label=label)
                 lines.append(line_plot[0])
             
             labels.append(label)
@@ -665,7 +439,7 @@ class AnalysisWindow(tk.Toplevel):
 
         self.ax1.set_xticks(x_ticks)
         self.ax1.set_xticklabels(x_labels, rotation=45, ha='right')
-        self.ax1.set_xlabel(aggregated_df.index.name or '時間')
+        self.ax1.set_xlabel(result.index_name or '時間')
         
         self.figure.tight_layout(rect=[0, 0, 1, 0.95])
         self.figure.legend(lines, labels, title="圖例", loc='upper right')
@@ -673,29 +447,130 @@ class AnalysisWindow(tk.Toplevel):
         self.canvas.draw()
 
     def on_export_excel(self):
-        result = self._get_analysis_params()
-        if not result:
+        request = self._get_analysis_params()
+        if not request:
             return
-        aggregated_df, _ = result
+        params, plot_info = request
         save_path = filedialog.asksaveasfilename(defaultextension=".xlsx", 
                                                 filetypes=[("Excel 活頁簿", "*.xlsx"), ("所有檔案", "*.*")], 
                                                 title="請選擇儲存位置與檔名")
         if not save_path:
             return
+
+        def export(result):
+            try:
+                self._draw_chart(result, plot_info)
+                img_data = io.BytesIO()
+                self.figure.savefig(img_data, format='png', dpi=300, bbox_inches='tight')
+                img_data.seek(0)
+                analysis_query.export_excel(result, save_path, img_data)
+                messagebox.showinfo("成功", f"報告已成功匯出至:\n{save_path}", parent=self)
+            except Exception as e:
+                messagebox.showerror("匯出失敗", f"匯出 Excel 報告時發生錯誤:\n{e}", parent=self)
+
+        # 設定與上次預覽相同時直接使用預覽的結果，不重新查詢
+        if self.last_result and self.last_result[0] == params:
+            export(self.last_result[1])
+        else:
+            self._run_analysis(params, export)
+
+
+class TablePager:
+    """
+    資料表檢視的分頁視窗：Treeview 只保留目前捲動位置附近最多 MAX_ROWS 筆 (可見範圍加上預載)，
+    捲動接近底部/頂部時以 keyset 分頁 (依 rowid) 向後/向前載入一頁，並捨棄另一端超出的列。
+    收集程式每輪執行後呼叫 append_new，只在已載入到最後一筆時附加 key 大於目前最後一筆的新資料。
+    """
+    MAX_ROWS = 1000
+    PREFETCH_FRACTION = 0.15  # 捲動到距離邊界這個比例內時預先載入下一頁
+
+    def __init__(self, parent):
+        frame = ttk.Frame(parent); frame.pack(fill="both", expand=True, padx=5, pady=5)
+        self.tree = ttk.Treeview(frame, show="headings"); self.scrollbar = ttk.Scrollbar(frame, orient="vertical", command=self.tree.yview)
+        self.tree.configure(yscrollcommand=self.on_scroll); self.tree.pack(side="left", fill="both", expand=True); self.scrollbar.pack(side="right", fill="y")
+        self.lbl_info = ttk.Label(parent, anchor="e"); self.lbl_info.pack(fill="x", padx=5)
+        self.table = None; self.columns = (); self.keys = []; self.at_start = True; self.at_end = True; self.loading = False; self.total = 0
+
+    def clear(self):
+        self.tree.delete(*self.tree.get_children()); self.tree["columns"] = (); self.table = None; self.columns = (); self.keys = []; self.at_start = self.at_end = True; self.total = 0; self.lbl_info.config(text="")
+
+    def load(self, table):
+        """切換或重新載入資料表：顯示第一頁"""
+        self.table = table; self.columns = tuple(get_table_columns(table))
+        self.tree.delete(*self.tree.get_children()); self.tree["columns"] = self.columns; self.keys = []
+        for col in self.columns: self.tree.heading(col, text=col); self.tree.column(col, width=120, anchor="w")
+        page = get_table_page(table, limit=TABLE_PAGE_SIZE); self._insert(page, "end")
+        self.at_start = True; self.at_end = len(page) < TABLE_PAGE_SIZE; self._update_info(refresh_count=True)
+
+    def columns_changed(self, table):
+        return table != self.table or tuple(get_table_columns(table)) != self.columns
+
+    def append_new(self):
+        """只附加 key 大於目前最後一筆的新資料；使用者正在檢視較舊的資料時只更新總筆數"""
+        if not self.table: return
+        if self.at_end:
+            after_key = self.keys[-1] if self.keys else None
+            while True:
+                page = get_table_page(self.table, after_key=after_key, limit=TABLE_PAGE_SIZE)
+                if not page: break
+                follow = self._is_scrolled_to_bottom(); self._insert(page, "end"); after_key = page[-1][0]
+                if follow: self.tree.yview_moveto(1.0)
+                if len(page) < TABLE_PAGE_SIZE: break
+            self._trim("start")
+        self._update_info(refresh_count=True)
+
+    def _insert(self, page, position):
+        if position == "end":
+            for key, row in page: self.tree.insert("", "end", iid=key, values=row)
+            self.keys.extend(key for key, _ in page)
+        else:
+            for index, (key, row) in enumerate(page): self.tree.insert("", index, iid=key, values=row)
+            self.keys[:0] = [key for key, _ in page]
+
+    def _trim(self, side):
+        """視窗超過 MAX_ROWS 時從指定的一端移除多餘的列"""
+        excess = len(self.keys) - self.MAX_ROWS
+        if excess <= 0: return
+        if side == "start": removed, self.keys = self.keys[:excess], self.keys[excess:]; self.at_start = False
+        else: removed, self.keys = self.keys[-excess:], self.keys[:-excess]; self.at_end = False
+        self.tree.delete(*removed)
+
+    def _is_scrolled_to_bottom(self):
+        return self.tree.yview()[1] >= 0.999
+
+    def on_scroll(self, first, last):
+        self.scrollbar.set(first, last)
+        if self.loading or not self.table: return
+        first, last = float(first), float(last)
+        if last >= 1 - self.PREFETCH_FRACTION and not self.at_end: self.tree.after_idle(self._load_next)
+        elif first <= self.PREFETCH_FRACTION and not self.at_start: self.tree.after_idle(self._load_previous)
+
+    def _load_next(self):
+        if self.loading or self.at_end or not self.keys: return
+        self.loading = True
         try:
-            self.on_preview_chart()
-            img_data = io.BytesIO()
-            self.figure.savefig(img_data, format='png', dpi=300, bbox_inches='tight')
-            img_data.seek(0)
-            with pd.ExcelWriter(save_path, engine='openpyxl') as writer:
-                aggregated_df.to_excel(writer, sheet_name='分析數據')
-                ws = writer.sheets['分析數據']
-                img = OpenpyxlImage(img_data)
-                img.anchor = f'A{len(aggregated_df) + 5}'
-                ws.add_image(img)
-            messagebox.showinfo("成功", f"報告已成功匯出至:\n{save_path}", parent=self)
-        except Exception as e:
-            messagebox.showerror("匯出失敗", f"匯出 Excel 報告時發生錯誤:\n{e}", parent=self)
+            anchor = self.tree.yview()[0] * len(self.keys)
+            page = get_table_page(self.table, after_key=self.keys[-1], limit=TABLE_PAGE_SIZE); self._insert(page, "end")
+            self.at_end = len(page) < TABLE_PAGE_SIZE; before = len(self.keys); self._trim("start")
+            if self.keys: self.tree.yview_moveto(max(0.0, anchor - (before - len(self.keys))) / len(self.keys))  # 維持目前看到的列不跳動
+            self._update_info()
+        finally: self.loading = False
+
+    def _load_previous(self):
+        if self.loading or self.at_start or not self.keys: return
+        self.loading = True
+        try:
+            anchor = self.tree.yview()[0] * len(self.keys)
+            page = get_table_page(self.table, before_key=self.keys[0], limit=TABLE_PAGE_SIZE); self._insert(page, "start")
+            self.at_start = len(page) < TABLE_PAGE_SIZE; self._trim("end")
+            if self.keys: self.tree.yview_moveto((anchor + len(page)) / len(self.keys))
+            self._update_info()
+        finally: self.loading = False
+
+    def _update_info(self, refresh_count=False):
+        if refresh_count: self.total = get_table_row_count(self.table)
+        self.lbl_info.config(text=f"已載入 {len(self.keys)} 筆 / 共 {self.total} 筆" + ("" if self.at_end else "  (向下捲動載入更多)"))
+
 class App:
     def __init__(self, root):
         self.root = root; self.root.title("URL 管理與自動抓取工具 v3.9"); self.root.geometry("800x650"); self.auto_run_thread = None; self.stop_auto_run = threading.Event(); self.is_auto_running = False; self.setup_ui(); self.refresh_all(); self.root.protocol("WM_DELETE_WINDOW", self.on_closing)
@@ -706,15 +581,15 @@ class App:
         paned_window.add(frm_templates, weight=2)
         frm_templates.grid_rowconfigure(0, weight=1)
         frm_templates.grid_columnconfigure(0, weight=1)
-        self.tree_templates = ttk.Treeview(frm_templates, show="headings", selectmode="extended"); self.tree_templates["columns"] = ("ID", "範本名稱", "說明", "唯一鍵", "上次執行")
+        self.tree_templates = ttk.Treeview(frm_templates, show="headings", selectmode="extended"); self.tree_templates["columns"] = ("ID", "範本名稱", "說明", "唯一鍵", "取樣間隔", "上次執行")
         for col in self.tree_templates["columns"]: self.tree_templates.heading(col, text=col); self.tree_templates.column(col, anchor="w")
-        self.tree_templates.column("ID", width=40, anchor="center"); self.tree_templates.column("範本名稱", width=150); self.tree_templates.column("說明", width=200); self.tree_templates.column("唯一鍵", width=100);         self.tree_templates.grid(row=0, column=0, sticky="nsew", padx=5, pady=5)
+        self.tree_templates.column("ID", width=40, anchor="center"); self.tree_templates.column("範本名稱", width=150); self.tree_templates.column("說明", width=200); self.tree_templates.column("唯一鍵", width=100); self.tree_templates.column("取樣間隔", width=70, anchor="center");         self.tree_templates.grid(row=0, column=0, sticky="nsew", padx=5, pady=5)
         frm_template_btns = ttk.Frame(frm_templates); frm_template_btns.grid(row=1, column=0, sticky="ew", padx=5, pady=5); ttk.Button(frm_template_btns, text="新增範本", command=self.open_template_editor).pack(side="left"); ttk.Button(frm_template_btns, text="編輯選取", command=self.edit_selected_template).pack(side="left", padx=5); ttk.Button(frm_template_btns, text="執行選取", command=self.run_selected_templates).pack(side="left", padx=5); ttk.Button(frm_template_btns, text="管理 URL", command=self.open_url_manager).pack(side="left", padx=5); ttk.Button(frm_template_btns, text="圖表分析", command=self.open_analysis_window).pack(side="left", padx=5); ttk.Button(frm_template_btns, text="刪除選取", command=self.delete_selected_templates).pack(side="right")
         frm_auto_run = ttk.LabelFrame(frm_templates, text="自動執行設定"); frm_auto_run.grid(row=2, column=0, sticky="ew", padx=5, pady=5); ttk.Label(frm_auto_run, text="間隔(秒):").pack(side="left", padx=(5,0)); self.ent_interval = ttk.Entry(frm_auto_run, width=5); self.ent_interval.insert(0, "60"); self.ent_interval.pack(side="left", padx=(0,10)); self.btn_auto_run = ttk.Button(frm_auto_run, text="開始自動執行", command=self.toggle_auto_run); self.btn_auto_run.pack(side="left"); self.status_label = ttk.Label(frm_auto_run, text="狀態：已停止", anchor="w"); self.status_label.pack(side="left", padx=10, fill="x", expand=True)
         frm_data_view = ttk.LabelFrame(paned_window, text="2. 資料表檢視"); paned_window.add(frm_data_view, weight=3); frm_table_select = ttk.Frame(frm_data_view); frm_table_select.pack(fill="x", padx=5, pady=5); ttk.Label(frm_table_select, text="選擇資料表:").pack(side="left"); self.cmb_tables = ttk.Combobox(frm_table_select, state="readonly", width=30); self.cmb_tables.pack(side="left", padx=5); self.cmb_tables.bind("<<ComboboxSelected>>", lambda e: self.on_load_table()); ttk.Button(frm_table_select, text="刷新列表", command=self.refresh_table_list).pack(side="left"); ttk.Button(frm_table_select, text="刷新內容", command=lambda: self.on_load_table(True)).pack(side="left", padx=5); ttk.Button(frm_table_select, text="清空此表內容", command=self.on_clear_table, style="Danger.TButton").pack(side="right"); style = ttk.Style(); style.configure("Danger.TButton", foreground="red")
-        self.tree_data = ttk.Treeview(frm_data_view, show="headings"); self.tree_data.pack(fill="both", expand=True, padx=5, pady=5)
+        self.table_view = TablePager(frm_data_view)
     def refresh_all(self): self.refresh_template_list(); self.refresh_table_list()
-    def refresh_template_list(self): self.tree_templates.delete(*self.tree_templates.get_children()); [self.tree_templates.insert("", "end", iid=r['id'], values=(r['id'], r['template_name'], r['description'] or "", r['unique_key_column'] or "無", r['last_run_time'] or "從未")) for r in get_templates()]
+    def refresh_template_list(self): self.tree_templates.delete(*self.tree_templates.get_children()); [self.tree_templates.insert("", "end", iid=r['id'], values=(r['id'], r['template_name'], r['description'] or "", r['unique_key_column'] or "無", f"{get_template_interval(r):g}s", r['last_run_time'] or "從未")) for r in get_templates()]
     def refresh_table_list(self):
         current_table = self.cmb_tables.get(); tables = get_table_names(); self.cmb_tables['values'] = tables
         if current_table in tables: self.cmb_tables.set(current_table)
@@ -733,13 +608,13 @@ class App:
         selected = self.tree_templates.selection();
         if not selected: messagebox.showwarning("警告", "請選擇要執行的範本"); return
         if not messagebox.askyesno("確認執行", f"確定要執行選取的 {len(selected)} 個範本嗎？"): return
-        url_map = {r['id']: (r['url'], r['description']) for r in get_urls()}; total = len(selected); success_count, failed_list = 0, []
-        for template_id in selected:
-            template_name = self.tree_templates.item(template_id, 'values')[1]; self.update_status(f"正在執行: {template_name}..."); self.root.update_idletasks()
-            ok, msg = run_template(template_id, url_map)
+        total = len(selected); success_count, failed_list = 0, []
+        self.update_status(f"正在同時執行 {total} 個範本..."); self.root.update_idletasks()
+        for template_id, ok, msg in run_templates(selected):
+            template_name = self.tree_templates.item(template_id, 'values')[1]
             if not ok: failed_list.append(f"{template_name}: {msg}")
             else: success_count += 1
-        self.update_status("手動執行完畢。"); self.refresh_all(); self.on_load_table(True)
+        self.update_status("手動執行完畢。"); self.refresh_all()
         summary = f"執行完畢。\n\n成功: {success_count}/{total} 個範本。"
         if failed_list: summary += "\n\n失敗詳情:\n" + "\n".join(failed_list)
         messagebox.showinfo("執行結果", summary)
@@ -752,17 +627,9 @@ class App:
             messagebox.showinfo("成功", "選取的範本與資料表已刪除"); self.refresh_all()
     def on_load_table(self, force_refresh=False):
         table = self.cmb_tables.get()
-        if not table: self.tree_data.delete(*self.tree_data.get_children()); self.tree_data["columns"] = (); return
-        needs_refresh = force_refresh
-        if not needs_refresh:
-            try:
-                columns, _ = get_table_data(table)
-                if tuple(columns) != self.tree_data['columns']: needs_refresh = True
-            except Exception: needs_refresh = True
-        if needs_refresh:
-            self.tree_data.delete(*self.tree_data.get_children()); columns, rows = get_table_data(table); self.tree_data["columns"] = columns
-            for col in columns: self.tree_data.heading(col, text=col); self.tree_data.column(col, width=120, anchor="w")
-            for row in rows: self.tree_data.insert("", "end", values=tuple(row))
+        if not table: self.table_view.clear(); return
+        if force_refresh or self.table_view.columns_changed(table): self.table_view.load(table)
+        else: self.table_view.append_new()
     def on_clear_table(self):
         table_to_clear = self.cmb_tables.get()
         if not table_to_clear: messagebox.showwarning("警告", "請先選擇一個要清空的資料表。"); return
@@ -773,19 +640,15 @@ class App:
             else: messagebox.showerror("失敗", result_msg)
     def update_status(self, message): self.status_label.config(text=f"狀態：{message}")
     def _auto_run_loop(self, selected_ids, interval_seconds, id_to_name_map):
-        url_map = {r['id']: (r['url'], r['description']) for r in get_urls()}
         while not self.stop_auto_run.is_set():
-            total, success_count = len(selected_ids), 0
-            for template_id in selected_ids:
-                if self.stop_auto_run.is_set(): break
-                template_name = id_to_name_map.get(template_id, f"ID {template_id}"); self.root.after(0, self.update_status, f"自動執行中: {template_name}...")
-                ok, _ = run_template(template_id, url_map); 
-                if ok: success_count += 1
-                time.sleep(0.1)
+            total = len(selected_ids); cycle_start = time.monotonic(); self.root.after(0, self.update_status, f"自動執行中: 同時抓取 {total} 個範本...")
+            results = run_templates(selected_ids); success_count = sum(1 for _, ok, _ in results if ok); failed_names = [id_to_name_map.get(tid, f"ID {tid}") for tid, ok, _ in results if not ok]
             if self.stop_auto_run.is_set(): break
-            next_run_time = datetime.datetime.now() + datetime.timedelta(seconds=interval_seconds); status_msg = f"執行完畢 ({success_count}/{total})。下次執行: {next_run_time.strftime('%H:%M:%S')}"
-            self.root.after(0, self.update_status, status_msg); self.root.after(0, self.refresh_all); self.root.after(0, self.on_load_table, True)
-            if self.stop_auto_run.wait(timeout=interval_seconds): break
+            wait_seconds = max(0.0, interval_seconds - (time.monotonic() - cycle_start))
+            next_run_time = datetime.datetime.now() + datetime.timedelta(seconds=wait_seconds); status_msg = f"執行完畢 ({success_count}/{total})。下次執行: {next_run_time.strftime('%H:%M:%S')}"
+            if failed_names: status_msg += f" 失敗: {', '.join(failed_names)}"
+            self.root.after(0, self.update_status, status_msg); self.root.after(0, self.refresh_all)
+            if self.stop_auto_run.wait(timeout=wait_seconds): break
     def toggle_auto_run(self):
         if self.is_auto_running:
             self.stop_auto_run.set(); self.btn_auto_run.config(state="disabled"); self.update_status("正在停止..."); self.root.after(100, self.check_thread_stopped)
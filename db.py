@@ -0,0 +1,139 @@
+# ems_project/db.py
+# 共用的資料庫存取層：連線池、WAL 日誌模式與 PRAGMA 調校，供 Flask、GUI 與背景收集服務共用
+
+import os
+import sqlite3
+import threading
+import time
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+DB_NAME = "url_manager.db"
+DB_PATH = os.environ.get("EMS_DB_PATH") or os.path.join(BASE_DIR, DB_NAME)
+
+# --- 連線設定 ---
+POOL_MAX_IDLE = 8             # 每個資料庫檔案保留的閒置連線數上限
+BUSY_TIMEOUT_SECONDS = 5      # 等待其他寫入者釋放鎖定的秒數 (sqlite busy_timeout)
+BUSY_RETRIES = 3              # busy_timeout 後仍被鎖定時，整個寫入交易的重試次數
+BUSY_BACKOFF_SECONDS = 0.2    # 重試的起始等待秒數，每次加倍
+
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",        # 讀取不會被寫入阻擋，寫入也不會被讀取阻擋
+    "PRAGMA synchronous=NORMAL",      # WAL 模式下只在 checkpoint 時 fsync
+    "PRAGMA cache_size=-16000",       # 每個連線約 16MB 頁面快取
+    "PRAGMA mmap_size=268435456",     # 以記憶體映射讀取資料庫檔案 (256MB)
+    "PRAGMA temp_store=MEMORY",
+)
+
+
+class PooledConnection(sqlite3.Connection):
+    """close() 時歸還連線池而不是真正關閉；未提交的交易會先回滾"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.pool = None
+        self.idle = False
+
+    def close(self):
+        if self.pool is None:
+            super().close()
+        else:
+            self.pool.release(self)
+
+    def discard(self):
+        """真正關閉連線 (不歸還連線池)"""
+        self.pool = None
+        super().close()
+
+
+class ConnectionPool:
+    """
+    單一資料庫檔案的連線池。
+    Flask 開發伺服器每個請求使用新的執行緒，因此閒置連線由所有執行緒共用，
+    但同一時間一個連線只會借給一個執行緒使用。
+    """
+
+    def __init__(self, path, max_idle=POOL_MAX_IDLE):
+        self.path = path
+        self.max_idle = max_idle
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _open(self):
+        conn = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT_SECONDS, factory=PooledConnection, check_same_thread=False,
+                               isolation_level="IMMEDIATE")
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        conn.pool = self
+        return conn
+
+    def acquire(self):
+        with self._lock:
+            conn = self._idle.pop() if self._idle else None
+        if conn is None:
+            conn = self._open()
+        conn.idle = False
+        return conn
+
+    def release(self, conn):
+        if conn.idle:
+            return
+        try:
+            if conn.in_transaction:
+                conn.rollback()
+            conn.row_factory = None
+        except sqlite3.ProgrammingError:
+            return
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                conn.idle = True
+                self._idle.append(conn)
+                return
+        conn.discard()
+
+    def close_all(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            conn.discard()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def connect(path=None):
+    """
+    從連線池取得連線 (用法與 sqlite3.connect 相同，用完呼叫 close() 歸還)。
+    寫入交易以 BEGIN IMMEDIATE 開始，於第一個寫入語句時即取得寫入鎖，
+    避免 WAL 模式下讀取交易升級為寫入時直接回傳 SQLITE_BUSY。
+    """
+    path = path or DB_PATH
+    with _pools_lock:
+        pool = _pools.get(path)
+        if pool is None:
+            pool = _pools[path] = ConnectionPool(path)
+    return pool.acquire()
+
+
+def close_all():
+    """關閉所有閒置連線 (程式結束時呼叫)"""
+    with _pools_lock:
+        pools = list(_pools.values())
+    for pool in pools:
+        pool.close_all()
+
+
+def is_busy_error(error):
+    message = str(error).lower()
+    return isinstance(error, sqlite3.OperationalError) and ("locked" in message or "busy" in message)
+
+
+def run_with_retry(func, *args, retries=BUSY_RETRIES, **kwargs):
+    """執行一個完整的寫入交易；busy_timeout 後仍被鎖定時依指數退避重試整個交易"""
+    for attempt in range(retries + 1):
+        try:
+            return func(*args, **kwargs)
+        except sqlite3.OperationalError as e:
+            if not is_busy_error(e) or attempt == retries:
+                raise
+            time.sleep(BUSY_BACKOFF_SECONDS * (2 ** attempt))
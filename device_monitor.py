@@ -0,0 +1,171 @@
+# ems_project/device_monitor.py
+# 設備狀態監控：一個範本可同時監控多台設備，共用一個狀態 URL 或各自使用不同的 URL。
+# 各設備是否運轉中 (以及未結束紀錄的 id) 保存在記憶體中，第一次執行時由資料表重建；
+# 每次取樣只在記憶體中比對狀態，只有開機/關機轉換時才讀寫資料庫。
+#
+# 設定格式 (設備狀態監控欄位的 value):
+#   單一設備 (舊格式): {"url_id": "4", "device_id": "卓越烤爐1", "on_val": "255", "off_val": "0"}
+#   多台設備:          {"url_id": "4", "on_val": "255", "off_val": "0",
+#                       "devices": ["AC1", "AC2", {"device_id": "烤爐", "url_id": "5"}, {"device_id": "AC3", "status_key": "ac_3"}]}
+#   字串設備以設備 ID 為鍵，由 URL 回傳的 JSON 物件讀取狀態；物件設備可個別指定 url_id / status_key / on_val / off_val，
+#   未指定 status_key 時整個 URL 回傳內容即為該設備的狀態。
+
+import json
+import threading
+import time
+
+STATE_TTL_SECONDS = 300   # 定期由資料表重新載入狀態，修正其他程序寫入造成的差異
+HEARTBEAT_SECONDS = 60    # 沒有狀態轉換時，最多每隔這麼久更新一次範本的 last_run_time
+
+
+class MonitorConfigError(ValueError):
+    """設備狀態監控設定錯誤 (訊息接在 "監控範本 '名稱' " 之後)"""
+
+
+class Device:
+    def __init__(self, device_id, url, status_key, on_val, off_val):
+        self.device_id = device_id
+        self.url = url
+        self.status_key = status_key
+        self.on_val = on_val
+        self.off_val = off_val
+
+
+def parse_devices(config, url_map):
+    """由一個設備狀態監控欄位的 value 解析出設備列表；URL ID 以 url_map 對照為實際網址"""
+    try:
+        entries = config.get('devices')
+        if entries is None:
+            entries = [{'device_id': config['device_id']}]
+            default_key = None
+        else:
+            default_key = config.get('status_key')
+        devices = []
+        for entry in entries:
+            if isinstance(entry, str):
+                entry = {'device_id': entry, 'status_key': entry}
+            url_id = entry.get('url_id', config.get('url_id'))
+            url, _ = url_map.get(int(url_id), (None, None))
+            if not url:
+                raise MonitorConfigError(f"中找不到 URL ID: {url_id}")
+            devices.append(Device(
+                str(entry['device_id']), url, entry.get('status_key', default_key),
+                str(entry.get('on_val', config.get('on_val'))), str(entry.get('off_val', config.get('off_val')))))
+    except MonitorConfigError:
+        raise
+    except (AttributeError, KeyError, ValueError, TypeError) as e:
+        raise MonitorConfigError(f"的設定不完整或格式錯誤: {e}") from e
+    return devices
+
+
+def check_unique(devices):
+    seen = set()
+    for device in devices:
+        if device.device_id in seen:
+            raise MonitorConfigError(f"的設定不完整或格式錯誤: 設備 ID 重複 '{device.device_id}'")
+        seen.add(device.device_id)
+
+
+def read_statuses(devices, fetch):
+    """
+    fetch(url) 回傳文字 (失敗時拋出例外)；每個 URL 只取用與解析一次。
+    回傳 ({設備 ID: 狀態字串或 None}, [失敗的 URL 訊息])。
+    """
+    texts, parsed, statuses, errors = {}, {}, {}, []
+    for device in devices:
+        if device.url not in texts:
+            try:
+                texts[device.url] = fetch(device.url).strip()
+            except Exception as e:
+                texts[device.url] = None
+                errors.append(f"{device.url}: {e}")
+        text = texts[device.url]
+        if text is None:
+            status = None
+        elif device.status_key is None:
+            status = text
+        else:
+            if device.url not in parsed:
+                try:
+                    data = json.loads(text)
+                except ValueError:
+                    data = None
+                    errors.append(f"{device.url}: 回傳內容不是 JSON 物件")
+                parsed[device.url] = data if isinstance(data, dict) else {}
+            value = parsed[device.url].get(device.status_key)
+            status = None if value is None else str(value).strip()
+        statuses[device.device_id] = status
+    return statuses, errors
+
+
+def find_transitions(devices, statuses, running):
+    """回傳 [(設備, 'on'|'off')]：開機值且目前未運轉、或關機值且目前運轉中的設備"""
+    transitions = []
+    for device in devices:
+        status = statuses.get(device.device_id)
+        is_running = running.get(device.device_id) is not None
+        if status == device.on_val and not is_running:
+            transitions.append((device, 'on'))
+        elif status == device.off_val and is_running:
+            transitions.append((device, 'off'))
+    return transitions
+
+
+class MonitorStates:
+    """
+    {資料表: {設備 ID: 未結束紀錄的 id 或 None}}。
+    寫入提交後才以 confirm() 更新；寫入失敗或資料表被清空/刪除時以 invalidate() 清除，下次重新載入。
+    """
+
+    def __init__(self):
+        self._tables = {}
+        self._lock = threading.Lock()
+
+    def get(self, table_name, device_ids):
+        """快取有效且包含所有設備時回傳 {設備: 紀錄 id 或 None}，否則回傳 None"""
+        with self._lock:
+            entry = self._tables.get(table_name)
+            if entry is None or entry['expires'] <= time.monotonic() or not entry['running'].keys() >= set(device_ids):
+                return None
+            return entry['running']
+
+    def load(self, c, table_name, device_ids):
+        """由資料表讀取每台設備的最後一筆紀錄 (一次查詢)，end_time 為空代表運轉中"""
+        running = dict.fromkeys(device_ids)
+        placeholders = ', '.join('?' * len(device_ids))
+        rows = c.execute(f'''
+            SELECT device_id, id, end_time FROM "{table_name}"
+            WHERE id IN (SELECT MAX(id) FROM "{table_name}" WHERE device_id IN ({placeholders}) GROUP BY device_id)
+        ''', list(device_ids)).fetchall()
+        for device_id, log_id, end_time in rows:
+            running[device_id] = log_id if end_time is None else None
+        with self._lock:
+            previous = self._tables.get(table_name)
+            self._tables[table_name] = {
+                'running': running, 'expires': time.monotonic() + STATE_TTL_SECONDS,
+                'written': previous['written'] if previous else None,
+            }
+        return running
+
+    def heartbeat_due(self, table_name):
+        with self._lock:
+            entry = self._tables.get(table_name)
+            return entry is None or entry['written'] is None or time.monotonic() - entry['written'] >= HEARTBEAT_SECONDS
+
+    def confirm(self, table_name, changes):
+        """提交成功後套用狀態轉換 {設備: 紀錄 id 或 None}，並記錄寫入時間"""
+        with self._lock:
+            entry = self._tables.get(table_name)
+            if entry is not None:
+                entry['running'].update(changes)
+                entry['written'] = time.monotonic()
+
+    def invalidate(self, table_name=None):
+        with self._lock:
+            if table_name is None:
+                self._tables.clear()
+            else:
+                self._tables.pop(table_name, None)
+
+
+states = MonitorStates()
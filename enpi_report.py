@@ -0,0 +1,181 @@
+# ems_project/enpi_report.py
+# EnPI 計算：一次計算多個 EnPI、多個年度。
+# 自動來源依 (來源表, 時間欄位) 分組，同一組的所有分子/分母共用一次分組查詢；
+# 人工數據與目標值各只查詢一次；基線來源的 factors_json 解碼後快取。
+
+import json
+import threading
+import time
+
+import retention
+import rollup
+
+COMPONENTS = ('numerator', 'denominator')
+BASELINE_CACHE_TTL_SECONDS = 300  # 監控數據都經由 API 寫入並主動失效，TTL 只是保險
+
+_baseline_cache = {}
+_baseline_lock = threading.Lock()
+
+
+def invalidate_baseline_data(baseline_id=None):
+    """MonitoredData 寫入後呼叫，清除已解碼的基線數據快取"""
+    with _baseline_lock:
+        if baseline_id is None:
+            _baseline_cache.clear()
+        else:
+            _baseline_cache.pop(int(baseline_id), None)
+
+
+def _year_bounds(start_year, end_year):
+    return f"{int(start_year):04d}-01-01", f"{int(end_year) + 1:04d}-01-01"
+
+
+def _get_baseline_data(conn, baseline_id):
+    """回傳 {(year, month): {欄位: 值}}，欄位包含 actual_consumption 與所有因子"""
+    now = time.monotonic()
+    with _baseline_lock:
+        cached = _baseline_cache.get(baseline_id)
+        if cached and cached[0] > now:
+            return cached[1]
+    data = {}
+    rows = conn.execute("SELECT year, month, actual_consumption, factors_json FROM MonitoredData WHERE baseline_id = ?", (baseline_id,)).fetchall()
+    for year, month, actual, factors_json in rows:
+        values = json.loads(factors_json) if factors_json else {}
+        if actual is not None:
+            values['actual_consumption'] = actual
+        else:
+            values.pop('actual_consumption', None)
+        data[(year, month)] = values
+    with _baseline_lock:
+        _baseline_cache[baseline_id] = (now + BASELINE_CACHE_TTL_SECONDS, data)
+    return data
+
+
+def _auto_spec(definition, prefix):
+    agg = definition.get(f'{prefix}_aggregation')
+    table = definition.get(f'{prefix}_source_table')
+    column = definition.get(f'{prefix}_source_column')
+    time_col = definition.get(f'{prefix}_time_column')
+    if not all([agg, table, column, time_col]):
+        return None
+    return table, time_col, agg.upper(), column
+
+
+def _query_auto_group(conn, table, time_col, aggregates, start, end):
+    """
+    同一來源表/時間欄位的所有聚合一次查詢，回傳 {(聚合, 欄位): {(year, month): 值}}。
+    全部聚合都能由月彙總計算時直接讀彙總表，否則掃描原始資料一次。
+    """
+    aliases = {spec: f"v{i}" for i, spec in enumerate(sorted(aggregates))}
+    use_rollup = (all(agg in rollup.ROLLUP_AGGREGATES and column != time_col for agg, column in aliases)
+                  and rollup.has_rollup(conn, table, time_col))
+    if use_rollup:
+        rows = rollup.query_rollup(conn, table, 'month', start, end, aliases)
+    else:
+        aggregate_specs = [(agg, f'"{column}"', alias) for (agg, column), alias in aliases.items()]
+        rows = retention.aggregate_range(conn, table, time_col, f'substr("{time_col}", 1, 7)', aggregate_specs, start, end)
+    results = {spec: {} for spec in aliases}
+    for row in rows:
+        bucket = row[0]
+        try:
+            key = (int(bucket[:4]), int(bucket[5:7]))
+        except (TypeError, ValueError):
+            continue
+        for index, spec in enumerate(aliases, start=1):
+            results[spec][key] = row[index]
+    return results
+
+
+def compute_components(conn, definitions, start_year, end_year):
+    """
+    計算所有 EnPI 的分子與分母，回傳 {(enpi_id, 'numerator'|'denominator'): {(year, month): 值}}。
+    """
+    start, end = _year_bounds(start_year, end_year)
+    components, auto_groups, manual_keys = {}, {}, {}
+    for definition in definitions:
+        enpi_id = definition['id']
+        for prefix in COMPONENTS:
+            key = (enpi_id, prefix)
+            components[key] = {}
+            source_type = definition.get(f'{prefix}_source_type')
+            if source_type == 'manual':
+                manual_name = definition.get(f'{prefix}_manual_name')
+                if manual_name:
+                    manual_keys.setdefault((enpi_id, manual_name), []).append(key)
+            elif source_type == 'auto':
+                spec = _auto_spec(definition, prefix)
+                if spec:
+                    table, time_col, agg, column = spec
+                    auto_groups.setdefault((table, time_col), {}).setdefault((agg, column), []).append(key)
+            elif source_type == 'baseline':
+                baseline_id = definition.get(f'{prefix}_baseline_id')
+                source_col = definition.get(f'{prefix}_source_column')
+                if baseline_id and source_col:
+                    for (year, month), values in _get_baseline_data(conn, int(baseline_id)).items():
+                        if year is not None and start_year <= year <= end_year and source_col in values:
+                            components[key][(year, month)] = values[source_col]
+
+    if manual_keys:
+        enpi_ids = sorted({enpi_id for enpi_id, _ in manual_keys})
+        rows = conn.execute(f'''
+            SELECT enpi_id, variable_name, year, month, value FROM EnPI_Manual_Data
+            WHERE year BETWEEN ? AND ? AND enpi_id IN ({', '.join('?' * len(enpi_ids))})
+        ''', [start_year, end_year] + enpi_ids).fetchall()
+        for enpi_id, variable_name, year, month, value in rows:
+            for key in manual_keys.get((enpi_id, variable_name), ()):
+                components[key][(year, month)] = value
+
+    for (table, time_col), aggregates in auto_groups.items():
+        for spec, values in _query_auto_group(conn, table, time_col, aggregates, start, end).items():
+            for key in aggregates[spec]:
+                components[key] = values
+    return components
+
+
+def get_targets(conn, enpi_ids, start_year, end_year):
+    """回傳 {(enpi_id, year, month): 目標值}"""
+    if not enpi_ids:
+        return {}
+    rows = conn.execute(f'''
+        SELECT enpi_id, year, month, target_value FROM EnPI_Targets
+        WHERE year BETWEEN ? AND ? AND enpi_id IN ({', '.join('?' * len(enpi_ids))})
+    ''', [start_year, end_year] + list(enpi_ids)).fetchall()
+    return {(enpi_id, year, month): value for enpi_id, year, month, value in rows}
+
+
+def month_report(month, target_value, num_raw, den_raw):
+    """單一月份的報表列：分子/分母皆為數值且分母不為 0 時計算實際 EnPI"""
+    actual_enpi = None
+    try:
+        num_val = float(num_raw) if num_raw is not None else None
+        den_val = float(den_raw) if den_raw is not None else None
+        if num_val is not None and den_val is not None and den_val != 0:
+            actual_enpi = num_val / den_val
+    except (ValueError, TypeError):
+        actual_enpi = None
+    return {
+        "month": month, "month_name": f"{month}月",
+        "target_value": target_value,
+        "numerator_value": num_raw,
+        "denominator_value": den_raw,
+        "actual_enpi": actual_enpi
+    }
+
+
+def build_reports(conn, definitions, start_year, end_year):
+    """
+    回傳 {enpi_id: {year: [12 個月的報表列]}}。
+    所有 EnPI 與年度共用 compute_components 的分組查詢結果。
+    """
+    components = compute_components(conn, definitions, start_year, end_year)
+    targets = get_targets(conn, [d['id'] for d in definitions], start_year, end_year)
+    reports = {}
+    for definition in definitions:
+        enpi_id = definition['id']
+        numerators, denominators = components[(enpi_id, 'numerator')], components[(enpi_id, 'denominator')]
+        reports[enpi_id] = {
+            year: [month_report(month, targets.get((enpi_id, year, month)), numerators.get((year, month)), denominators.get((year, month)))
+                   for month in range(1, 13)]
+            for year in range(start_year, end_year + 1)
+        }
+    return reports
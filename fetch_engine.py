@@ -0,0 +1,87 @@
+# ems_project/fetch_engine.py
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# --- 抓取引擎設定 ---
+MAX_WORKERS = 32          # 同時進行的請求上限 (所有主機合計)
+PER_HOST_LIMIT = 16       # 單一主機同時連線上限，避免對同一台電表/雲端服務灌請求
+STANDARD_TIMEOUT = 15     # 一般範本的 URL 逾時秒數
+MONITOR_TIMEOUT = 10      # 設備狀態監控範本的 URL 逾時秒數
+
+_thread_local = threading.local()
+_host_semaphores = {}
+_host_lock = threading.Lock()
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _get_session():
+    """每個工作執行緒各自持有一個 keep-alive Session，跨抓取週期重複使用連線"""
+    session = getattr(_thread_local, 'session', None)
+    if session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=PER_HOST_LIMIT, pool_maxsize=PER_HOST_LIMIT)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        _thread_local.session = session
+    return session
+
+
+def _get_host_semaphore(url):
+    host = urlsplit(url).netloc.lower()
+    with _host_lock:
+        sem = _host_semaphores.get(host)
+        if sem is None:
+            sem = threading.BoundedSemaphore(PER_HOST_LIMIT)
+            _host_semaphores[host] = sem
+        return sem
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix="fetch")
+        return _executor
+
+
+def fetch_url(url, timeout=STANDARD_TIMEOUT):
+    """抓取單一 URL 並回傳去除前後空白前的原始文字，失敗時拋出例外"""
+    with _get_host_semaphore(url):
+        resp = _get_session().get(url, timeout=timeout)
+        resp.raise_for_status()
+        return resp.text
+
+
+def _fetch_one(url, timeout):
+    try:
+        return True, fetch_url(url, timeout)
+    except Exception as e:
+        return False, str(e)
+
+
+def fetch_all(url_timeouts):
+    """
+    同時抓取多個 URL。
+    url_timeouts: {url: timeout_seconds}，同一 URL 只會被請求一次。
+    回傳 {url: (ok, text 或 錯誤訊息)}。
+    """
+    if not url_timeouts:
+        return {}
+    executor = _get_executor()
+    futures = {url: executor.submit(_fetch_one, url, timeout) for url, timeout in url_timeouts.items()}
+    return {url: future.result() for url, future in futures.items()}
+
+
+def shutdown():
+    """關閉共用的執行緒池 (程式結束時呼叫)"""
+    global _executor
+    with _executor_lock:
+        if _executor is not None:
+            _executor.shutdown(wait=False, cancel_futures=True)
+            _executor = None
@@ -0,0 +1,312 @@
+# ems_project/formula_engine.py
+# db_eval 公式引擎：每個範本的公式只解析一次，get_diff 由記憶體中的環狀緩衝區計算；
+# 補匯入或修復資料時可用視窗 SQL 或 NumPy 一次重算整個衍生欄位
+#
+# 用法:
+#   python formula_engine.py 哈特佛用電            # 以視窗 SQL 重算所有 db_eval 欄位
+#   python formula_engine.py 哈特佛用電 --numpy    # 以 NumPy 計算後批次寫回
+
+import argparse
+import ast
+import json
+import threading
+from collections import deque
+
+import rollup
+
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+
+
+def parse_db_function(function_call):
+    """解析 db_eval 公式 (不含 'db_eval:' 前綴)，回傳 (函式名稱, 參數 tuple)；語法錯誤時拋出例外"""
+    func_name, rest = function_call.split('(', 1)
+    params = ast.literal_eval(f"({rest.rsplit(')', 1)[0]})")
+    if not isinstance(params, tuple):
+        params = (params,)
+    return func_name.strip(), params
+
+
+def validate_get_diff(params):
+    """檢查 get_diff 參數，正確時回傳 None，否則回傳錯誤訊息"""
+    if len(params) != 2:
+        return "get_diff需要2個參數('欄位名', 行數)"
+    target_column, offset = params
+    if not isinstance(target_column, str) or not target_column.isidentifier():
+        return "無效的欄位名稱"
+    if not isinstance(offset, int) or isinstance(offset, bool) or offset < 1:
+        return "行數偏移量必須是正整數"
+    return None
+
+
+def diff_values(latest, previous):
+    """get_diff 的計算規則：兩值相減後取到小數第 2 位，任一值非數值時回傳 None"""
+    latest, previous = rollup.to_number(latest), rollup.to_number(previous)
+    if latest is None or previous is None:
+        return None
+    return round(latest - previous, 2)
+
+
+class Formula:
+    """
+    編譯後的單一 db_eval 公式。
+    error 不為 None 時代表公式本身有誤，每次計算都回傳該錯誤訊息 (與逐筆 eval 時的行為相同)。
+    """
+
+    def __init__(self, column, formula):
+        self.column = column
+        self.formula = formula
+        self.source = None
+        self.offset = None
+        self.error = None
+        try:
+            func_name, params = parse_db_function(formula[8:].strip())
+        except Exception as e:
+            self.error = f"公式語法錯誤: {e}"
+            return
+        if func_name != 'get_diff':
+            self.error = f"未知的資料庫函式: {func_name}"
+            return
+        self.error = validate_get_diff(params)
+        if self.error is None:
+            self.source, self.offset = params
+
+    def evaluate_sql(self, c, table_name, order_column=None):
+        """直接查詢資料庫計算 (緩衝區無法使用時的備援)；目前的列必須已寫入"""
+        if self.error:
+            return self.error
+        order_sql = f'"{order_column}" DESC, id DESC' if order_column else 'id DESC'
+        try:
+            rows = c.execute(f'SELECT "{self.source}" FROM "{table_name}" ORDER BY {order_sql} LIMIT {self.offset + 1}').fetchall()
+        except Exception as e:
+            return f"公式執行錯誤: {e}"
+        if len(rows) <= self.offset:
+            return 0.0
+        return diff_values(rows[0][0], rows[self.offset][0])
+
+
+class TemplateFormulas:
+    """
+    單一範本的所有 db_eval 公式與 get_diff 來源欄位的環狀緩衝區。
+    緩衝區保存依 (時間, id) 排序的最後 N 筆來源值；每次新增一列時先確認自上次以來沒有其他寫入
+    (id 區間內只有上次記錄的那一列)，確認通過才由記憶體計算，否則改為查詢資料庫並於下次重新載入。
+    """
+
+    def __init__(self, table_name, columns_config, time_column=None):
+        self.table_name = table_name
+        self.columns_config = columns_config
+        self.time_column = time_column
+        self.formulas = [Formula(col['name'], str(col['value'])) for col in columns_config
+                         if col['type'] == '動態公式' and str(col['value']).lower().startswith('db_eval:')]
+        depth = {}
+        for formula in self.formulas:
+            if formula.error is None:
+                depth[formula.source] = max(depth.get(formula.source, 0), formula.offset)
+        self.depth = depth
+        self.lock = threading.Lock()
+        self._buffers = None    # {來源欄位: deque}
+        self._last_id = None    # 載入/確認時資料表中最大的 id
+        self._last_time = None  # 緩衝區最後一筆的時間
+        self._pending = None    # 尚未確認提交的新列 (id, 時間)
+
+    def invalidate(self):
+        with self.lock:
+            self._reset()
+
+    def _reset(self):
+        self._buffers = None
+        self._last_id = None
+        self._last_time = None
+        self._pending = None
+
+    def _seed(self, c, row_id):
+        """由資料庫載入新列之前的最後 N 筆來源值"""
+        sources = list(self.depth)
+        time_sql = f'"{self.time_column}"' if self.time_column else 'NULL'
+        order_sql = f'"{self.time_column}" DESC, id DESC' if self.time_column else 'id DESC'
+        source_sql = ', '.join(f'"{source}"' for source in sources)
+        rows = c.execute(f'SELECT {time_sql}, {source_sql} FROM "{self.table_name}" WHERE id <> ? ORDER BY {order_sql} LIMIT {max(self.depth.values())}', (row_id,)).fetchall()
+        rows.reverse()
+        self._buffers = {source: deque((row[1 + i] for row in rows), maxlen=self.depth[source]) for i, source in enumerate(sources)}
+        self._last_time = rows[-1][0] if rows else None
+        self._last_id = c.execute(f'SELECT MAX(id) FROM "{self.table_name}" WHERE id <> ?', (row_id,)).fetchone()[0]
+
+    def _buffer_usable(self, c, row_id, time_value):
+        if self._buffers is None:
+            self._seed(c, row_id)
+        elif self._last_id is None:
+            if c.execute(f'SELECT 1 FROM "{self.table_name}" WHERE id < ? LIMIT 1', (row_id,)).fetchone():
+                return False
+        elif self._last_id >= row_id or c.execute(f'SELECT COUNT(*) FROM "{self.table_name}" WHERE id >= ? AND id < ?', (self._last_id, row_id)).fetchone()[0] != 1:
+            return False  # 上次之後有其他寫入 (或最後一列已被刪除)
+        if not self.time_column or self._last_time is None:
+            return True
+        return time_value is not None and time_value >= self._last_time  # 新列必須是時間上最新的一筆
+
+    def evaluate(self, c, row_id, data_row, appended=True):
+        """
+        計算所有 db_eval 欄位，回傳 {欄位: 結果}。
+        appended=False (唯一鍵就地更新) 時一律查詢資料庫。結果寫入並提交後須呼叫 confirm()。
+        """
+        with self.lock:
+            self._pending = None
+            time_value = data_row.get(self.time_column) if self.time_column else None
+            usable = False
+            if appended and self.depth:
+                try:
+                    usable = self._buffer_usable(c, row_id, time_value)
+                except Exception:
+                    usable = False
+            if not usable:
+                self._reset()
+                return {f.column: f.evaluate_sql(c, self.table_name, self.time_column) for f in self.formulas}
+            results = {}
+            for formula in self.formulas:
+                if formula.error:
+                    results[formula.column] = formula.error
+                    continue
+                buffer = self._buffers[formula.source]
+                if len(buffer) < formula.offset:
+                    results[formula.column] = 0.0
+                else:
+                    results[formula.column] = diff_values(data_row.get(formula.source), buffer[-formula.offset])
+            self._pending = (row_id, time_value)
+            return results
+
+    def confirm(self, data_row):
+        """新列 (含 db_eval 結果) 已提交後，將來源值加入緩衝區"""
+        with self.lock:
+            if self._pending is None or self._buffers is None:
+                return
+            for source, buffer in self._buffers.items():
+                buffer.append(data_row.get(source))
+            self._last_id, self._last_time = self._pending
+            self._pending = None
+
+
+_engines = {}
+_engines_lock = threading.Lock()
+
+
+def get_formulas(table_name, columns_config, time_column=None):
+    """取得範本的已編譯公式；範本設定改變時自動重新編譯"""
+    with _engines_lock:
+        engine = _engines.get(table_name)
+        if engine is None or engine.columns_config != columns_config or engine.time_column != time_column:
+            engine = _engines[table_name] = TemplateFormulas(table_name, columns_config, time_column)
+        return engine
+
+
+def invalidate(table_name=None):
+    """資料表被批次寫入、清空或刪除後呼叫，下次計算時重新由資料庫載入緩衝區"""
+    with _engines_lock:
+        engines = list(_engines.values()) if table_name is None else [_engines[table_name]] if table_name in _engines else []
+    for engine in engines:
+        engine.invalidate()
+
+
+# --- 批次重算 ---
+
+def _recompute_range(c, table_name, order_column, offset, since):
+    """回傳 (計算範圍的 SQL 條件, 參數)：從 since 往前多取 offset 筆作為前值"""
+    if since is None or not order_column:
+        return '', []
+    row = c.execute(f'SELECT "{order_column}" FROM "{table_name}" WHERE "{order_column}" < ? ORDER BY "{order_column}" DESC, id DESC LIMIT 1 OFFSET ?', (since, offset - 1)).fetchone()
+    return (f' WHERE "{order_column}" >= ?', [row[0]]) if row else ('', [])
+
+
+def _recompute_sql(c, table_name, formula, order_column, dtype, since):
+    range_sql, params = _recompute_range(c, table_name, order_column, formula.offset, since)
+    order_sql = f'"{order_column}", id' if order_column else 'id'
+    value_sql = rollup.num_sql(formula.source)
+    diff_sql = f'ROUND({value_sql} - LAG({value_sql}, {formula.offset}) OVER w, 2)'
+    if dtype == 'INTEGER':
+        diff_sql = f'CAST(ROUND({diff_sql}) AS INTEGER)'
+    update_sql = f'''
+        UPDATE "{table_name}" SET "{formula.column}" = d.diff
+        FROM (
+            SELECT id, CASE WHEN LAG(id, {formula.offset}) OVER w IS NULL THEN 0.0 ELSE {diff_sql} END AS diff
+            FROM "{table_name}"{range_sql}
+            WINDOW w AS (ORDER BY {order_sql})
+        ) AS d
+        WHERE "{table_name}".id = d.id
+    '''
+    if range_sql:
+        update_sql += f' AND "{table_name}"."{order_column}" >= ?'
+        params.append(since)
+    c.execute(update_sql, params)
+
+
+def _recompute_numpy(c, table_name, formula, order_column, dtype, since):
+    range_sql, params = _recompute_range(c, table_name, order_column, formula.offset, since)
+    order_sql = f'"{order_column}", id' if order_column else 'id'
+    time_sql = f'"{order_column}"' if order_column else 'NULL'
+    rows = c.execute(f'SELECT id, {time_sql}, {rollup.num_sql(formula.source)} FROM "{table_name}"{range_sql} ORDER BY {order_sql}', params).fetchall()
+    if not rows:
+        return
+    values = np.array([np.nan if row[2] is None else row[2] for row in rows], dtype=float)
+    diffs = np.zeros(len(values))
+    if len(values) > formula.offset:
+        diffs[formula.offset:] = np.round(values[formula.offset:] - values[:-formula.offset], 2)
+    if dtype == 'INTEGER':
+        updates = [(None if np.isnan(d) else int(round(d)), row[0]) for d, row in zip(diffs, rows) if not range_sql or row[1] >= since]
+    else:
+        updates = [(None if np.isnan(d) else float(d), row[0]) for d, row in zip(diffs, rows) if not range_sql or row[1] >= since]
+    c.executemany(f'UPDATE "{table_name}" SET "{formula.column}" = ? WHERE id = ?', updates)
+
+
+def recompute(c, table_name, formulas, dtypes=None, since=None, method='sql'):
+    """
+    一次重算資料表的所有 get_diff 衍生欄位 (依時間欄位再依 id 排序)。
+    since 為最早被影響的時間，只更新該時間之後的列；method 為 'sql' (視窗函式) 或 'numpy'。
+    """
+    if method == 'numpy' and not NUMPY_AVAILABLE:
+        raise RuntimeError("需要安裝 numpy 才能使用 NumPy 模式")
+    rollup.register_functions(c.connection)
+    runner = _recompute_numpy if method == 'numpy' else _recompute_sql
+    for formula in formulas.formulas:
+        if formula.error is None:
+            runner(c, table_name, formula, formulas.time_column, (dtypes or {}).get(formula.column), since)
+    invalidate(table_name)
+
+
+def main():
+    import db
+    from collector_core import bump_data_version, get_template_dtypes, get_template_time_columns
+
+    parser = argparse.ArgumentParser(description="重算範本資料表的 db_eval 衍生欄位")
+    parser.add_argument("template", help="範本名稱")
+    parser.add_argument("--numpy", action="store_true", help="以 NumPy 計算後批次寫回 (預設使用視窗 SQL)")
+    parser.add_argument("--since", help="只重算此時間之後的列 (YYYY-MM-DD HH:MM:SS)")
+    args = parser.parse_args()
+
+    conn = db.connect()
+    try:
+        row = conn.execute("SELECT columns_config FROM data_templates WHERE template_name = ?", (args.template,)).fetchone()
+        if not row:
+            print(f"找不到範本: {args.template}")
+            return
+        columns_config = json.loads(row[0])
+        time_columns = get_template_time_columns(columns_config)
+        formulas = get_formulas(args.template, columns_config, time_columns[0] if time_columns else None)
+        if not formulas.formulas:
+            print(f"範本 '{args.template}' 沒有 db_eval 欄位。")
+            return
+        recompute(conn.cursor(), args.template, formulas, get_template_dtypes(columns_config), args.since, 'numpy' if args.numpy else 'sql')
+        time_column = formulas.time_column
+        columns = rollup.get_rollup_columns(columns_config)
+        if time_column and columns and rollup.has_rollup(conn, args.template, time_column):
+            start = rollup.month_bounds(args.since)[0] if args.since else None
+            rollup.rebuild_rollups(conn.cursor(), args.template, time_column, columns, start)
+        bump_data_version(conn.cursor(), args.template)
+        conn.commit()
+        print(f"範本 '{args.template}' 的 {len(formulas.formulas)} 個 db_eval 欄位已重算。")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
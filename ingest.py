@@ -0,0 +1,325 @@
+# ems_project/ingest.py
+# 大量匯入歷史資料 (CSV / JSON lines) 至範本資料表
+#
+# 用法:
+#   python ingest.py 哈特佛用電 export.csv
+#   python ingest.py 11 history.ndjson --format ndjson
+#   type export.csv | python ingest.py 哈特佛用電 -
+
+import argparse
+import csv
+import datetime
+import io
+import json
+import re
+import sys
+import time
+
+import db
+import rollup
+import formula_engine
+from collector_core import coerce_value, ensure_time_index, get_template_dtypes, get_template_time_columns, is_monitor_template, touch_template
+
+BATCH_SIZE = 50000      # 每個交易寫入的筆數
+SQL_PARAM_LIMIT = 900   # 單一 IN (...) 查詢的參數上限
+MAX_REPORTED_ERRORS = 20
+
+CANONICAL_TIME = re.compile(r'^(\d{4})[-/](\d{2})[-/](\d{2})[ T](\d{2}):(\d{2})(?::(\d{2}))?$')
+TIME_FORMATS = ('%Y-%m-%d %H:%M:%S', '%Y-%m-%d %H:%M', '%Y/%m/%d %H:%M:%S', '%Y/%m/%d %H:%M', '%Y-%m-%d', '%Y/%m/%d')
+
+
+class IngestError(Exception):
+    """範本不存在或不支援匯入"""
+
+
+def normalize_timestamp(value):
+    """將各種常見時間格式轉為 'YYYY-MM-DD HH:MM:SS'，無法解析時回傳 None"""
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return datetime.datetime.fromtimestamp(value).strftime('%Y-%m-%d %H:%M:%S')
+    text = str(value).strip()
+    if not text:
+        return None
+    match = CANONICAL_TIME.match(text)
+    if match:  # 常見格式直接重組字串，不經過 strptime
+        return f"{match[1]}-{match[2]}-{match[3]} {match[4]}:{match[5]}:{match[6] or '00'}"
+    for fmt in TIME_FORMATS:
+        try:
+            return datetime.datetime.strptime(text, fmt).strftime('%Y-%m-%d %H:%M:%S')
+        except ValueError:
+            continue
+    try:
+        parsed = datetime.datetime.fromisoformat(text.replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone().replace(tzinfo=None)
+    return parsed.strftime('%Y-%m-%d %H:%M:%S')
+
+
+def _check_utf8(text):
+    """串流以 surrogateescape 讀取，無效的 UTF-8 位元組會成為代理字元；在此轉為該筆資料的錯誤"""
+    try:
+        text.encode('utf-8')
+    except UnicodeEncodeError:
+        raise ValueError("包含無效的 UTF-8 位元組") from None
+    return text
+
+
+def read_csv(stream):
+    """逐列讀取 CSV (第一列為欄位名稱)"""
+    yield from csv.DictReader(stream)
+
+
+def decode_csv(row):
+    for value in row.values():
+        if isinstance(value, str):
+            _check_utf8(value)
+    return row
+
+
+def read_ndjson(stream):
+    """逐列讀取 JSON lines (每行一個物件)；空白行略過，解析在 decode_ndjson 進行"""
+    for line in stream:
+        line = line.strip()
+        if line:
+            yield line
+
+
+def decode_ndjson(line):
+    record = json.loads(_check_utf8(line))
+    if not isinstance(record, dict):
+        raise ValueError("每行必須是 JSON 物件")
+    return record
+
+
+READERS = {'csv': (read_csv, decode_csv), 'ndjson': (read_ndjson, decode_ndjson)}
+
+
+def _load_template(conn, template):
+    column = 'id' if str(template).isdigit() else 'template_name'
+    row = conn.execute(f"SELECT id, template_name, columns_config, unique_key_column FROM data_templates WHERE {column} = ?", (template,)).fetchone()
+    if not row:
+        raise IngestError(f"找不到範本: {template}")
+    columns_config = json.loads(row[2])
+    if is_monitor_template(columns_config):
+        raise IngestError(f"範本 '{row[1]}' 為設備狀態監控範本，不支援大量匯入")
+    return row[0], row[1], columns_config, row[3]
+
+
+class _Plan:
+    """由範本設定整理出的匯入規則"""
+
+    def __init__(self, table_name, columns_config, unique_key):
+        self.dtypes = get_template_dtypes(columns_config)
+        time_columns = get_template_time_columns(columns_config)
+        self.time_col = time_columns[0] if time_columns else None
+        self.unique_key = unique_key or None
+        self.static = {}
+        self.formulas = formula_engine.get_formulas(table_name, columns_config, self.time_col)
+        for formula in self.formulas.formulas:
+            if formula.error:
+                raise IngestError(f"欄位 '{formula.column}' 的公式無法批次計算: {formula.error}")
+        derived = {formula.column for formula in self.formulas.formulas}
+        self.columns = []  # 由匯入資料寫入的欄位 (不含 db_eval 衍生欄位)
+        for col_def in columns_config:
+            name, source_type, value = col_def['name'], col_def['type'], str(col_def.get('value', ''))
+            if name in derived:
+                continue
+            if source_type == '靜態值':
+                self.static[name] = value
+            self.columns.append(name)
+        self.rollup_columns = rollup.get_rollup_columns(columns_config)
+
+        self.fields = [(name, self.dtypes.get(name, 'TEXT'), self.static.get(name)) for name in self.columns]
+        self.time_index = self.columns.index(self.time_col) if self.time_col in self.columns else None
+
+    def convert(self, record):
+        """將一筆匯入資料轉為寫入值 tuple；資料不正確時拋出 ValueError"""
+        values = []
+        for name, dtype, static in self.fields:
+            raw = record.get(name)
+            if static is not None and raw in (None, ''):
+                raw = static
+            if dtype == 'TIMESTAMP':
+                value = normalize_timestamp(raw)
+                if raw not in (None, '') and value is None:
+                    raise ValueError(f"無法解析時間 '{raw}' ({name})")
+            else:
+                value = coerce_value(raw if raw != '' else None, dtype)
+            values.append(value)
+        if self.time_index is not None and values[self.time_index] is None:
+            raise ValueError(f"缺少時間欄位 '{self.time_col}'")
+        return tuple(values)
+
+
+def _existing_ids(c, table_name, plan, keys):
+    """回傳 {唯一鍵值: (id, 舊時間)}"""
+    found = {}
+    keys = list(keys)
+    time_sql = f', "{plan.time_col}"' if plan.time_col else ', NULL'
+    for i in range(0, len(keys), SQL_PARAM_LIMIT):
+        chunk = keys[i:i + SQL_PARAM_LIMIT]
+        placeholders = ', '.join('?' * len(chunk))
+        for row_id, key, old_time in c.execute(f'SELECT id, "{plan.unique_key}"{time_sql} FROM "{table_name}" WHERE "{plan.unique_key}" IN ({placeholders})', chunk):
+            found[key] = (row_id, old_time)
+    return found
+
+
+def _write_batch(c, table_name, plan, batch, stats):
+    """寫入一批資料，回傳本批涉及的時間值 (含被覆蓋列的舊時間)"""
+    cols = ', '.join(f'"{name}"' for name in plan.columns)
+    insert_sql = f'INSERT INTO "{table_name}" ({cols}) VALUES ({", ".join("?" * len(plan.columns))})'
+    touched_times = []
+    if plan.time_index is not None:
+        touched_times.extend(values[plan.time_index] for values in batch)
+    if not plan.unique_key:
+        c.executemany(insert_sql, batch)
+        stats['inserted'] += len(batch)
+        return touched_times
+    # 唯一鍵：同一批內以最後一筆為準，已存在的鍵更新原列，其餘新增
+    key_index = plan.columns.index(plan.unique_key)
+    latest, inserts = {}, []
+    for values in batch:
+        if values[key_index] is None:
+            inserts.append(values)
+        else:
+            latest[values[key_index]] = values
+    stats['duplicates'] += len(batch) - len(latest) - len(inserts)
+    existing = _existing_ids(c, table_name, plan, latest)
+    set_clause = ', '.join(f'"{name}" = ?' for name in plan.columns)
+    updates = [values + (existing[key][0],) for key, values in latest.items() if key in existing]
+    inserts.extend(values for key, values in latest.items() if key not in existing)
+    if updates:
+        c.executemany(f'UPDATE "{table_name}" SET {set_clause} WHERE id = ?', updates)
+        touched_times.extend(old_time for _, old_time in existing.values())
+    if inserts:
+        c.executemany(insert_sql, inserts)
+    stats['updated'] += len(updates)
+    stats['inserted'] += len(inserts)
+    return touched_times
+
+
+def _refresh_derived(conn, template_id, table_name, plan, touched_times):
+    """以視窗 SQL 重算 get_diff 欄位、重建受影響月份的彙總資料並更新資料版本"""
+    c = conn.cursor()
+    touched_times = [t for t in touched_times if t]
+    since = min(touched_times) if touched_times else None
+    formula_engine.recompute(c, table_name, plan.formulas, plan.dtypes, since)
+    if plan.time_col and plan.rollup_columns and touched_times and rollup.has_rollup(conn, table_name, plan.time_col):
+        start, _ = rollup.month_bounds(since)
+        _, end = rollup.month_bounds(max(touched_times))
+        rollup.rebuild_rollups(c, table_name, plan.time_col, plan.rollup_columns, start, end)
+    touch_template(c, template_id)  # 更新資料版本，讓儀表板快取失效
+    conn.commit()
+
+
+def ingest_records(template, records, batch_size=BATCH_SIZE, progress=None, decode=None):
+    """
+    將一連串資料 (dict，鍵為欄位名稱) 匯入範本資料表；有 decode 時先以 decode 將每筆原始資料轉為 dict。
+    每 batch_size 筆以 executemany 在同一交易寫入；設有唯一鍵的範本會更新既有列。
+    無法解析或轉換的資料計入 skipped。全部寫入後 (或中途發生例外時，只要已有批次寫入)
+    以視窗 SQL 一次重算 get_diff 欄位並重建受影響月份的彙總資料。
+    回傳統計 {'table', 'inserted', 'updated', 'duplicates', 'skipped', 'errors', 'seconds'}。
+    """
+    started = time.perf_counter()
+    conn = db.connect()
+    try:
+        template_id, table_name, columns_config, unique_key = _load_template(conn, template)
+        plan = _Plan(table_name, columns_config, unique_key)
+        if plan.unique_key and plan.unique_key not in plan.columns:
+            raise IngestError(f"唯一鍵 '{plan.unique_key}' 不是可匯入的欄位")
+        c = conn.cursor()
+        if plan.unique_key:  # 每批以 IN (...) 查找既有的鍵，沒有索引時每批都會掃描整張表
+            ensure_time_index(c, table_name, plan.unique_key)
+            conn.commit()
+        stats = {'table': table_name, 'inserted': 0, 'updated': 0, 'duplicates': 0, 'skipped': 0, 'errors': []}
+        batch, touched_times = [], []
+        committed = False
+
+        def flush():
+            nonlocal committed
+            times = _write_batch(c, table_name, plan, batch, stats)
+            conn.commit()
+            committed = True
+            touched_times.extend(times)
+            formula_engine.invalidate(table_name)
+            batch.clear()
+            if progress:
+                progress(stats)
+
+        try:
+            for line_no, record in enumerate(records, start=1):
+                try:
+                    batch.append(plan.convert(decode(record) if decode else record))
+                except (ValueError, TypeError, AttributeError) as e:
+                    stats['skipped'] += 1
+                    if len(stats['errors']) < MAX_REPORTED_ERRORS:
+                        stats['errors'].append(f"第 {line_no} 筆: {e}")
+                    continue
+                if len(batch) >= batch_size:
+                    flush()
+            if batch:
+                flush()
+        finally:
+            if committed:  # 已寫入的批次不會復原，中途失敗時也要讓衍生欄位與彙總資料保持一致
+                conn.rollback()
+                _refresh_derived(conn, template_id, table_name, plan, touched_times)
+        stats['seconds'] = round(time.perf_counter() - started, 2)
+        return stats
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+
+
+def ingest_stream(template, stream, fmt='csv', batch_size=BATCH_SIZE, progress=None):
+    """由文字串流匯入；fmt 為 'csv' 或 'ndjson'。無效的 UTF-8 位元組只會讓該筆資料被略過"""
+    if fmt not in READERS:
+        raise IngestError(f"不支援的格式: {fmt}")
+    if hasattr(stream, 'reconfigure'):
+        stream.reconfigure(errors='surrogateescape')
+    reader, decode = READERS[fmt]
+    return ingest_records(template, reader(stream), batch_size, progress, decode)
+
+
+def detect_format(filename, content_type=''):
+    """依副檔名或 Content-Type 判斷格式"""
+    lowered = (filename or '').lower()
+    if lowered.endswith(('.ndjson', '.jsonl', '.json')) or 'json' in (content_type or ''):
+        return 'ndjson'
+    return 'csv'
+
+
+def main():
+    parser = argparse.ArgumentParser(description="大量匯入歷史資料至範本資料表")
+    parser.add_argument("template", help="範本名稱或 ID")
+    parser.add_argument("file", help="CSV 或 JSON lines 檔案路徑 ('-' 代表標準輸入)")
+    parser.add_argument("--format", choices=sorted(READERS), help="檔案格式 (預設依副檔名判斷)")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    parser.add_argument("--encoding", default="utf-8-sig")
+    args = parser.parse_args()
+
+    fmt = args.format or detect_format(args.file)
+    progress = lambda s: print(f"  已寫入 {s['inserted']} 筆，更新 {s['updated']} 筆...", flush=True)
+    if args.file == '-':
+        stream = io.TextIOWrapper(sys.stdin.buffer, encoding=args.encoding, newline='')
+    else:
+        stream = open(args.file, encoding=args.encoding, newline='')
+    try:
+        stats = ingest_stream(args.template, stream, fmt, args.batch_size, progress)
+    except IngestError as e:
+        print(f"匯入失敗: {e}")
+        sys.exit(1)
+    finally:
+        stream.close()
+    print(f"範本 '{stats['table']}' 匯入完成：新增 {stats['inserted']} 筆，更新 {stats['updated']} 筆，"
+          f"重複 {stats['duplicates']} 筆，略過 {stats['skipped']} 筆，耗時 {stats['seconds']} 秒。")
+    for error in stats['errors']:
+        print(f"  {error}")
+
+
+if __name__ == "__main__":
+    main()
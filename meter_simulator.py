@@ -0,0 +1,267 @@
+# ems_project/meter_simulator.py
+# 本機電表模擬器：以 HTTP 提供與現場電表相同格式的回應，讓收集程式可在離線環境測試吞吐量與逾時行為。
+#   累計型 (電表值/水表值/油表值): 隨時間遞增的累計值；電流: 依日夜負載變化；風壓: 6.2 ~ 7.0；
+#   設備狀態: 開機/關機值 (預設 255/0) 隨機切換，多台設備共用 URL 時回傳 {狀態鍵: 值} 的 JSON。
+# 可設定延遲、抖動、錯誤率 (HTTP 500) 與掛住的連線 (接受連線但不回應)。
+#
+# 原始 URL 改寫為 http://<模擬器>/<原主機><原路徑>?<原查詢字串>，回應種類依使用該 URL 的範本欄位判斷；
+# 不在 url_list 中的路徑依路徑文字判斷 (kwh / current / pressure / status)。
+#
+# 用法:
+#   python meter_simulator.py --port 8900                        # 模擬 url_list 中的所有 URL (列出改寫後的位址)
+#   python meter_simulator.py --port 8900 --latency 200 --jitter 100 --error-rate 0.05 --hang-rate 0.01
+# 收集程式的負載測試請用 benchmarks/collector_load.py (會在資料庫副本中改寫 URL 並啟動模擬器)。
+
+import argparse
+import json
+import math
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+import device_monitor
+
+DEFAULT_TOGGLE_SECONDS = 300   # 設備狀態平均多久切換一次
+
+
+class FaultConfig:
+    """延遲 = latency_ms ± jitter_ms；error_rate 機率回傳 500；hang_rate 機率掛住 hang_seconds 後直接斷線"""
+
+    def __init__(self, latency_ms=0, jitter_ms=0, error_rate=0.0, hang_rate=0.0, hang_seconds=120):
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.error_rate = error_rate
+        self.hang_rate = hang_rate
+        self.hang_seconds = hang_seconds
+
+
+def infer_kind(text):
+    """由欄位名稱或 URL 路徑判斷回應種類"""
+    lower = text.lower()
+    if '電流' in text or 'current' in lower:
+        return 'current'
+    if '壓' in text or 'pressure' in lower:
+        return 'pressure'
+    if '狀態' in text or 'status' in lower:
+        return 'status'
+    return 'counter'
+
+
+def _load_factor(now):
+    """日間較高的負載曲線 (0.2 ~ 1.0)"""
+    hours = time.localtime(now).tm_hour + time.localtime(now).tm_min / 60
+    return 0.6 - 0.4 * math.cos(2 * math.pi * hours / 24)
+
+
+class SimulatedMeter:
+    """單一 URL 的模擬值；status_keys 為 None 時回傳單一狀態值，否則回傳 {狀態鍵: 值} 的 JSON"""
+
+    def __init__(self, kind, rng, status_keys=None, on_val='255', off_val='0', toggle_seconds=DEFAULT_TOGGLE_SECONDS):
+        self.kind = kind
+        self.rng = rng
+        self.rated = rng.uniform(20, 120)
+        self.value = rng.uniform(1000, 50000)
+        self.updated = time.time()
+        self.on_val, self.off_val = on_val, off_val
+        self.toggle_seconds = toggle_seconds
+        self.status_keys = status_keys
+        self.states = {key: rng.random() < 0.5 for key in (status_keys or [None])}
+        self.lock = threading.Lock()
+
+    def read(self, now=None):
+        now = now or time.time()
+        with self.lock:
+            elapsed, self.updated = max(0.0, now - self.updated), now
+            if self.kind == 'counter':
+                self.value += self.rated * _load_factor(now) * elapsed / 3600
+                return f"{self.value:.2f}"
+            if self.kind == 'current':
+                return f"{self.rated * _load_factor(now) * 1.6 * self.rng.uniform(0.95, 1.05):.2f}"
+            if self.kind == 'pressure':
+                return f"{self.rng.uniform(6.2, 7.0):.2f}"
+            for key in self.states:
+                if self.rng.random() < elapsed / self.toggle_seconds:
+                    self.states[key] = not self.states[key]
+            values = {key: self.on_val if on else self.off_val for key, on in self.states.items()}
+            return values[None] if self.status_keys is None else json.dumps(values)
+
+
+def simulated_url(url, base_url):
+    """原始 URL 改寫為模擬器上的位址"""
+    parts = urlsplit(url)
+    return f"{base_url}/{parts.netloc}{parts.path}" + (f"?{parts.query}" if parts.query else "")
+
+
+def _to_simulated(url, base_url):
+    """已是模擬器位址時原樣回傳"""
+    return url if url.startswith(base_url + '/') else simulated_url(url, base_url)
+
+
+def _request_key(url):
+    parts = urlsplit(url)
+    return parts.path + (f"?{parts.query}" if parts.query else "")
+
+
+def load_meters(conn, base_url, seed=1, toggle_seconds=DEFAULT_TOGGLE_SECONDS):
+    """依 url_list 與範本設定建立 {請求路徑: SimulatedMeter}；conn 中的 URL 可以是原始或已改寫的位址"""
+    rng = random.Random(seed)
+    urls = {row[0]: row[1] for row in conn.execute("SELECT id, url FROM url_list")}
+    url_map = {url_id: (_to_simulated(url, base_url), None) for url_id, url in urls.items()}
+    kinds, status = {}, {}
+    for (config_json,) in conn.execute("SELECT columns_config FROM data_templates"):
+        try:
+            columns_config = json.loads(config_json)
+        except (ValueError, TypeError):
+            continue
+        for col in columns_config:
+            if col.get('type') == 'URL':
+                url, _ = url_map.get(int(col['value']) if str(col['value']).isdigit() else None, (None, None))
+                if url:
+                    kinds.setdefault(url, infer_kind(col['name']))
+            elif col.get('type') == '設備狀態監控':
+                try:
+                    devices = device_monitor.parse_devices(col['value'], url_map)
+                except device_monitor.MonitorConfigError:
+                    continue
+                for device in devices:
+                    entry = status.setdefault(device.url, {'keys': [], 'on': device.on_val, 'off': device.off_val})
+                    if device.status_key is not None:
+                        entry['keys'].append(device.status_key)
+    meters = {}
+    for url, _ in url_map.values():
+        if url in status:
+            entry = status[url]
+            meters[_request_key(url)] = SimulatedMeter('status', random.Random(rng.random()), entry['keys'] or None, entry['on'], entry['off'], toggle_seconds)
+        else:
+            meters[_request_key(url)] = SimulatedMeter(kinds.get(url) or infer_kind(url), random.Random(rng.random()))
+    return meters
+
+
+def rewrite_urls(conn, base_url):
+    """將 url_list 的 URL 改寫為模擬器位址 (只可用於資料庫副本)，回傳改寫筆數"""
+    rows = conn.execute("SELECT id, url FROM url_list").fetchall()
+    changed = [(_to_simulated(url, base_url), url_id) for url_id, url in rows if _to_simulated(url, base_url) != url]
+    conn.executemany("UPDATE url_list SET url = ? WHERE id = ?", changed)
+    conn.commit()
+    return len(changed)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"   # keep-alive，與收集程式的 Session 重複使用連線相同
+
+    def do_GET(self):
+        simulator = self.server.simulator
+        faults = simulator.faults
+        rng = simulator.rng
+        delay = max(0.0, faults.latency_ms + rng.uniform(-faults.jitter_ms, faults.jitter_ms)) / 1000
+        if rng.random() < faults.hang_rate:
+            simulator.count('hangs')
+            simulator.stopping.wait(faults.hang_seconds)
+            self.close_connection = True
+            return
+        if delay:
+            time.sleep(delay)
+        if rng.random() < faults.error_rate:
+            simulator.count('errors')
+            self._send(500, "simulated error")
+            return
+        simulator.count('requests')
+        self._send(200, simulator.meter_for(self.path).read())
+
+    def _send(self, code, text):
+        body = text.encode('utf-8')
+        self.send_response(code)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MeterSimulator:
+    """在背景執行緒中提供模擬電表的 HTTP 服務；port=0 時由系統指定可用的埠號"""
+
+    def __init__(self, meters=None, faults=None, host='127.0.0.1', port=0, seed=1):
+        self.meters = meters or {}
+        self.faults = faults or FaultConfig()
+        self.rng = random.Random(seed)
+        self.stopping = threading.Event()
+        self._stats = {'requests': 0, 'errors': 0, 'hangs': 0}
+        self._lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), _Handler)
+        self.server.daemon_threads = True
+        self.server.simulator = self
+        self._thread = None
+
+    @property
+    def base_url(self):
+        host, port = self.server.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def meter_for(self, path):
+        with self._lock:
+            meter = self.meters.get(path)
+            if meter is None:
+                meter = self.meters[path] = SimulatedMeter(infer_kind(path), random.Random(self.rng.random()))
+            return meter
+
+    def count(self, key):
+        with self._lock:
+            self._stats[key] += 1
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, name="meter-simulator", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.stopping.set()
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本機電表模擬器")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8900)
+    parser.add_argument("--latency", type=float, default=0, help="回應延遲毫秒數")
+    parser.add_argument("--jitter", type=float, default=0, help="延遲的隨機變動範圍 (±毫秒)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="回傳 HTTP 500 的機率")
+    parser.add_argument("--hang-rate", type=float, default=0.0, help="接受連線但不回應的機率")
+    parser.add_argument("--hang-seconds", type=float, default=120)
+    parser.add_argument("--toggle-seconds", type=float, default=DEFAULT_TOGGLE_SECONDS, help="設備狀態平均切換間隔秒數")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    import db
+    faults = FaultConfig(args.latency, args.jitter, args.error_rate, args.hang_rate, args.hang_seconds)
+    simulator = MeterSimulator(faults=faults, host=args.host, port=args.port, seed=args.seed)
+    conn = db.connect()
+    try:
+        simulator.meters = load_meters(conn, simulator.base_url, args.seed, args.toggle_seconds)
+        originals = conn.execute("SELECT url FROM url_list ORDER BY id").fetchall()
+    finally:
+        conn.close()
+    for (url,) in originals:
+        target = _to_simulated(url, simulator.base_url)
+        print(f"{simulator.meter_for(_request_key(target)).kind:<8} {target}")
+    print(f"模擬器已啟動於 {simulator.base_url}，按 Ctrl+C 停止。")
+    try:
+        simulator.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        simulator.server.server_close()
+        print(f"統計: {simulator.stats()}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+# ems_project/migrate_types.py
+# 將舊版全部為 TEXT 的範本資料表轉換為具型別的欄位 (REAL / INTEGER / TIMESTAMP)
+#
+# 用法:
+#   python migrate_types.py                  # 轉換所有範本資料表
+#   python migrate_types.py 卓越空壓 三廠自來水
+#   python migrate_types.py --dry-run        # 只列出需要轉換的資料表與欄位
+
+import argparse
+import json
+
+import db
+import formula_engine
+import schema_cache
+from collector_core import COLUMN_DTYPES, coerce_value, get_template_dtypes, get_template_time_columns, ensure_time_index
+
+BATCH_SIZE = 5000
+
+
+def plan_table_migration(conn, table_name, columns_config):
+    """
+    比對資料表目前的宣告型別與範本定義的型別。
+    回傳 [(欄位, 型別, 新的宣告型別), ...] (包含所有欄位)；不需要轉換時回傳 None。
+    """
+    dtypes = get_template_dtypes(columns_config)
+    info = schema_cache.get_catalog(conn).tables.get(table_name)
+    if not info or not info.columns:
+        return None
+    plan, changed = [], False
+    for col_name in info.columns:
+        declared = info.types[col_name]
+        if col_name == 'id':
+            continue
+        dtype = dtypes.get(col_name)
+        target = COLUMN_DTYPES[dtype] if dtype else (declared or 'TEXT')
+        if (declared or '').upper() != target:
+            changed = True
+        plan.append((col_name, dtype or 'TEXT', target))
+    return plan if changed else None
+
+
+def _copy_batch(conn, table_name, new_table, plan, after_id, limit=None):
+    col_list = ", ".join(f'"{col}"' for col, _, _ in plan)
+    query = f'SELECT id, {col_list} FROM "{table_name}" WHERE id > ? ORDER BY id'
+    params = [after_id]
+    if limit:
+        query += ' LIMIT ?'; params.append(limit)
+    rows = conn.execute(query, params).fetchall()
+    if rows:
+        converted = [(row[0],) + tuple(coerce_value(value, dtype) for value, (_, dtype, _) in zip(row[1:], plan)) for row in rows]
+        placeholders = ", ".join("?" * (len(plan) + 1))
+        conn.executemany(f'INSERT INTO "{new_table}" (id, {col_list}) VALUES ({placeholders})', converted)
+    return (rows[-1][0] if rows else after_id), len(rows)
+
+
+def migrate_table(conn, table_name, columns_config, unique_key=None, batch_size=BATCH_SIZE, progress=print):
+    """
+    以批次複製的方式轉換資料表型別：
+    1. 建立具型別的新資料表，每批複製 batch_size 筆並立即提交，收集程式可在批次之間繼續寫入；
+    2. 最後在單一寫入交易中補齊期間新增的資料，刪除舊表並將新表改名。
+    設有唯一鍵的範本可能就地更新舊資料，因此整個複製過程改在同一交易中完成以確保一致。
+    """
+    plan = plan_table_migration(conn, table_name, columns_config)
+    if not plan:
+        return 0
+    new_table = f"{table_name}__typed"
+    col_defs = ", ".join(f'"{col}" {declared}' for col, _, declared in plan)
+    conn.execute(f'DROP TABLE IF EXISTS "{new_table}"')
+    conn.execute(f'CREATE TABLE "{new_table}" (id INTEGER PRIMARY KEY AUTOINCREMENT, {col_defs})')
+    conn.commit()
+
+    last_id, copied = 0, 0
+    if not unique_key:
+        while True:
+            last_id, count = _copy_batch(conn, table_name, new_table, plan, last_id, batch_size)
+            conn.commit()
+            copied += count
+            if count < batch_size:
+                break
+            progress(f"  {table_name}: 已複製 {copied} 筆...")
+
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        last_id, count = _copy_batch(conn, table_name, new_table, plan, last_id)
+        copied += count
+        conn.execute(f'DROP TABLE "{table_name}"')
+        conn.execute(f'ALTER TABLE "{new_table}" RENAME TO "{table_name}"')
+        for time_column in get_template_time_columns(columns_config):
+            if time_column in [col for col, _, _ in plan]:
+                ensure_time_index(conn.cursor(), table_name, time_column)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    formula_engine.invalidate(table_name)
+    schema_cache.invalidate()
+    return copied
+
+
+def migrate_all(tables=None, dry_run=False, batch_size=BATCH_SIZE, progress=print):
+    conn = db.connect()
+    try:
+        templates = conn.execute("SELECT template_name, columns_config, unique_key_column FROM data_templates").fetchall()
+        for name, config_json, unique_key in templates:
+            if tables and name not in tables:
+                continue
+            columns_config = json.loads(config_json)
+            plan = plan_table_migration(conn, name, columns_config)
+            if not plan:
+                continue
+            changes = ", ".join(f"{col}→{dtype}" for col, dtype, _ in plan)
+            if dry_run:
+                progress(f"{name}: {changes}")
+                continue
+            progress(f"轉換 {name}: {changes}")
+            copied = migrate_table(conn, name, columns_config, unique_key, batch_size, progress)
+            progress(f"  {name}: 完成，共 {copied} 筆。")
+    finally:
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="將範本資料表的 TEXT 欄位轉換為具型別的欄位")
+    parser.add_argument("tables", nargs="*", help="只轉換指定的資料表 (預設全部)")
+    parser.add_argument("--dry-run", action="store_true", help="只列出需要轉換的資料表與欄位")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    args = parser.parse_args()
+    migrate_all(set(args.tables) or None, args.dry_run, args.batch_size)
+
+
+if __name__ == "__main__":
+    main()
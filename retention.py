@@ -0,0 +1,370 @@
+# ems_project/retention.py
+# 原始資料保留期限與每月分區封存：範本設定 retention_days 後，收集服務會把整個月份都已超過保留天數的
+# 原始資料複製到獨立的每月資料庫檔案 (archive/<資料表>/<YYYY-MM>_<封存時間>.db.gz，gzip 壓縮)，再由主資料表刪除。
+# 彙總資料 (Rollup_Data) 永久保留；儀表板、EnPI、圖表分析與基線擬合無法使用彙總資料時 (監控範本、時間欄位不同等)
+# 以 aggregate_range() 分組計算，需要原始值時以 read_range() 讀取，兩者都依時間範圍只開啟重疊的分區
+# (Partition_Archive 記錄每個分區的筆數與時間範圍)。
+#
+# 用法:
+#   python retention.py                 # 封存所有已超過保留期限的月份
+#   python retention.py --list          # 列出已封存的分區
+#   python retention.py --vacuum        # 封存後執行 VACUUM，將釋放的空間還給檔案系統
+
+import argparse
+import datetime
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+
+import db
+import device_monitor
+import formula_engine
+import rollup
+import schema_cache
+
+ARCHIVE_DIR_NAME = "archive"   # 相對於資料庫檔案所在的目錄
+COPY_BATCH_SIZE = 5000
+_extract_dir = os.path.join(tempfile.gettempdir(), "ems_partitions")
+_extract_lock = threading.Lock()
+
+
+class RetentionError(Exception):
+    """封存期間資料有變動等無法完成封存的狀況 (該月份保持原狀，下次再試)"""
+
+
+def init_partition_tables(c):
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS Partition_Archive (
+            source_table TEXT NOT NULL,
+            month TEXT NOT NULL,              -- 'YYYY-MM'
+            path TEXT NOT NULL,               -- 相對於資料庫目錄的 .db.gz 路徑
+            time_column TEXT NOT NULL,
+            row_count INTEGER NOT NULL,
+            min_time TEXT,
+            max_time TEXT,
+            archived_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (source_table, month)
+        )
+    ''')
+
+
+def _db_dir(conn):
+    pool = getattr(conn, 'pool', None)
+    path = pool.path if pool is not None else conn.execute("PRAGMA database_list").fetchone()[2]
+    return os.path.dirname(os.path.abspath(path))
+
+
+def _month_start(value):
+    """'YYYY-MM...' 時間字串轉為該月第一天的 date；格式不符時回傳 None"""
+    try:
+        return datetime.date(int(value[:4]), int(value[5:7]), 1)
+    except (TypeError, ValueError):
+        return None
+
+
+def _next_month(date):
+    return (date + datetime.timedelta(days=32)).replace(day=1)
+
+
+def _retention_targets(c):
+    """回傳 [(資料表, 時間欄位, 保留天數, 是否為監控範本)]，只包含已設定保留天數且資料表存在的範本"""
+    existing_tables = set(schema_cache.table_names(c.connection))
+    targets = []
+    rows = c.execute("SELECT template_name, columns_config, retention_days FROM data_templates WHERE retention_days > 0").fetchall()
+    for name, config_json, retention_days in rows:
+        if name not in existing_tables:
+            continue
+        try:
+            columns_config = json.loads(config_json)
+        except (ValueError, TypeError):
+            continue
+        is_monitor = any(col['type'] == '設備狀態監控' for col in columns_config)
+        time_columns = ['start_time'] if is_monitor else [
+            col['name'] for col in columns_config if col['type'] == '動態公式' and str(col['value']).strip().lower() == 'now']
+        if time_columns and schema_cache.has_column(c.connection, name, time_columns[0]):
+            targets.append((name, time_columns[0], int(retention_days), is_monitor))
+    return targets
+
+
+def _extract(path):
+    """將 .db.gz 分區解壓縮到暫存目錄 (已解壓縮過則直接使用；每次封存都寫入新檔名，內容不會改變)"""
+    digest = hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()[:12]
+    target = os.path.join(_extract_dir, f"{digest}_{os.path.basename(path)[:-len('.gz')]}")
+    with _extract_lock:
+        if not os.path.exists(target):
+            os.makedirs(_extract_dir, exist_ok=True)
+            partial = target + ".tmp"
+            with gzip.open(path, 'rb') as src, open(partial, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+            os.replace(partial, target)
+    return target
+
+
+def _compress(source, path):
+    partial = path + ".tmp"
+    with open(source, 'rb') as src, gzip.open(partial, 'wb') as dst:
+        shutil.copyfileobj(src, dst)
+    os.replace(partial, path)
+
+
+def archive_month(conn, table_name, time_column, month, is_monitor=False):
+    """
+    將一個月份 ('YYYY-MM') 的原始資料移到分區檔案，回傳封存的筆數。
+    該月份已有分區時 (例如之後才補寫的資料) 併入原分區。監控範本中尚未結束 (end_time 為空) 的紀錄不封存。
+    分區檔案寫入完成後才在同一個交易中刪除原始資料並登記分區；刪除筆數與複製筆數不同時整個月份保持原狀。
+    """
+    start, end = rollup.month_bounds(month)
+    where = f'"{time_column}" >= ? AND "{time_column}" < ?' + (' AND end_time IS NOT NULL' if is_monitor else '')
+    row_count, min_time, max_time = conn.execute(f'SELECT COUNT(*), MIN("{time_column}"), MAX("{time_column}") FROM "{table_name}" WHERE {where}', (start, end)).fetchone()
+    if row_count == 0:
+        return 0
+
+    # 每次寫入新的檔案，登記成功後才刪除舊分區檔，中途失敗時舊分區與主資料表都保持原狀
+    base = _db_dir(conn)
+    relative_path = os.path.join(ARCHIVE_DIR_NAME, table_name, f"{month}_{datetime.datetime.now():%Y%m%d%H%M%S%f}.db.gz")
+    path = os.path.join(base, relative_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    existing = conn.execute("SELECT path, row_count, min_time, max_time FROM Partition_Archive WHERE source_table = ? AND month = ?", (table_name, month)).fetchone()
+    if existing and not os.path.exists(os.path.join(base, existing[0])):
+        raise RetentionError(f"'{table_name}' {month} 的分區檔案不存在: {existing[0]}")
+    work_path = path[:-len('.gz')]
+    if existing:
+        shutil.copyfile(_extract(os.path.join(base, existing[0])), work_path)
+
+    try:
+        part = sqlite3.connect(work_path)
+        try:
+            if not existing:
+                create_sql = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = ?", (table_name,)).fetchone()[0]
+                part.execute(create_sql)
+                part.execute(f'CREATE INDEX "idx_{table_name}_{time_column}" ON "{table_name}" ("{time_column}")')
+            cursor = conn.execute(f'SELECT * FROM "{table_name}" WHERE {where} ORDER BY "{time_column}"', (start, end))
+            placeholders = ', '.join('?' * len(cursor.description))
+            copied = 0
+            while True:
+                rows = cursor.fetchmany(COPY_BATCH_SIZE)
+                if not rows:
+                    break
+                part.executemany(f'INSERT INTO "{table_name}" VALUES ({placeholders})', rows)
+                copied += len(rows)
+            part.commit()
+        finally:
+            part.close()
+        if copied != row_count:
+            raise RetentionError(f"'{table_name}' {month} 複製筆數 ({copied}) 與預期 ({row_count}) 不符")
+        _compress(work_path, path)
+    finally:
+        if os.path.exists(work_path):
+            os.remove(work_path)
+
+    if existing:
+        row_count_total = existing[1] + row_count
+        min_time, max_time = min(existing[2], min_time), max(existing[3], max_time)
+    else:
+        row_count_total = row_count
+
+    def commit():
+        c = conn.cursor()
+        try:
+            deleted = c.execute(f'DELETE FROM "{table_name}" WHERE {where}', (start, end)).rowcount
+            if deleted != row_count:
+                raise RetentionError(f"'{table_name}' {month} 在封存期間有資料變動，下次再封存")
+            c.execute('''
+                INSERT OR REPLACE INTO Partition_Archive (source_table, month, path, time_column, row_count, min_time, max_time, archived_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+            ''', (table_name, month, relative_path, time_column, row_count_total, min_time, max_time))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+
+    try:
+        db.run_with_retry(commit)
+    except Exception:
+        os.remove(path)
+        raise
+    if existing:
+        os.remove(os.path.join(base, existing[0]))
+    formula_engine.invalidate(table_name)
+    if is_monitor:
+        device_monitor.states.invalidate(table_name)
+    return row_count
+
+
+def archive_expired(conn, now=None, tables=None):
+    """
+    封存各範本中整個月份都早於 (now - retention_days) 的原始資料。
+    回傳 ([(資料表, 月份, 筆數)], [錯誤訊息])；單一月份失敗不影響其他月份。
+    """
+    now = now or datetime.datetime.now()
+    c = conn.cursor()
+    archived, errors = [], []
+    for table_name, time_column, retention_days, is_monitor in _retention_targets(c):
+        if tables and table_name not in tables:
+            continue
+        horizon = _month_start((now - datetime.timedelta(days=retention_days)).strftime('%Y-%m'))
+        oldest = conn.execute(f'SELECT MIN("{time_column}") FROM "{table_name}"').fetchone()[0]
+        month = _month_start(oldest)
+        while month is not None and month < horizon:
+            try:
+                count = archive_month(conn, table_name, time_column, month.strftime('%Y-%m'), is_monitor)
+                if count:
+                    archived.append((table_name, month.strftime('%Y-%m'), count))
+            except (RetentionError, sqlite3.Error, OSError) as e:
+                if conn.in_transaction:
+                    conn.rollback()
+                errors.append(f"{table_name} {month.strftime('%Y-%m')}: {e}")
+            month = _next_month(month)
+    return archived, errors
+
+
+def forget(c, table_name):
+    """刪除範本時移除分區登記 (封存檔案保留在磁碟上)"""
+    c.execute("DELETE FROM Partition_Archive WHERE source_table = ?", (table_name,))
+
+
+def archived_partitions(conn, table_name, start=None, end=None, time_column=None):
+    """
+    回傳與 [start, end) 時間範圍重疊的分區 [(月份, 絕對路徑, 筆數)]，依月份排序。
+    time_column 與封存時使用的時間欄位不同時無法依時間範圍篩選，回傳該資料表的所有分區。
+    """
+    try:
+        rows = conn.execute('''
+            SELECT month, path, row_count FROM Partition_Archive
+            WHERE source_table = ? AND ((? IS NOT NULL AND time_column != ?)
+                                        OR ((? IS NULL OR max_time >= ?) AND (? IS NULL OR min_time < ?)))
+            ORDER BY month
+        ''', (table_name, time_column, time_column, start, start, end, end)).fetchall()
+    except sqlite3.OperationalError:
+        return []
+    base = _db_dir(conn)
+    return [(month, os.path.join(base, path), row_count) for month, path, row_count in rows]
+
+
+def read_range(conn, table_name, time_column, select_sql, start, end, limit=None):
+    """
+    讀取 [start, end) 範圍內的原始資料 (包含已封存的分區)，依時間排序；select_sql 為 SELECT 的欄位運算式。
+    只開啟時間範圍重疊的分區，最後再讀取主資料表；limit 為總筆數上限。
+    """
+    query = f'SELECT {select_sql} FROM "{table_name}" WHERE "{time_column}" >= ? AND "{time_column}" < ? ORDER BY "{time_column}" LIMIT ?'
+    rows = []
+    for _, path, _ in archived_partitions(conn, table_name, start, end, time_column):
+        remaining = -1 if limit is None else limit - len(rows)
+        if remaining == 0:
+            return rows
+        part = sqlite3.connect(f"file:{_extract(path)}?mode=ro", uri=True)
+        try:
+            rollup.register_functions(part)
+            rows.extend(part.execute(query, (start, end, remaining)).fetchall())
+        finally:
+            part.close()
+    remaining = -1 if limit is None else limit - len(rows)
+    if remaining != 0:
+        rows.extend(conn.execute(query, (start, end, remaining)).fetchall())
+    return rows
+
+
+class _Row(tuple):
+    """合併後的分組結果，與 sqlite3.Row 相同可用索引或欄位名稱取值"""
+    names = ()
+
+    def __getitem__(self, key):
+        return tuple.__getitem__(self, self.names.index(key) if isinstance(key, str) else key)
+
+    def keys(self):
+        return list(self.names)
+
+
+def _merge_partial(acc, values):
+    """acc / values 皆為 [總和, 筆數, 最小, 最大]"""
+    total, count, low, high = values
+    if total is not None:
+        acc[0] = total if acc[0] is None else acc[0] + total
+    acc[1] += count or 0
+    if low is not None and (acc[2] is None or low < acc[2]):
+        acc[2] = low
+    if high is not None and (acc[3] is None or high > acc[3]):
+        acc[3] = high
+
+
+def _finish_partial(func, acc):
+    total, count, low, high = acc
+    if func == 'COUNT':
+        return count
+    if func == 'AVG':
+        return total / count if count and total is not None else None
+    return {'SUM': total if count else None, 'MIN': low, 'MAX': high}[func]
+
+
+def aggregate_range(conn, table_name, time_column, group_sql, aggregates, start, end):
+    """
+    在 [start, end) 範圍內依 group_sql 分組計算聚合 (包含已封存的分區)，回傳 [(分組值, 聚合值...)]，依分組值排序。
+    aggregates: [(聚合方式, SQL 運算式, 別名或 None)]，聚合方式為 SUM/AVG/MIN/MAX/COUNT ('*' 只能用於 COUNT)。
+    沒有重疊的分區時直接查詢主資料表；否則各來源分別計算總和/筆數/最小/最大後合併 (AVG = 總和 / 筆數)。
+    """
+    where = f'"{time_column}" >= ? AND "{time_column}" < ?'
+    partitions = archived_partitions(conn, table_name, start, end, time_column)
+    if not partitions:
+        select_parts = ', '.join(f'{func}({expr})' + (f' AS "{alias}"' if alias else '') for func, expr, alias in aggregates)
+        return conn.execute(f'SELECT {group_sql} AS x_axis, {select_parts} FROM "{table_name}" WHERE {where} GROUP BY x_axis ORDER BY x_axis',
+                            (start, end)).fetchall()
+
+    partial_parts = ', '.join('NULL, COUNT(*), NULL, NULL' if expr == '*' else f'SUM({expr}), COUNT({expr}), MIN({expr}), MAX({expr})'
+                              for _, expr, _ in aggregates)
+    query = f'SELECT {group_sql} AS x_axis, {partial_parts} FROM "{table_name}" WHERE {where} GROUP BY x_axis'
+    groups = {}
+
+    def merge(rows):
+        for row in rows:
+            accs = groups.setdefault(row[0], [[None, 0, None, None] for _ in aggregates])
+            for i, acc in enumerate(accs):
+                _merge_partial(acc, row[1 + 4 * i:5 + 4 * i])
+
+    for _, path, _ in partitions:
+        part = sqlite3.connect(f"file:{_extract(path)}?mode=ro", uri=True)
+        try:
+            rollup.register_functions(part)
+            merge(part.execute(query, (start, end)).fetchall())
+        finally:
+            part.close()
+    merge(conn.execute(query, (start, end)).fetchall())
+    row_type = type('Row', (_Row,), {'names': ('x_axis',) + tuple(alias or f"v{i}" for i, (_, _, alias) in enumerate(aggregates))})
+    return [row_type((key,) + tuple(_finish_partial(func, acc) for (func, _, _), acc in zip(aggregates, accs)))
+            for key, accs in sorted(groups.items(), key=lambda item: (item[0] is not None, item[0]))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="封存超過保留期限的原始資料")
+    parser.add_argument("--list", action="store_true", help="列出已封存的分區")
+    parser.add_argument("--vacuum", action="store_true", help="封存後執行 VACUUM 釋放空間")
+    parser.add_argument("tables", nargs="*", metavar="TABLE", help="只處理指定資料表 (預設全部)")
+    args = parser.parse_args()
+    conn = db.connect()
+    try:
+        c = conn.cursor()
+        init_partition_tables(c)
+        conn.commit()
+        if args.list:
+            for row in c.execute("SELECT source_table, month, row_count, path FROM Partition_Archive ORDER BY source_table, month"):
+                print(f"{row[0]}\t{row[1]}\t{row[2]} 筆\t{row[3]}")
+            return
+        archived, errors = archive_expired(conn, tables=set(args.tables) or None)
+        for table_name, month, count in archived:
+            print(f"已封存 {table_name} {month}: {count} 筆")
+        for message in errors:
+            print(f"封存失敗 {message}")
+        if not archived and not errors:
+            print("沒有需要封存的資料")
+        if args.vacuum:
+            conn.execute("VACUUM")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
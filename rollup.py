@@ -0,0 +1,298 @@
+# ems_project/rollup.py
+# 預先彙總 (rollup) 資料表：由收集程式在寫入原始資料時同步累加，
+# 儀表板、EnPI 與圖表分析改讀每小時/每日/每月的彙總值，不必每次重新掃描原始資料。
+#
+# 用法:
+#   python rollup.py --rebuild               # 重建所有範本的彙總資料
+#   python rollup.py --rebuild 卓越空壓 三廠自來水
+
+import argparse
+import json
+import math
+import sqlite3
+
+import schema_cache
+
+# 各彙總層級的 bucket 字串長度 (對應 'YYYY-MM-DD HH:MM:SS' 的前綴)
+TIERS = {'hour': 13, 'day': 10, 'month': 7}
+# 由下一層彙總推導上一層時使用的來源層級
+PARENT_TIER = {'day': 'hour', 'month': 'day'}
+# 各層級 bucket 中代表「小時 / 日 / 月」的子字串位置 (substr 起點, 長度)，作為圖表 X 軸
+TIER_LABELS = {'hour': (12, 2), 'day': (9, 2), 'month': (6, 2)}
+# 可由彙總值直接計算的聚合方式
+ROLLUP_AGGREGATES = {
+    'SUM': 'SUM(sum_value)',
+    'AVG': 'SUM(sum_value) / SUM(count_value)',
+    'MIN': 'MIN(min_value)',
+    'MAX': 'MAX(max_value)',
+    'COUNT': 'SUM(count_value)',
+}
+
+
+def init_rollup_tables(c):
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS Rollup_Data (
+            source_table TEXT NOT NULL,          -- 原始資料表 (範本名稱)
+            column_name TEXT NOT NULL,           -- 原始欄位
+            tier TEXT NOT NULL,                  -- 'hour' / 'day' / 'month'
+            bucket TEXT NOT NULL,                -- 'YYYY-MM-DD HH' / 'YYYY-MM-DD' / 'YYYY-MM'
+            sum_value REAL NOT NULL DEFAULT 0,
+            count_value INTEGER NOT NULL DEFAULT 0,
+            min_value REAL,
+            max_value REAL,
+            last_value REAL,                     -- bucket 內時間最晚的一筆數值
+            last_time TEXT,
+            PRIMARY KEY (source_table, column_name, tier, bucket)
+        ) WITHOUT ROWID
+    ''')
+    # 記錄哪些資料表的彙總資料已完整建立，只有列在這裡的資料表才會改讀彙總值
+    c.execute('''
+        CREATE TABLE IF NOT EXISTS Rollup_State (
+            source_table TEXT PRIMARY KEY,
+            time_column TEXT NOT NULL,
+            built_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+
+
+def to_number(value):
+    """將欄位值轉為 float；空值、非數值或 NaN/Inf 時回傳 None"""
+    if value is None or isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        number = float(value)
+    else:
+        try:
+            number = float(str(value).strip())
+        except ValueError:
+            return None
+    return number if math.isfinite(number) else None
+
+
+def num_sql(column_name):
+    """欄位轉數值的 SQL 運算式；已是 REAL/INTEGER 的值直接使用，只有文字值才呼叫 ems_num"""
+    return f"""(CASE WHEN typeof("{column_name}") IN ('integer', 'real') THEN "{column_name}" ELSE ems_num("{column_name}") END)"""
+
+
+def register_functions(conn):
+    conn.create_function('ems_num', 1, to_number, deterministic=True)
+
+
+def get_rollup_columns(columns_config):
+    """回傳一般範本需要彙總的欄位 (時間欄位以外的所有欄位)；監控範本不彙總"""
+    if any(col['type'] == '設備狀態監控' for col in columns_config):
+        return []
+    return [col['name'] for col in columns_config if not (col['type'] == '動態公式' and str(col['value']).strip().lower() == 'now')]
+
+
+def get_rollup_time_column(conn, table_name):
+    """資料表的彙總資料已建立時回傳其時間欄位，否則回傳 None"""
+    row = conn.execute("SELECT time_column FROM Rollup_State WHERE source_table = ?", (table_name,)).fetchone()
+    return row[0] if row else None
+
+
+def has_rollup(conn, table_name, time_column):
+    try:
+        return get_rollup_time_column(conn, table_name) == time_column
+    except sqlite3.OperationalError:
+        return False
+
+
+def apply_sample(c, table_name, time_value, values):
+    """
+    將一筆新寫入的原始資料累加進各層彙總 (與原始資料在同一個交易內執行)。
+    values: {欄位名稱: 原始值}，非數值會被略過。
+    """
+    if not time_value or len(time_value) < TIERS['hour']:
+        return
+    params = []
+    for column_name, raw in values.items():
+        number = to_number(raw)
+        if number is None:
+            continue
+        for tier, length in TIERS.items():
+            params.append((table_name, column_name, tier, time_value[:length], number, number, number, number, time_value))
+    if not params:
+        return
+    c.executemany('''
+        INSERT INTO Rollup_Data (source_table, column_name, tier, bucket, sum_value, count_value, min_value, max_value, last_value, last_time)
+        VALUES (?, ?, ?, ?, ?, 1, ?, ?, ?, ?)
+        ON CONFLICT(source_table, column_name, tier, bucket) DO UPDATE SET
+            sum_value = sum_value + excluded.sum_value,
+            count_value = count_value + 1,
+            min_value = MIN(min_value, excluded.min_value),
+            max_value = MAX(max_value, excluded.max_value),
+            last_value = CASE WHEN last_time IS NULL OR excluded.last_time >= last_time THEN excluded.last_value ELSE last_value END,
+            last_time = MAX(COALESCE(last_time, ''), excluded.last_time)
+    ''', params)
+
+
+def month_bounds(time_value):
+    """回傳時間字串所在月份的半開區間 [YYYY-MM-01, 下個月-01)"""
+    year, month = int(time_value[:4]), int(time_value[5:7])
+    next_year, next_month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return f"{year:04d}-{month:02d}-01", f"{next_year:04d}-{next_month:02d}-01"
+
+
+def rebuild_rollups(c, table_name, time_column, columns, start=None, end=None):
+    """
+    由原始資料重新計算彙總。start/end 為月份對齊的時間字串 (半開區間)，省略時重建整張表。
+    先以原始資料計算每小時彙總，再由每小時推導每日、由每日推導每月。
+    已封存月份 (原始資料已移到分區檔案) 的彙總資料永久保留，不會被刪除或重建。
+    """
+    horizon = archived_until(c, table_name)
+    if horizon is not None and (start is None or start < horizon):
+        start = horizon
+        if end is not None and start >= end:
+            return
+    register_functions(c.connection)
+    range_sql, range_params = "", []
+    if start is not None:
+        range_sql += " AND bucket >= ?"; range_params.append(start)
+    if end is not None:
+        range_sql += " AND bucket < ?"; range_params.append(end)
+
+    for tier, length in TIERS.items():
+        tier_params = [p[:length] for p in range_params]
+        c.execute(f"DELETE FROM Rollup_Data WHERE source_table = ? AND tier = ?{range_sql}", [table_name, tier] + tier_params)
+
+    raw_range_sql, raw_params = "", []
+    if start is not None:
+        raw_range_sql += f' AND "{time_column}" >= ?'; raw_params.append(start)
+    if end is not None:
+        raw_range_sql += f' AND "{time_column}" < ?'; raw_params.append(end)
+
+    for column_name in columns:
+        c.execute(f'''
+            INSERT INTO Rollup_Data (source_table, column_name, tier, bucket, sum_value, count_value, min_value, max_value, last_value, last_time)
+            SELECT ?, ?, 'hour', bucket, SUM(v), COUNT(v), MIN(v), MAX(v), MAX(lv), MAX(t)
+            FROM (
+                SELECT substr("{time_column}", 1, {TIERS['hour']}) AS bucket, "{time_column}" AS t, {num_sql(column_name)} AS v,
+                       FIRST_VALUE({num_sql(column_name)}) OVER (PARTITION BY substr("{time_column}", 1, {TIERS['hour']}) ORDER BY "{time_column}" DESC, id DESC) AS lv
+                FROM "{table_name}"
+                WHERE "{time_column}" IS NOT NULL AND length("{time_column}") >= {TIERS['hour']} AND {num_sql(column_name)} IS NOT NULL{raw_range_sql}
+            )
+            GROUP BY bucket
+        ''', [table_name, column_name] + raw_params)
+        for tier, parent in PARENT_TIER.items():
+            length = TIERS[tier]
+            parent_params = [p[:TIERS[parent]] for p in range_params]
+            c.execute(f'''
+                INSERT INTO Rollup_Data (source_table, column_name, tier, bucket, sum_value, count_value, min_value, max_value, last_value, last_time)
+                SELECT source_table, column_name, ?, b, SUM(sum_value), SUM(count_value), MIN(min_value), MAX(max_value), MAX(lv), MAX(last_time)
+                FROM (
+                    SELECT source_table, column_name, substr(bucket, 1, {length}) AS b, sum_value, count_value, min_value, max_value, last_time,
+                           FIRST_VALUE(last_value) OVER (PARTITION BY substr(bucket, 1, {length}) ORDER BY last_time DESC) AS lv
+                    FROM Rollup_Data
+                    WHERE source_table = ? AND column_name = ? AND tier = ?{range_sql}
+                )
+                GROUP BY b
+            ''', [tier, table_name, column_name, parent] + parent_params)
+
+
+def archived_until(c, table_name):
+    """回傳最後一個已封存月份的下個月第一天 ('YYYY-MM-01')，沒有封存的分區時回傳 None"""
+    try:
+        row = c.execute("SELECT MAX(month) FROM Partition_Archive WHERE source_table = ?", (table_name,)).fetchone()
+    except sqlite3.OperationalError:
+        return None
+    return month_bounds(row[0])[1] if row and row[0] else None
+
+
+def rebuild_sample_months(c, table_name, time_column, columns, time_values):
+    """原始資料被就地更新 (唯一鍵) 時，重建受影響月份的彙總"""
+    for month_start in sorted({month_bounds(t)[0] for t in time_values if t and len(t) >= TIERS['month']}):
+        rebuild_rollups(c, table_name, time_column, columns, *month_bounds(month_start))
+
+
+def mark_built(c, table_name, time_column):
+    c.execute("INSERT INTO Rollup_State (source_table, time_column) VALUES (?, ?) ON CONFLICT(source_table) DO UPDATE SET time_column = excluded.time_column, built_at = CURRENT_TIMESTAMP", (table_name, time_column))
+
+
+def drop_rollups(c, table_name, forget=False):
+    """清除資料表的彙總資料；forget=True 時一併移除建立狀態 (刪除範本時使用)"""
+    c.execute("DELETE FROM Rollup_Data WHERE source_table = ?", (table_name,))
+    if forget:
+        c.execute("DELETE FROM Rollup_State WHERE source_table = ?", (table_name,))
+
+
+def _template_rollup_targets(c):
+    """回傳 [(資料表, 時間欄位, 彙總欄位), ...]，只包含資料表實際存在的一般範本"""
+    existing_tables = set(schema_cache.table_names(c.connection, include_internal=True))
+    targets = []
+    for name, config_json in c.execute("SELECT template_name, columns_config FROM data_templates").fetchall():
+        if name not in existing_tables:
+            continue
+        try:
+            columns_config = json.loads(config_json)
+        except (ValueError, TypeError):
+            continue
+        columns = get_rollup_columns(columns_config)
+        time_columns = [col['name'] for col in columns_config if col['type'] == '動態公式' and str(col['value']).strip().lower() == 'now']
+        if columns and time_columns:
+            targets.append((name, time_columns[0], columns))
+    return targets
+
+
+def ensure_rollups(conn, tables=None, force=False):
+    """為尚未建立彙總資料的範本進行回填 (force=True 時全部重建)，回傳已處理的資料表名稱"""
+    c = conn.cursor()
+    init_rollup_tables(c)
+    built = {row[0]: row[1] for row in c.execute("SELECT source_table, time_column FROM Rollup_State").fetchall()}
+    processed = []
+    for table_name, time_column, columns in _template_rollup_targets(c):
+        if tables and table_name not in tables:
+            continue
+        if not force and built.get(table_name) == time_column:
+            continue
+        rebuild_rollups(c, table_name, time_column, columns)
+        mark_built(c, table_name, time_column)
+        conn.commit()
+        processed.append(table_name)
+    conn.commit()
+    return processed
+
+
+def query_rollup(conn, table_name, tier, start, end, aggregates, label_start=1, label_length=None):
+    """
+    由彙總表讀取分組結果。
+    aggregates: {(聚合方式, 欄位): 別名}；回傳 [(x_axis, 別名值...), ...] 與欄位別名順序。
+    x_axis 為 bucket 從 label_start 起長度 label_length 的子字串 (省略時為完整 bucket)。
+    """
+    length = TIERS[tier]
+    label_sql = f"substr(bucket, {label_start}, {label_length})" if label_length else "bucket"
+    select_parts, params, columns = [], [], set()
+    for (func, column_name), alias in aggregates.items():
+        expr = ROLLUP_AGGREGATES[func.upper()]
+        for field in ('sum_value', 'count_value', 'min_value', 'max_value'):
+            expr = expr.replace(f'({field})', f'(CASE WHEN column_name = ? THEN {field} END)')
+        select_parts.append(f'{expr} AS "{alias}"')
+        params.extend([column_name] * expr.count('?'))
+        columns.add(column_name)
+    column_placeholders = ', '.join('?' for _ in columns)
+    query = f'''
+        SELECT {label_sql} AS x_axis, {', '.join(select_parts)}
+        FROM Rollup_Data
+        WHERE source_table = ? AND tier = ? AND bucket >= ? AND bucket < ? AND column_name IN ({column_placeholders})
+        GROUP BY x_axis ORDER BY x_axis
+    '''
+    params.extend([table_name, tier, start[:length], end[:length]])
+    params.extend(columns)
+    return conn.execute(query, params).fetchall()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="重建範本資料表的彙總 (rollup) 資料")
+    parser.add_argument("--rebuild", nargs="*", metavar="TABLE", help="重建指定資料表 (未指定時重建全部)")
+    args = parser.parse_args()
+    import db
+    conn = db.connect()
+    try:
+        processed = ensure_rollups(conn, tables=set(args.rebuild or []) or None, force=args.rebuild is not None)
+        print(f"已重建 {len(processed)} 個資料表的彙總資料: {', '.join(processed)}")
+    finally:
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
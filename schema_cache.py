@@ -0,0 +1,117 @@
+# ems_project/schema_cache.py
+# 資料庫結構快取：資料表、欄位 (含宣告型別) 與索引，Flask 與收集程式共用。
+# 每次取用只執行一次 PRAGMA schema_version；任何連線 (包含其他程序) 變更結構時版本號會改變，快取即重建。
+# 範本儲存/刪除與型別遷移後也會主動呼叫 invalidate()。
+
+import threading
+
+# 系統內部維護的資料表 (彙總、設定版本、封存分區)：不列在圖表設定與資料表檢視中，也不可清空
+INTERNAL_TABLES = {'Rollup_Data', 'Rollup_State', 'Config_Version', 'Partition_Archive'}
+
+_catalogs = {}
+_lock = threading.Lock()
+
+
+def is_internal(table):
+    return table.startswith('sqlite_') or table in INTERNAL_TABLES
+
+
+class TableInfo:
+    """單一資料表的結構：columns 依欄位順序，types 為 {欄位: 宣告型別}，indexes 為 [(索引名稱, 是否唯一, [欄位])]"""
+
+    def __init__(self, name):
+        self.name = name
+        self.columns = []
+        self.types = {}
+        self.indexes = []
+
+    def has_column(self, column):
+        return column in self.types
+
+    def indexed_columns(self):
+        """回傳各索引的第一個欄位 (可用於範圍查詢的欄位)"""
+        return {columns[0] for _, _, columns in self.indexes if columns}
+
+
+class Catalog:
+    def __init__(self, version, tables):
+        self.version = version
+        self.tables = tables  # {資料表名稱: TableInfo}，依 sqlite_master 順序
+
+    def table_names(self, include_internal=False):
+        return [name for name in self.tables if include_internal or not is_internal(name)]
+
+    def columns(self, table):
+        info = self.tables.get(table)
+        return list(info.columns) if info else None
+
+
+def _cache_key(conn):
+    pool = getattr(conn, 'pool', None)
+    if pool is not None:
+        return pool.path
+    return conn.execute("PRAGMA database_list").fetchone()[2]
+
+
+def _load(conn, version):
+    tables = {}
+    for (name,) in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' ORDER BY rowid"):
+        tables[name] = TableInfo(name)
+    for table, column, declared in conn.execute('''
+        SELECT m.name, p.name, p.type FROM sqlite_master m JOIN pragma_table_info(m.name) p
+        WHERE m.type = 'table' ORDER BY m.name, p.cid
+    '''):
+        tables[table].columns.append(column)
+        tables[table].types[column] = declared or ''
+    indexes = {}
+    for table, index, unique, column in conn.execute('''
+        SELECT m.name, il.name, il."unique", ii.name
+        FROM sqlite_master m JOIN pragma_index_list(m.name) il JOIN pragma_index_info(il.name) ii
+        WHERE m.type = 'table' ORDER BY m.name, il.name, ii.seqno
+    '''):
+        indexes.setdefault((table, index, bool(unique)), []).append(column)
+    for (table, index, unique), columns in indexes.items():
+        tables[table].indexes.append((index, unique, columns))
+    return Catalog(version, tables)
+
+
+def get_catalog(conn):
+    """
+    回傳目前的結構快取；schema_version 與快取不同時重新讀取。
+    在交易中讀取的結構可能包含未提交的 DDL，因此只回傳、不存入快取。
+    """
+    version = conn.execute("PRAGMA schema_version").fetchone()[0]
+    key = _cache_key(conn)
+    with _lock:
+        catalog = _catalogs.get(key)
+    if catalog is not None and catalog.version == version:
+        return catalog
+    catalog = _load(conn, version)
+    if not conn.in_transaction:
+        with _lock:
+            _catalogs[key] = catalog
+    return catalog
+
+
+def table_names(conn, include_internal=False):
+    return get_catalog(conn).table_names(include_internal)
+
+
+def has_table(conn, table):
+    return table in get_catalog(conn).tables
+
+
+def get_columns(conn, table):
+    """回傳資料表的欄位名稱列表；資料表不存在時回傳 None"""
+    return get_catalog(conn).columns(table)
+
+
+def has_column(conn, table, column):
+    info = get_catalog(conn).tables.get(table)
+    return info is not None and info.has_column(column)
+
+
+def invalidate():
+    """結構變更後呼叫 (schema_version 也會偵測到，這裡讓同一程序內立即生效)"""
+    with _lock:
+        _catalogs.clear()
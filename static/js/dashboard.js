@@ -8,8 +8,8 @@ let dashboardBaselineChart = null;
 document.addEventListener('DOMContentLoaded', () => {
     // 1. 設定動態圖表區塊
     setupDashboardPage();
-    loadDashboardCharts();
-    startDashboardRefresh(); // 頁面載入時就開始自動刷新
+    startDashboardRefresh(); // 頁面載入時就開始接收推播 (不支援時改為載入後定時刷新)
+    if (!dashboardStream) loadDashboardCharts();
 
     // 2. 設定能源基線圖表區塊
     setupBaselineChartSection();
@@ -35,12 +35,22 @@ async function apiFetch(url, options = {}) {
 
 
 // --- 動態圖表邏輯 ---
+// 優先使用 Server-Sent Events 接收推播；瀏覽器不支援或連線失敗時改回定時輪詢
+let dashboardStream = null;
+let dashboardStreamFailures = 0;
+const MAX_STREAM_FAILURES = 3;
+
 function setupDashboardPage() {
     document.getElementById('toggle-refresh-btn').addEventListener('click', toggleDashboardRefresh);
     document.getElementById('refresh-interval').addEventListener('change', restartDashboardRefresh);
 }
 
 function startDashboardRefresh() {
+    if (window.EventSource && dashboardStreamFailures < MAX_STREAM_FAILURES) {
+        openDashboardStream();
+        document.getElementById('toggle-refresh-btn').textContent = "暫停刷新";
+        return;
+    }
     if (dashboardRefreshInterval) clearInterval(dashboardRefreshInterval);
     const intervalInput = document.getElementById('refresh-interval');
     const intervalSeconds = parseInt(intervalInput.value, 10);
@@ -52,13 +62,14 @@ function startDashboardRefresh() {
 }
 
 function stopDashboardRefresh() {
+    closeDashboardStream();
     if (dashboardRefreshInterval) clearInterval(dashboardRefreshInterval);
     dashboardRefreshInterval = null;
     document.getElementById('toggle-refresh-btn').textContent = "開始刷新";
 }
 
 function toggleDashboardRefresh() {
-    dashboardRefreshInterval ? stopDashboardRefresh() : startDashboardRefresh();
+    (dashboardRefreshInterval || dashboardStream) ? stopDashboardRefresh() : startDashboardRefresh();
 }
 
 function restartDashboardRefresh() {
@@ -66,15 +77,49 @@ function restartDashboardRefresh() {
     startDashboardRefresh();
 }
 
+function openDashboardStream() {
+    closeDashboardStream();
+    dashboardStream = new EventSource('/api/realtime_dashboard/stream');
+    dashboardStream.addEventListener('snapshot', (e) => {
+        dashboardStreamFailures = 0;
+        renderDashboardCharts(JSON.parse(e.data));
+    });
+    dashboardStream.addEventListener('chart', (e) => replaceDashboardChart(JSON.parse(e.data)));
+    dashboardStream.addEventListener('delta', (e) => applyDashboardDelta(JSON.parse(e.data)));
+    dashboardStream.addEventListener('reload', () => openDashboardStream());
+    dashboardStream.onerror = () => {
+        // EventSource 會自動重連；連續失敗多次則改用輪詢
+        dashboardStreamFailures++;
+        if (dashboardStreamFailures >= MAX_STREAM_FAILURES) {
+            console.warn('儀表板推播連線失敗，改為定時輪詢。');
+            closeDashboardStream();
+            startDashboardRefresh();
+            loadDashboardCharts();
+        }
+    };
+}
+
+function closeDashboardStream() {
+    if (dashboardStream) dashboardStream.close();
+    dashboardStream = null;
+}
+
 async function loadDashboardCharts() {
     console.log("正在更新動態監控圖表...");
     const data = await apiFetch('/api/realtime_dashboard');
-    const grid = document.getElementById('charts-grid');
     if (!data) {
-        grid.innerHTML = '<p>無法載入圖表數據，請檢查後端服務。</p>';
+        document.getElementById('charts-grid').innerHTML = '<p>無法載入圖表數據，請檢查後端服務。</p>';
         return;
     }
+    renderDashboardCharts(data);
+}
 
+function renderDashboardCharts(data) {
+    const grid = document.getElementById('charts-grid');
+    Object.keys(chartInstances).forEach(id => {
+        chartInstances[id].destroy();
+        delete chartInstances[id];
+    });
     grid.innerHTML = ''; // 清空舊內容
 
     if (data.length === 0) {
@@ -82,112 +127,153 @@ async function loadDashboardCharts() {
         return;
     }
 
-    data.forEach((chartData, index) => {
+    data.forEach(chartData => {
         const card = document.createElement('div');
         card.className = 'chart-card';
-        const canvasId = `dashboard-chart-${index}`;
-        card.innerHTML = `<canvas id="${canvasId}"></canvas>`;
+        card.dataset.chartId = chartData.chartId;
         grid.appendChild(card);
+        drawDashboardChart(card, chartData);
+    });
+}
 
-        if (chartInstances[canvasId]) {
-            chartInstances[canvasId].destroy();
+function drawDashboardChart(card, chartData) {
+    const canvasId = `dashboard-chart-${chartData.chartId}`;
+    if (chartInstances[canvasId]) {
+        chartInstances[canvasId].destroy();
+    }
+    card.innerHTML = `<canvas id="${canvasId}"></canvas>`;
+
+    const ctx = document.getElementById(canvasId).getContext('2d');
+    const datasets = chartData.datasets.map((ds, i) => ({
+        ...ds, // 直接使用後端傳來的設定
+        borderColor: chartColors[i % chartColors.length],
+        backgroundColor: chartColors[i % chartColors.length] + '80', // '80' for transparency
+        fill: ds.type === 'bar',
+    }));
+
+    chartInstances[canvasId] = new Chart(ctx, {
+        type: 'bar', // 預設類型，會被 dataset 中的 type 覆蓋
+        data: { labels: chartData.labels, datasets: datasets },
+        options: {
+            responsive: true,
+            maintainAspectRatio: false,
+            aspectRatio: 1.3, // 建議值：從 1.5 開始嘗試。數字越小，圖表越高。1 代表正方形。
+            plugins: {
+                title: { display: true, text: chartData.tableName, font: { size: 16 } },
+                legend: { display: true, position: 'top' }
+            },
+            scales: {
+                x: { 
+                    title: { display: true, text: '時間' } 
+                },
+                // 將 yAxesConfig 的內容解構到 scales 中
+                ...buildYAxesConfig(datasets)
+            }
         }
+    });
+}
+
+// 依數據範圍計算左右 Y 軸的最大/最小值與標題
+function buildYAxesConfig(datasets) {
+    const yAxesConfig = {};
+    const yAxesData = { y: [], y1: [] };
 
-        const ctx = document.getElementById(canvasId).getContext('2d');
-        const datasets = chartData.datasets.map((ds, i) => ({
-            ...ds, // 直接使用後端傳來的設定
-            borderColor: chartColors[i % chartColors.length],
-            backgroundColor: chartColors[i % chartColors.length] + '80', // '80' for transparency
-            fill: ds.type === 'bar',
-        }));
-          // =========================================================
-        //  ↓↓↓ 這裡是修改的核心：更智慧的 Y 軸設定 ↓↓↓
-        // =========================================================
-
-        const yAxesConfig = {};
-const yAxesData = { y: [], y1: [] };
-
-// 1. 分別收集左右 Y 軸的數據和標籤
-datasets.forEach(ds => {
-    const axisID = ds.yAxisID === 'y1' ? 'y1' : 'y';
-    yAxesData[axisID].push(...ds.data);
+    // 1. 分別收集左右 Y 軸的數據和標籤
+    datasets.forEach(ds => {
+        const axisID = ds.yAxisID === 'y1' ? 'y1' : 'y';
+        yAxesData[axisID].push(...ds.data);
     
-    if (!yAxesConfig[axisID]) {
-        yAxesConfig[axisID] = {
-            labels: [],
-            type: 'linear',
-            display: true,
-            position: axisID === 'y1' ? 'right' : 'left',
-            grid: { drawOnChartArea: axisID === 'y1' ? false : true },
-            // 移除 beginAtZero: true
-        };
-    }
-    yAxesConfig[axisID].labels.push(ds.label);
-});
+        if (!yAxesConfig[axisID]) {
+            yAxesConfig[axisID] = {
+                labels: [],
+                type: 'linear',
+                display: true,
+                position: axisID === 'y1' ? 'right' : 'left',
+                grid: { drawOnChartArea: axisID === 'y1' ? false : true },
+                // 移除 beginAtZero: true
+            };
+        }
+        yAxesConfig[axisID].labels.push(ds.label);
+    });
 
-// 2. 為每個使用到的 Y 軸，動態計算最大/最小值並設定標題
-for (const axisID in yAxesConfig) {
-    const validData = yAxesData[axisID].filter(d => d !== null && !isNaN(d));
+    // 2. 為每個使用到的 Y 軸，動態計算最大/最小值並設定標題
+    for (const axisID in yAxesConfig) {
+        const validData = yAxesData[axisID].filter(d => d !== null && !isNaN(d));
     
-    if (validData.length > 0) {
-        const maxVal = Math.max(...validData);
-        const minVal = Math.min(...validData);
+        if (validData.length > 0) {
+            const maxVal = Math.max(...validData);
+            const minVal = Math.min(...validData);
         
-        // 計算數據範圍
-        const dataRange = maxVal - minVal;
-
-        // 設定 Y 軸的最大/最小值，並增加 10% 的上下緩衝
-        // 如果數據範圍是 0 (所有值都一樣)，則給一個小範圍
-        if (dataRange > 0) {
-            yAxesConfig[axisID].min = minVal - dataRange * 0.1;
-            yAxesConfig[axisID].max = maxVal + dataRange * 0.1;
+            // 計算數據範圍
+            const dataRange = maxVal - minVal;
+
+            // 設定 Y 軸的最大/最小值，並增加 10% 的上下緩衝
+            // 如果數據範圍是 0 (所有值都一樣)，則給一個小範圍
+            if (dataRange > 0) {
+                yAxesConfig[axisID].min = minVal - dataRange * 0.1;
+                yAxesConfig[axisID].max = maxVal + dataRange * 0.1;
+            } else {
+                // 如果所有值都一樣，例如都是 50
+                // 則將 Y 軸範圍設為 50 ± 5
+                yAxesConfig[axisID].min = minVal - 5; 
+                yAxesConfig[axisID].max = maxVal + 5;
+            }
+
         } else {
-            // 如果所有值都一樣，例如都是 50
-            // 則將 Y 軸範圍設為 50 ± 5
-            yAxesConfig[axisID].min = minVal - 5; 
-            yAxesConfig[axisID].max = maxVal + 5;
+            // 如果沒有數據，給一個預設範圍
+            yAxesConfig[axisID].min = 0;
+            yAxesConfig[axisID].max = 10;
         }
 
-    } else {
-        // 如果沒有數據，給一個預設範圍
-        yAxesConfig[axisID].min = 0;
-        yAxesConfig[axisID].max = 10;
+        // 將收集到的標籤組合為 Y 軸標題
+        yAxesConfig[axisID].title = {
+            display: true,
+            text: yAxesConfig[axisID].labels.join(' / ')
+        };
     }
+    return yAxesConfig;
+}
 
-    // 將收集到的標籤組合為 Y 軸標題
-    yAxesConfig[axisID].title = {
-        display: true,
-        text: yAxesConfig[axisID].labels.join(' / ')
-    };
+// 單一圖表整張重送 (新出現、跨日或設定變更)；chart 為 null 代表已無資料
+function replaceDashboardChart(message) {
+    const grid = document.getElementById('charts-grid');
+    let card = grid.querySelector(`.chart-card[data-chart-id="${message.chartId}"]`);
+    if (!message.chart) {
+        const canvasId = `dashboard-chart-${message.chartId}`;
+        if (chartInstances[canvasId]) {
+            chartInstances[canvasId].destroy();
+            delete chartInstances[canvasId];
+        }
+        if (card) card.remove();
+        return;
+    }
+    if (!card) {
+        if (!grid.querySelector('.chart-card')) grid.innerHTML = '';
+        card = document.createElement('div');
+        card.className = 'chart-card';
+        card.dataset.chartId = message.chartId;
+        grid.appendChild(card);
+    }
+    drawDashboardChart(card, message.chart);
 }
-        // =========================================================
-        //  ↑↑↑ 修改核心結束 ↑↑↑
-        // =========================================================
-        chartInstances[canvasId] = new Chart(ctx, {
-            type: 'bar', // 預設類型，會被 dataset 中的 type 覆蓋
-            data: { labels: chartData.labels, datasets: datasets },
-            options: {
-                responsive: true,
-                maintainAspectRatio: false,
-                 // =========================================================
-        //  ↓↓↓ 這裡是關鍵的修改點 ↓↓↓
-        // =========================================================
-                aspectRatio: 1.3, // 建議值：從 1.5 開始嘗試。數字越小，圖表越高。1 代表正方形。
-        // =========================================================
-                plugins: {
-                    title: { display: true, text: chartData.tableName, font: { size: 16 } },
-                    legend: { display: true, position: 'top' }
-                },
-                scales: {
-                     x: { 
-                title: { display: true, text: '時間' } 
-            },
-            // 將 yAxesConfig 的內容解構到 scales 中
-            ...yAxesConfig
-                }
-            }
-        });
+
+// 只更新有變動的分組點：既有的分組更新數值，新的分組依順序插入
+function applyDashboardDelta(message) {
+    const chart = chartInstances[`dashboard-chart-${message.chartId}`];
+    if (!chart) return;
+    const labels = chart.data.labels;
+    message.points.forEach(point => {
+        let index = labels.indexOf(point.label);
+        if (index === -1) {
+            index = labels.findIndex(label => label > point.label);
+            if (index === -1) index = labels.length;
+            labels.splice(index, 0, point.label);
+            chart.data.datasets.forEach(ds => ds.data.splice(index, 0, null));
+        }
+        chart.data.datasets.forEach((ds, i) => { ds.data[index] = point.values[i]; });
     });
+    Object.assign(chart.options.scales, buildYAxesConfig(chart.data.datasets));
+    chart.update('none');
 }
 
 
@@ -220,10 +306,11 @@ async function loadBaselinesForSelect() {
 }
 
 async function loadAndDrawBaselineChart(baselineId) {
-    const data = await apiFetch(`/api/regression_baselines/${baselineId}`);
-    if (!data) return;
+    const evaluation = await apiFetch(`/api/regression_baselines/evaluate?ids=${baselineId}`);
+    if (!evaluation || evaluation.length === 0) return;
+    const data = evaluation[0];
     
-    const reportData = calculateReportData(data); // 計算圖表所需數據
+    const reportData = buildBaselineReportData(data); // 基線標準與 CUSUM 由後端計算
 
     const ctx = document.getElementById('dashboard-baseline-chart').getContext('2d');
     if (dashboardBaselineChart) {
@@ -252,6 +339,13 @@ async function loadAndDrawBaselineChart(baselineId) {
                     backgroundColor: 'rgba(54, 162, 235, 0.7)',
                     type: 'line', // 實際值用長條圖表示
                     yAxisID: 'y',
+                },
+                {
+                    label: '累積節能 (CUSUM)',
+                    data: reportData.map(d => d.cusum),
+                    borderColor: 'rgb(46, 204, 113)',
+                    backgroundColor: 'rgba(46, 204, 113, 0.5)',
+                    yAxisID: 'y1',
                 }
             ]
         },
@@ -263,39 +357,26 @@ async function loadAndDrawBaselineChart(baselineId) {
                 legend: { position: 'top' }
             },
             scales: {
-                y: { beginAtZero: true, title: { display: true, text: '能耗' } }
+                y: { beginAtZero: true, title: { display: true, text: '能耗' } },
+                y1: { position: 'right', grid: { drawOnChartArea: false }, title: { display: true, text: '累積節能' } }
             }
         }
     });
 }
 
-// 輔助函式：從 API 回應計算出報表數據
-function calculateReportData(apiData) {
+// 輔助函式：將後端的評估結果整理為 1-12 月的圖表數據
+function buildBaselineReportData(evaluation) {
+    const byMonth = {};
+    evaluation.months.forEach(m => byMonth[m.month] = m);
     const reportData = [];
-    const formula = { intercept: apiData.baseline.formula_intercept, factors: apiData.factors };
-
     for (let month = 1; month <= 12; month++) {
-        const monthData = apiData.monitored_data[month] || {};
-        const factorsData = monthData.factors || {};
-        const actualConsumption = monthData.actual_consumption;
-
-        let baselineStandard = formula.intercept;
-        let allFactorsPresent = true;
-        
-        formula.factors.forEach(f => {
-            const factorValue = factorsData[f.factor_name];
-            if (factorValue === undefined || factorValue === null || factorValue === '') {
-                allFactorsPresent = false;
-            } else {
-                baselineStandard += parseFloat(factorValue) * f.coefficient;
-            }
-        });
-
+        const m = byMonth[month] || {};
         reportData.push({
             month: `${month}月`,
-            baseline: allFactorsPresent ? baselineStandard.toFixed(2) : null,
-            actual: (actualConsumption !== null && actualConsumption !== undefined) ? actualConsumption : null,
+            baseline: m.expected !== undefined && m.expected !== null ? m.expected.toFixed(2) : null,
+            actual: m.actual_consumption !== undefined ? m.actual_consumption : null,
+            cusum: m.cusum !== undefined ? m.cusum : null,
         });
     }
     return reportData;
-}
\ No newline at end of file
+}
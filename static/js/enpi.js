@@ -132,7 +132,7 @@ async function saveEnpiData() {
     const enpiId = document.getElementById('select-enpi').value;
     const year = document.getElementById('select-year').value;
     const tableBody = document.getElementById('enpi-table').querySelector('tbody');
-    const requests = [];
+    const months = [];
     for (const row of tableBody.rows) {
         const month = row.dataset.month;
         const payload = { 
@@ -142,11 +142,13 @@ async function saveEnpiData() {
             denominator_value: row.querySelector('.denominator-input').value
         };
         if (payload.target_value !== '' || payload.numerator_value !== '' || payload.denominator_value !== '') {
-            requests.push(apiFetch(`/api/enpi/data/${enpiId}/${year}`, { method: 'POST', headers: { 'Content-Type': 'application/json' }, body: JSON.stringify(payload)}));
+            months.push(payload);
         }
     }
-    if (requests.length > 0) { await Promise.all(requests); alert('數據已儲存！'); loadEnpiReport(); } 
-    else { alert('沒有需要儲存的數據。'); }
+    if (months.length === 0) { alert('沒有需要儲存的數據。'); return; }
+    // 整年度一次送出，由後端在單一交易中寫入
+    const result = await apiFetch(`/api/enpi/data/${enpiId}/${year}/bulk`, { method: 'POST', headers: { 'Content-Type': 'application/json' }, body: JSON.stringify({ months })});
+    if (result) { alert('數據已儲存！'); loadEnpiReport(); }
 }
 
 // --- 定義新 EnPI 的彈出視窗邏輯 ---
@@ -107,8 +107,14 @@ async function handleBaselineSelectionForData(e) {
         return;
     }
     
-    const data = await apiFetch(`/api/regression_baselines/${baselineId}`);
+    const [data, evaluation] = await Promise.all([
+        apiFetch(`/api/regression_baselines/${baselineId}`),
+        apiFetch(`/api/regression_baselines/evaluate?ids=${baselineId}`)
+    ]);
     if (!data) return;
+    // 基線標準與差異由後端計算 (以月份對應)
+    const evaluatedMonths = {};
+    (evaluation && evaluation[0] ? evaluation[0].months : []).forEach(m => evaluatedMonths[m.month] = m);
 
     document.getElementById('data-entry-title').textContent = `輸入/檢視 "${data.baseline.name}" 的監控數據`;
     const tableHead = document.getElementById('data-entry-table').querySelector('thead');
@@ -120,7 +126,6 @@ async function handleBaselineSelectionForData(e) {
     tableHead.innerHTML = headerHtml;
 
     tableBody.innerHTML = '';
-    const formula = { intercept: data.baseline.formula_intercept, factors: data.factors };
 
     for (let month = 1; month <= 12; month++) {
         const row = tableBody.insertRow();
@@ -137,7 +142,7 @@ async function handleBaselineSelectionForData(e) {
         });
         rowHtml += `<td><input type="number" step="any" class="actual-consumption-input" value="${actualConsumption}"></td>`;
         
-        const { baselineStandard, diff, diffPercent } = calculateRow(formula, factorsData, actualConsumption);
+        const { baselineStandard, diff, diffPercent } = formatEvaluation(evaluatedMonths[month]);
         
         rowHtml += `<td class="baseline-standard">${baselineStandard}</td><td class="diff">${diff}</td><td class="diff-percent ${Math.abs(parseFloat(diffPercent)) > 10 ? 'highlight' : ''}">${diffPercent}</td>`;
         row.innerHTML = rowHtml;
@@ -147,32 +152,15 @@ async function handleBaselineSelectionForData(e) {
     dataEntrySection.style.display = 'block';
 }
 
-function calculateRow(formula, factorsData, actualConsumption) {
-    let baselineStandard = formula.intercept;
-    let allFactorsEntered = true;
-
-    formula.factors.forEach(f => {
-        const factorValue = factorsData[f.factor_name];
-        if (factorValue === undefined || factorValue === '' || factorValue === null) {
-            allFactorsEntered = false;
-        } else {
-            baselineStandard += parseFloat(factorValue) * f.coefficient;
-        }
-    });
-
-    if (!allFactorsEntered) return { baselineStandard: '', diff: '', diffPercent: '' };
-    if (actualConsumption === '' || actualConsumption === null || actualConsumption === undefined) {
-        return { baselineStandard: baselineStandard.toFixed(2), diff: '', diffPercent: '' };
+function formatEvaluation(evaluated) {
+    if (!evaluated || evaluated.expected === null) return { baselineStandard: '', diff: '', diffPercent: '' };
+    if (evaluated.deviation === null) {
+        return { baselineStandard: evaluated.expected.toFixed(2), diff: '', diffPercent: '' };
     }
-    
-    const actual = parseFloat(actualConsumption);
-    const diff = baselineStandard - actual;
-    const diffPercent = (baselineStandard !== 0) ? (diff / baselineStandard * 100) : 0;
-
     return {
-        baselineStandard: baselineStandard.toFixed(2),
-        diff: diff.toFixed(2),
-        diffPercent: `${diffPercent.toFixed(1)}%`
+        baselineStandard: evaluated.expected.toFixed(2),
+        diff: evaluated.deviation.toFixed(2),
+        diffPercent: `${evaluated.deviation_percent.toFixed(1)}%`
     };
 }
 
@@ -183,7 +171,7 @@ async function saveDataEntry() {
     const rows = document.getElementById('data-entry-table')?.querySelector('tbody')?.rows;
     if (!rows) return;
 
-    const requests = [];
+    const months = [];
     for (const row of rows) {
         const month = row.dataset.month;
         const factors = {};
@@ -201,22 +189,26 @@ async function saveDataEntry() {
         if (actualConsumption !== '') hasData = true;
 
         if (hasData) {
-            const payload = {
-                baseline_id: parseInt(baselineId),
+            months.push({
                 month: parseInt(month),
                 factors: factors,
                 actual_consumption: actualConsumption !== '' ? parseFloat(actualConsumption) : null
-            };
-            requests.push(apiFetch('/api/monitored_data', {
-                method: 'POST',
-                headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify(payload)
-            }));
+            });
         }
     }
     
-    const results = await Promise.all(requests);
-    const successCount = results.filter(r => r && r.success).length;
+    if (months.length === 0) {
+        alert("沒有可儲存的數據。");
+        return;
+    }
+
+    // 所有月份一次送出，由後端在單一交易中寫入
+    const result = await apiFetch('/api/monitored_data/bulk', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ baseline_id: parseInt(baselineId), months })
+    });
+    const successCount = result && result.success ? result.count : 0;
 
     if (successCount > 0) {
         alert(`成功儲存 ${successCount} 個月份的數據！`);